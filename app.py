@@ -1,13 +1,10 @@
 import streamlit as st
 import sqlite3
-import pandas as pd
-import hashlib
-import datetime
-import time
-import random
-import string
-from PIL import Image
-import io
+import html
+import os
+
+from meetup import (analytics, archive, avatars, cache, chat_render, db, geo, matching, message_queue, metrics, notify,
+                    passwords, schema, search, sweeper, venue_map, versions)
 
 # Application configuration
 st.set_page_config(
@@ -17,267 +14,416 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# Database connection and initialization
+# Usernames allowed to open the performance page (comma separated). These
+# names cannot be registered through the app: create the account first,
+# then list it here.
+ADMIN_USERS = {name.strip() for name in os.environ.get("MEETUP_ADMIN_USERS", "").split(",") if name.strip()}
+
+# Database initialization (migrations run once per server process)
 def init_db():
-    conn = sqlite3.connect('meetup_app.db')
-    c = conn.cursor()
-    
-    # Create users table with gender
-    c.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        user_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT UNIQUE NOT NULL,
-        password TEXT NOT NULL,
-        gender TEXT NOT NULL,
-        age INTEGER NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-    
-    # Create requests table with group_size
-    c.execute('''
-    CREATE TABLE IF NOT EXISTS requests (
-        request_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        area TEXT NOT NULL,
-        time_slot TEXT NOT NULL,
-        group_size INTEGER NOT NULL,
-        status TEXT DEFAULT 'pending',
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users (user_id)
-    )
-    ''')
-    
-    # Create matches table
-    c.execute('''
-    CREATE TABLE IF NOT EXISTS matches (
-        match_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        request_id_1 INTEGER NOT NULL,
-        request_id_2 INTEGER NOT NULL,
-        matched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (request_id_1) REFERENCES requests (request_id),
-        FOREIGN KEY (request_id_2) REFERENCES requests (request_id)
-    )
-    ''')
-    
-    # Create messages table
-    c.execute('''
-    CREATE TABLE IF NOT EXISTS messages (
-        message_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        match_id INTEGER NOT NULL,
-        sender_user_id INTEGER NOT NULL,
-        message_text TEXT NOT NULL,
-        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (match_id) REFERENCES matches (match_id),
-        FOREIGN KEY (sender_user_id) REFERENCES users (user_id)
-    )
-    ''')
-    
-    conn.commit()
-    conn.close()
-
-# Hash password
+    schema.ensure_schema()
+    matching.get_engine()  # rebuilds the pending queues on first use
+    if matching.MODE == "batch":
+        from meetup import scheduler
+        scheduler.start()
+    sweeper.start()  # expires pending requests whose slot has passed
+    archive.start()  # moves inactive chats to compressed segment files
+    search.start()  # indexes messages that predate the search index
+    metrics.start_dumper()  # only when MEETUP_METRICS_DUMP is set
+
+# Hash password (salted scrypt, computed on the shared password worker pool)
 def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+    return passwords.hash_password(password)
 
 # User registration
+@metrics.timed
 def register_user(username, password, gender, age):
-    conn = sqlite3.connect('meetup_app.db')
-    c = conn.cursor()
+    # Otherwise anyone could claim a listed admin name that has no account yet
+    if username in ADMIN_USERS:
+        return False
+    
+    hashed_password = hash_password(password)
     
     try:
-        hashed_password = hash_password(password)
-        c.execute("INSERT INTO users (username, password, gender, age) VALUES (?, ?, ?, ?)",
-                 (username, hashed_password, gender, age))
-        conn.commit()
-        return True
+        with db.transaction(immediate=True) as conn:
+            c = conn.cursor()
+            c.execute("INSERT INTO users (username, password, gender, age) VALUES (?, ?, ?, ?)",
+                     (username, hashed_password, gender, age))
+            user_id = c.lastrowid
     except sqlite3.IntegrityError:
         return False
-    finally:
-        conn.close()
+    
+    # A lookup of this id before it existed may have cached None
+    cache.invalidate(cache.USER_DETAILS, user_id)
+    return True
 
 # User login
+@metrics.timed
 def login_user(username, password):
-    conn = sqlite3.connect('meetup_app.db')
-    c = conn.cursor()
+    # Too many recent or running attempts for this name: reject before any hashing
+    if not passwords.limiter.acquire(username):
+        return None, None, None
     
-    hashed_password = hash_password(password)
-    c.execute("SELECT user_id, username, gender FROM users WHERE username = ? AND password = ?", 
-             (username, hashed_password))
-    user = c.fetchone()
-    conn.close()
+    matches = False
+    try:
+        with db.connection() as conn:
+            c = conn.cursor()
+            
+            c.execute("SELECT user_id, username, gender, password FROM users WHERE username = ?", (username,))
+            user = c.fetchone()
+        
+        matches, needs_rehash = passwords.verify(password, user[3] if user else None)
+    finally:
+        passwords.limiter.release(username, matches)
+    if not matches:
+        return None, None, None
     
-    if user:
-        return user[0], user[1], user[2]  # Return user_id, username, and gender
-    return None, None, None
+    # Replace a legacy SHA-256 (or outdated scrypt) hash now that we know the password
+    if needs_rehash:
+        upgraded = hash_password(password)
+        with db.transaction(immediate=True) as conn:
+            conn.execute("UPDATE users SET password = ? WHERE user_id = ? AND password = ?",
+                         (upgraded, user[0], user[3]))
+    
+    return user[0], user[1], user[2]  # Return user_id, username, and gender
 
 # Get user details
+@metrics.timed
+@cache.cached(cache.USER_DETAILS)
 def get_user_details(user_id):
-    conn = sqlite3.connect('meetup_app.db')
-    c = conn.cursor()
-    
-    c.execute("SELECT username, gender, age FROM users WHERE user_id = ?", (user_id,))
-    user = c.fetchone()
-    conn.close()
+    with db.connection() as conn:
+        c = conn.cursor()
+        
+        c.execute("SELECT username, gender, age, avatar_hash FROM users WHERE user_id = ?", (user_id,))
+        user = c.fetchone()
     
     if user:
-        return {"username": user[0], "gender": user[1], "age": user[2]}
+        return {"username": user[0], "gender": user[1], "age": user[2], "avatar_hash": user[3]}
     return None
 
-# Create matching request
-def create_request(user_id, area, time_slot, group_size):
-    conn = sqlite3.connect('meetup_app.db')
-    c = conn.cursor()
+# Set a user's profile image; thumbnails are stored once per distinct image
+@metrics.timed
+def set_avatar(user_id, image_bytes):
+    try:
+        digest = avatars.store(image_bytes)
+    except avatars.InvalidImage:
+        return False, "画像を読み込めませんでした。"
     
-    # Check if user has a pending request
-    c.execute("SELECT request_id FROM requests WHERE user_id = ? AND status = 'pending'", (user_id,))
-    existing_request = c.fetchone()
+    with db.transaction(immediate=True) as conn:
+        c = conn.cursor()
+        
+        c.execute("UPDATE users SET avatar_hash = ? WHERE user_id = ?", (digest, user_id))
+        # Partners see the avatar in their match lists and chat headers
+        c.execute("SELECT match_id, partner_user_id FROM match_participants WHERE user_id = ?", (user_id,))
+        rows = c.fetchall()
+        partners = {partner_id for _, partner_id in rows}
+        bumped = versions.bump(conn, *map(notify.user_topic, partners | {user_id}),
+                               *(notify.match_topic(match_id) for match_id, _ in rows))
     
-    if existing_request:
-        conn.close()
+    cache.invalidate(cache.USER_DETAILS, user_id)
+    for partner_id in partners:
+        cache.invalidate(cache.USER_MATCHES, partner_id)
+    versions.publish(bumped)
+    return True, digest
+
+# Create matching request
+@metrics.timed
+def create_request(user_id, area, time_slot, group_size):
+    # The matching engine persists the request and pairs it atomically
+    try:
+        _, match_id = matching.get_engine().submit(user_id, area, time_slot, group_size)
+    except matching.AlreadyPending:
         return False, "既に待機中のリクエストがあります。"
     
-    # Get user gender
-    c.execute("SELECT gender FROM users WHERE user_id = ?", (user_id,))
-    user_gender = c.fetchone()[0]
-    
-    # Create new request
-    c.execute("INSERT INTO requests (user_id, area, time_slot, group_size, status) VALUES (?, ?, ?, ?, 'pending')",
-             (user_id, area, time_slot, group_size))
-    conn.commit()
-    
-    # Get the new request ID
-    request_id = c.lastrowid
-    
-    # Find opposite gender for matching
-    opposite_gender = "女性" if user_gender == "男性" else "男性"
-    
-    # Try to find a match with opposite gender
-    c.execute("""
-    SELECT r.request_id, r.user_id, r.group_size
-    FROM requests r
-    JOIN users u ON r.user_id = u.user_id
-    WHERE r.status = 'pending' 
-    AND r.area = ? 
-    AND r.time_slot = ? 
-    AND r.user_id != ?
-    AND u.gender = ?
-    ORDER BY r.created_at ASC
-    LIMIT 1
-    """, (area, time_slot, user_id, opposite_gender))
-    
-    match = c.fetchone()
-    
-    if match:
-        # Create a match
-        match_request_id = match[0]
-        match_user_id = match[1]
-        match_group_size = match[2]
+    return True, match_id  # match_id is None while the request waits
+
+# Convert match_participants rows into the dicts used by the UI
+def match_dict(row):
+    match_id, area, time_slot, match_user_id, match_username, match_group_size, my_group_size, match_avatar = row
+    return {
+        "match_id": match_id,
+        "area": area,
+        "time_slot": time_slot,
+        "match_user_id": match_user_id,
+        "match_username": match_username,
+        "match_group_size": match_group_size,
+        "my_group_size": my_group_size,
+        "match_avatar": match_avatar
+    }
+
+# Unread counts are capped so a long unread chat costs no more than this to count
+UNREAD_CAP = 99
+
+# Get user's matches with unread counts and the latest message, newest match first
+@metrics.timed
+@cache.cached(cache.USER_MATCHES)
+def get_user_matches(user_id):
+    with db.connection() as conn:
+        c = conn.cursor()
         
-        c.execute("INSERT INTO matches (request_id_1, request_id_2) VALUES (?, ?)",
-                 (match_request_id, request_id))
-        match_id = c.lastrowid
+        # One query for the whole list: a range scan over the user's participant
+        # rows, with index-only lookups for the latest message and unread count
+        c.execute("""
+        SELECT p.match_id, p.area, p.time_slot, p.partner_user_id, u.username, p.partner_group_size, p.my_group_size,
+            u.avatar_hash, last.sender_user_id, last.message_text, last.timestamp,
+            (SELECT COUNT(*) FROM (
+                SELECT 1 FROM messages m
+                WHERE m.match_id = p.match_id
+                AND m.message_id > COALESCE(rc.last_read_message_id, 0)
+                AND m.sender_user_id != p.user_id
+                LIMIT ?
+            )),
+            ab.segment, ab.offset, ab.length
+        FROM match_participants p
+        JOIN users u ON (p.partner_user_id = u.user_id)
+        LEFT JOIN read_cursors rc ON (rc.user_id = p.user_id AND rc.match_id = p.match_id)
+        LEFT JOIN messages last ON last.message_id = (
+            SELECT MAX(message_id) FROM messages WHERE match_id = p.match_id
+        )
+        LEFT JOIN archive_blocks ab ON ab.match_id = p.match_id AND ab.first_message_id = (
+            SELECT MAX(first_message_id) FROM archive_blocks WHERE match_id = p.match_id
+        )
+        WHERE p.user_id = ?
+        ORDER BY p.matched_at DESC
+        """, (UNREAD_CAP + 1, user_id))
+        rows = c.fetchall()
+    
+    matches = []
+    for row in rows:
+        match = match_dict(row[:8])
+        sender_id, text, timestamp, unread, segment, offset, length = row[8:]
+        if text is None and segment is not None:
+            # Archived chat: the preview comes from its newest cold block
+            _, sender_id, _, text, timestamp = archive.load_block(
+                archive.segment_path(archive.archive_dir(), segment), offset, length)[-1]
+        match["last_message"] = None if text is None else {
+            "sender_id": sender_id,
+            "text": text,
+            "timestamp": timestamp
+        }
+        match["unread_count"] = unread
+        matches.append(match)
+    return matches
+
+# Remember that user_id has read match_id up to message_id
+@metrics.timed
+def mark_read(user_id, match_id, message_id):
+    with db.transaction(immediate=True) as conn:
+        c = conn.cursor()
+        
+        c.execute("""
+        INSERT INTO read_cursors (user_id, match_id, last_read_message_id) VALUES (?, ?, ?)
+        ON CONFLICT (user_id, match_id) DO UPDATE
+        SET last_read_message_id = excluded.last_read_message_id, updated_at = CURRENT_TIMESTAMP
+        WHERE excluded.last_read_message_id > read_cursors.last_read_message_id
+        """, (user_id, match_id, message_id))
+        changed = c.rowcount > 0
+        bumped = versions.bump(conn, notify.user_topic(user_id)) if changed else {}
+    
+    if changed:
+        cache.invalidate(cache.USER_MATCHES, user_id)
+        versions.publish(bumped)
+    return changed
+
+# Get one match as seen by user_id (None if the user is not part of it)
+@metrics.timed
+def get_match(match_id, user_id):
+    with db.connection() as conn:
+        c = conn.cursor()
         
-        # Update both requests to matched status
-        c.execute("UPDATE requests SET status = 'matched' WHERE request_id IN (?, ?)",
-                 (match_request_id, request_id))
+        c.execute("""
+        SELECT p.match_id, p.area, p.time_slot, p.partner_user_id, u.username, p.partner_group_size, p.my_group_size,
+            u.avatar_hash
+        FROM match_participants p
+        JOIN users u ON (p.partner_user_id = u.user_id)
+        WHERE p.user_id = ? AND p.match_id = ?
+        """, (user_id, match_id))
+        row = c.fetchone()
+    
+    return match_dict(row) if row else None
+
+# Convert message rows into the dicts used by the chat page
+def message_dicts(rows):
+    messages = []
+    for row in rows:
+        message_id, sender_id, sender_username, text, timestamp = row
+        messages.append({
+            "message_id": message_id,
+            "sender_id": sender_id,
+            "sender_username": sender_username,
+            "text": text,
+            "timestamp": timestamp
+        })
+    return messages
+
+# Get all messages for a match
+@metrics.timed
+def get_messages(match_id):
+    with db.connection() as conn:
+        c = conn.cursor()
         
-        conn.commit()
-        conn.close()
+        c.execute("""
+        SELECT m.message_id, m.sender_user_id, u.username, m.message_text, m.timestamp
+        FROM messages m
+        JOIN users u ON m.sender_user_id = u.user_id
+        WHERE m.match_id = ?
+        ORDER BY m.timestamp ASC
+        """, (match_id,))
+        rows = c.fetchall()
         
-        return True, match_id
+        # Older messages of inactive chats live in compressed segment files
+        rows[:0] = archive.read_messages(conn, match_id, before_id=rows[0][0] if rows else None)
     
-    conn.close()
-    return True, None  # Request created but no match yet
+    return message_dicts(rows)
 
-# Get user's active matches
-def get_user_matches(user_id):
-    conn = sqlite3.connect('meetup_app.db')
-    c = conn.cursor()
-    
-    c.execute("""
-    SELECT m.match_id, r1.area, r1.time_slot, r1.user_id as match_user_id, u.username, r1.group_size, r2.group_size as my_group_size
-    FROM matches m
-    JOIN requests r1 ON (m.request_id_1 = r1.request_id)
-    JOIN requests r2 ON (m.request_id_2 = r2.request_id)
-    JOIN users u ON (CASE WHEN r1.user_id = ? THEN r2.user_id ELSE r1.user_id END = u.user_id)
-    WHERE r1.user_id = ? OR r2.user_id = ?
-    ORDER BY m.matched_at DESC
-    """, (user_id, user_id, user_id))
+# Get messages newer than after_id, oldest first (keyset pagination)
+@metrics.timed
+def get_messages_after(match_id, after_id=0):
+    with db.connection() as conn:
+        c = conn.cursor()
+        
+        c.execute("""
+        SELECT m.message_id, m.sender_user_id, u.username, m.message_text, m.timestamp
+        FROM messages m
+        JOIN users u ON m.sender_user_id = u.user_id
+        WHERE m.match_id = ? AND m.message_id > ?
+        ORDER BY m.message_id ASC
+        """, (match_id, after_id))
+        rows = c.fetchall()
+        
+        rows[:0] = archive.read_messages(conn, match_id, after_id, rows[0][0] if rows else None)
     
-    matches = []
-    for row in c.fetchall():
-        match_id, area, time_slot, match_user_id, match_username, group_size, my_group_size = row
+    return message_dicts(rows)
+
+# Get up to `limit` messages older than before_id (or the latest ones), oldest first
+@metrics.timed
+def get_messages_before(match_id, before_id=None, limit=50):
+    with db.connection() as conn:
+        c = conn.cursor()
         
-        # Determine which group size is the match's and which is the user's
-        if match_user_id == user_id:
-            match_group_size = my_group_size
-            my_group_size = group_size
-        else:
-            match_group_size = group_size
+        c.execute("""
+        SELECT m.message_id, m.sender_user_id, u.username, m.message_text, m.timestamp
+        FROM messages m
+        JOIN users u ON m.sender_user_id = u.user_id
+        WHERE m.match_id = ? AND m.message_id < ?
+        ORDER BY m.message_id DESC
+        LIMIT ?
+        """, (match_id, before_id if before_id is not None else 2**63 - 1, limit))
+        rows = c.fetchall()
+        rows.reverse()
         
-        matches.append({
-            "match_id": match_id,
-            "area": area,
-            "time_slot": time_slot,
-            "match_user_id": match_user_id,
-            "match_username": match_username,
-            "match_group_size": match_group_size,
-            "my_group_size": my_group_size
-        })
+        # Ran out of live rows: continue into the archived part of the chat
+        if len(rows) < limit:
+            rows[:0] = archive.read_messages(conn, match_id, before_id=rows[0][0] if rows else before_id,
+                                             limit=limit - len(rows))
     
-    conn.close()
-    return matches
+    return message_dicts(rows)
 
-# Get all messages for a match
-def get_messages(match_id):
-    conn = sqlite3.connect('meetup_app.db')
-    c = conn.cursor()
+# Search the user's own chats; ranked by relevance when the index can be used
+@metrics.timed
+def search_messages(user_id, query, limit=20):
+    terms = search.terms(query)
+    if not terms:
+        return []
     
-    c.execute("""
-    SELECT m.message_id, m.sender_user_id, u.username, m.message_text, m.timestamp
-    FROM messages m
-    JOIN users u ON m.sender_user_id = u.user_id
-    WHERE m.match_id = ?
-    ORDER BY m.timestamp ASC
-    """, (match_id,))
+    with db.connection() as conn:
+        c = conn.cursor()
+        
+        if search.uses_index(query):
+            c.execute("""
+            SELECT m.message_id, m.match_id, partner.username, m.sender_user_id, u.username, m.message_text, m.timestamp
+            FROM messages_fts f
+            JOIN messages m ON m.message_id = f.rowid
+            JOIN match_participants p ON p.match_id = m.match_id AND p.user_id = ?
+            JOIN users partner ON partner.user_id = p.partner_user_id
+            JOIN users u ON u.user_id = m.sender_user_id
+            WHERE messages_fts MATCH ?
+            ORDER BY f.rank
+            LIMIT ?
+            """, (user_id, search.fts_query(query), limit))
+        else:
+            # Terms shorter than a trigram: substring scan of this user's chats only
+            conditions = " AND ".join("m.message_text LIKE ? ESCAPE '\\'" for _ in terms)
+            c.execute(f"""
+            SELECT m.message_id, m.match_id, partner.username, m.sender_user_id, u.username, m.message_text, m.timestamp
+            FROM match_participants p
+            JOIN users partner ON partner.user_id = p.partner_user_id
+            JOIN messages m ON m.match_id = p.match_id
+            JOIN users u ON u.user_id = m.sender_user_id
+            WHERE p.user_id = ? AND {conditions}
+            ORDER BY m.message_id DESC
+            LIMIT ?
+            """, (user_id, *map(search.like_pattern, terms), limit))
+        rows = c.fetchall()
+        
+        if len(rows) < limit:
+            rows += search.search_archive(conn, user_id, query, limit - len(rows))
     
-    messages = []
-    for row in c.fetchall():
-        message_id, sender_id, sender_username, text, timestamp = row
-        messages.append({
+    results = []
+    for row in rows:
+        message_id, match_id, partner_username, sender_id, sender_username, text, timestamp = row
+        results.append({
             "message_id": message_id,
+            "match_id": match_id,
+            "match_username": partner_username,
             "sender_id": sender_id,
             "sender_username": sender_username,
             "text": text,
             "timestamp": timestamp
         })
+    return results
+
+# Number of messages fetched per page when opening a chat or paging back
+CHAT_PAGE_SIZE = 50
+
+# Load a chat incrementally, keeping already-seen messages in session state.
+# Call after watch_live_updates(match_topic): nothing is read unless the
+# chat's version moved since the last load.
+def load_chat_messages(match_id):
+    cache = st.session_state.setdefault("chat_cache", {})
+    entry = cache.get(match_id)
+    seen = st.session_state.live_watch[1]
     
-    conn.close()
-    return messages
+    if entry is None:
+        # First visit: only the latest page, not the whole history
+        messages = get_messages_before(match_id, None, CHAT_PAGE_SIZE)
+        entry = {"messages": messages, "has_older": len(messages) == CHAT_PAGE_SIZE, "seen": seen}
+        cache[match_id] = entry
+    elif entry["seen"] != seen:
+        newest_id = entry["messages"][-1]["message_id"] if entry["messages"] else 0
+        entry["messages"].extend(get_messages_after(match_id, newest_id))
+        entry["seen"] = seen
+    
+    return entry
+
+# Prepend the next older page to a cached chat
+def load_older_messages(match_id):
+    entry = load_chat_messages(match_id)
+    if not entry["has_older"] or not entry["messages"]:
+        return entry
+    
+    older = get_messages_before(match_id, entry["messages"][0]["message_id"], CHAT_PAGE_SIZE)
+    entry["messages"][:0] = older
+    entry["has_older"] = len(older) == CHAT_PAGE_SIZE
+    return entry
 
 # Send a message
+@metrics.timed
 def send_message(match_id, sender_id, message_text):
-    conn = sqlite3.connect('meetup_app.db')
-    c = conn.cursor()
-    
-    c.execute("INSERT INTO messages (match_id, sender_user_id, message_text) VALUES (?, ?, ?)",
-             (match_id, sender_id, message_text))
-    
-    conn.commit()
-    conn.close()
+    # Group-committed by the message writer; returns once the row is durable
+    message_queue.send(match_id, sender_id, message_text)
     return True
 
 # Get pending request for a user
+@metrics.timed
+@cache.cached(cache.PENDING_REQUEST)
 def get_pending_request(user_id):
-    conn = sqlite3.connect('meetup_app.db')
-    c = conn.cursor()
-    
-    c.execute("SELECT request_id, area, time_slot, group_size, created_at FROM requests WHERE user_id = ? AND status = 'pending'", 
-             (user_id,))
-    request = c.fetchone()
-    
-    conn.close()
+    with db.connection() as conn:
+        c = conn.cursor()
+        
+        c.execute("SELECT request_id, area, time_slot, group_size, created_at FROM requests WHERE user_id = ? AND status = 'pending'", 
+                 (user_id,))
+        request = c.fetchone()
     
     if request:
         return {
@@ -290,15 +436,77 @@ def get_pending_request(user_id):
     return None
 
 # Cancel a pending request
+@metrics.timed
 def cancel_request(request_id):
-    conn = sqlite3.connect('meetup_app.db')
-    c = conn.cursor()
+    with db.transaction(immediate=True) as conn:
+        c = conn.cursor()
+        
+        # Archived like expired requests, so demand analytics can count it
+        c.execute("""
+        INSERT INTO requests_archive (request_id, user_id, area, time_slot, group_size, status, created_at)
+        SELECT request_id, user_id, area, time_slot, group_size, 'cancelled', created_at
+        FROM requests WHERE request_id = ? AND status = 'pending'
+        """, (request_id,))
+        c.execute("DELETE FROM requests WHERE request_id = ? AND status = 'pending' RETURNING user_id", (request_id,))
+        cancelled = c.fetchall()
+        bumped = versions.bump(conn, notify.user_topic(cancelled[0][0])) if cancelled else {}
     
-    c.execute("DELETE FROM requests WHERE request_id = ? AND status = 'pending'", (request_id,))
-    conn.commit()
-    conn.close()
+    matching.get_engine().discard(request_id)
+    if cancelled:
+        cache.invalidate(cache.PENDING_REQUEST, cancelled[0][0])
+        versions.publish(bumped)
     return True
 
+# Pending requests per station, time slot and gender within radius_km of area
+@metrics.timed
+@cache.cached(cache.PENDING_DEMAND)
+def get_pending_demand(area, radius_km):
+    point = geo.locate(area)
+    if point is None:
+        return ()
+    
+    cells = geo.neighbourhood(*point, radius_km)
+    with db.connection() as conn:
+        c = conn.cursor()
+        
+        c.execute(f"""
+        SELECT r.area, r.lat, r.lon, r.time_slot, SUM(u.gender = '男性'), SUM(u.gender != '男性')
+        FROM requests r
+        JOIN users u ON u.user_id = r.user_id
+        WHERE r.status = 'pending' AND r.cell IN ({",".join("?" * len(cells))})
+        GROUP BY r.area, r.time_slot
+        """, cells)
+        rows = c.fetchall()
+    
+    # A tuple of tuples, so the rendered map can be cached by its content
+    return tuple(row for row in rows if geo.distance_km(*point, row[1], row[2]) <= radius_km)
+
+# Live updates: a cheap periodic check that reruns the page only when one of
+# the topics it was rendered from has changed
+LIVE_POLL_INTERVAL = 1.0
+
+@st.fragment(run_every=LIVE_POLL_INTERVAL)
+def poll_live_updates():
+    watched = st.session_state.get("live_watch")
+    if watched and versions.current_many(watched[0]) != watched[1]:
+        st.rerun()
+
+# Call before loading page data so no update between the two is missed
+def watch_live_updates(*topics):
+    st.session_state.live_watch = (topics, versions.current_many(topics))
+    poll_live_updates()
+
+# Reuse what this session loaded under `key` while the versions of the topics
+# the page watches are unchanged; only a change to one of them reloads it
+def session_view(key, load):
+    seen = st.session_state.live_watch[1]
+    views = st.session_state.setdefault("views", {})
+    view = views.get(key)
+    if view is None or view[0] != seen:
+        view = (seen, load())
+        views[key] = view
+    return view[1]
+
 # UI Components
 def show_login_page():
     st.markdown("<h1 style='text-align: center; color: #ff5a5f;'>学生合コンマッチング</h1>", unsafe_allow_html=True)
@@ -312,13 +520,15 @@ def show_login_page():
             password = st.text_input("パスワード", type="password")
             
             if st.button("ログイン", key="login_button", use_container_width=True):
-                user_id, username, gender = login_user(username, password)
+                user_id, name, gender = login_user(username, password)
                 if user_id:
                     st.session_state.user_id = user_id
-                    st.session_state.username = username
+                    st.session_state.username = name
                     st.session_state.gender = gender
                     st.session_state.page = "dashboard"
                     st.rerun()
+                elif passwords.limiter.blocked(username):
+                    st.error("ログインの失敗が続いたため、しばらくしてから再度お試しください")
                 else:
                     st.error("ユーザー名またはパスワードが間違っています")
             
@@ -361,25 +571,24 @@ def show_register_page():
                 st.rerun()
 
 def show_dashboard():
-    st.markdown(f"<h1 style='text-align: center; color: #ff5a5f;'>こんにちは {st.session_state.username} さん！</h1>", unsafe_allow_html=True)
-    
-    # Create tabs
-    tab1, tab2, tab3 = st.tabs(["マッチング", "メッセージ", "プロフィール"])
-    
-    with tab1:
-        show_matching_tab()
+    # Rerun when the user's pending request gets matched
+    watch_live_updates(notify.user_topic(st.session_state.user_id))
     
-    with tab2:
-        show_messages_tab()
+    st.markdown(f"<h1 style='text-align: center; color: #ff5a5f;'>こんにちは {st.session_state.username} さん！</h1>", unsafe_allow_html=True)
     
-    with tab3:
-        show_profile_tab()
+    # Only the selected tab is rendered, so only its data is loaded. The
+    # choice is kept outside the widget so it survives a visit to the chat page.
+    names = list(DASHBOARD_TABS)
+    tab = st.radio("表示", names, index=names.index(st.session_state.get("dashboard_tab", names[0])),
+                   key="dashboard_tab_select", horizontal=True, label_visibility="collapsed")
+    st.session_state.dashboard_tab = tab
+    DASHBOARD_TABS[tab]()
 
 def show_matching_tab():
     st.header("マッチング")
     
-    # Check if user has pending request
-    pending_request = get_pending_request(st.session_state.user_id)
+    # Check if user has pending request (reloaded only when the user's version moves)
+    pending_request = session_view("pending_request", lambda: get_pending_request(st.session_state.user_id))
     
     if pending_request:
         with st.container(border=True):
@@ -393,7 +602,9 @@ def show_matching_tab():
         with st.container(border=True):
             st.subheader("新しいマッチングリクエスト")
             
-            area = st.selectbox("エリア選択", ["池袋", "新宿", "渋谷"])
+            area = st.selectbox("エリア選択", list(geo.STATIONS))
+            nearby = "・".join(name for name, _ in geo.nearby_stations(area)[1:])
+            st.caption(f"{area}駅から半径 {geo.RADIUS_KM:g}km 以内の相手とマッチングします" + (f"（{nearby} など）" if nearby else ""))
             time_slot = st.selectbox("時間帯", ["18:00-20:00", "20:00-22:00", "22:00-24:00", "24:00-26:00"])
             group_size = st.number_input("募集人数", min_value=1, max_value=10, value=3)
             
@@ -410,11 +621,30 @@ def show_matching_tab():
                 else:  # No match yet
                     st.success("リクエストを送信しました。マッチングを待っています...")
                     st.rerun()
+    
+    # folium is only imported once someone opens the map
+    center = pending_request["area"] if pending_request else area
+    if geo.locate(center) and st.toggle("周辺の待機状況を地図で表示", key="demand_map"):
+        show_demand_map(center)
+
+def show_demand_map(area):
+    demand = get_pending_demand(area, venue_map.RADIUS_KM)
+    waiting = sum(men + women for *_, men, women in demand)
+    st.caption(f"{area}駅の周辺 {venue_map.RADIUS_KM:g}km で {waiting} 件のリクエストが待機中です（約 {cache.TTL:g} 秒ごとに更新）")
+    
+    # A data: URL, not an HTML string: the frame must not share the app's origin
+    url = venue_map.render(area, demand)
+    st.iframe(url, height=venue_map.HEIGHT)
 
 def show_messages_tab():
     st.header("メッセージ")
     
-    matches = get_user_matches(st.session_state.user_id)
+    query = st.text_input("メッセージを検索", key="message_search", placeholder="キーワードを入力")
+    if query.strip():
+        show_search_results(query)
+        return
+    
+    matches = session_view("matches", lambda: get_user_matches(st.session_state.user_id))
     
     if not matches:
         st.info("まだマッチングがありません。")
@@ -425,9 +655,17 @@ def show_messages_tab():
             col1, col2 = st.columns([3, 1])
             
             with col1:
-                st.write(f"**{match['match_username']}** さん")
+                unread = match["unread_count"]
+                badge = f" :red-background[未読 {unread if unread <= UNREAD_CAP else f'{UNREAD_CAP}+'}]" if unread else ""
+                avatar = avatars.img_tag(match["match_avatar"], avatars.SMALL)
+                st.markdown(f"{avatar}**{html.escape(match['match_username'])}** さん{badge}", unsafe_allow_html=True)
                 st.write(f"エリア: {match['area']} / 時間帯: {match['time_slot']}")
                 st.write(f"人数: あなた {match['my_group_size']}人 / 相手 {match['match_group_size']}人")
+                last = match["last_message"]
+                if last:
+                    who = "あなた" if last["sender_id"] == st.session_state.user_id else match["match_username"]
+                    preview = last["text"] if len(last["text"]) <= 40 else last["text"][:40] + "…"
+                    st.caption(f"{who}: {preview} ・ {last['timestamp']}")
             
             with col2:
                 if st.button("チャットを開く", key=f"chat_{match['match_id']}", use_container_width=True):
@@ -435,6 +673,29 @@ def show_messages_tab():
                     st.session_state.page = "chat"
                     st.rerun()
 
+def show_search_results(query):
+    results = search_messages(st.session_state.user_id, query)
+    
+    if not results:
+        st.info("一致するメッセージはありません。")
+        return
+    
+    terms = search.terms(query)
+    for result in results:
+        with st.container(border=True):
+            col1, col2 = st.columns([3, 1])
+            
+            with col1:
+                st.write(f"**{result['match_username']}** さんとのチャット ・ {result['timestamp']}")
+                st.markdown(f"{chat_render.highlight(result['sender_username'], [])}: "
+                            f"{chat_render.highlight(result['text'], terms)}", unsafe_allow_html=True)
+            
+            with col2:
+                if st.button("チャットを開く", key=f"search_{result['message_id']}", use_container_width=True):
+                    st.session_state.active_match = result['match_id']
+                    st.session_state.page = "chat"
+                    st.rerun()
+
 def show_profile_tab():
     st.header("プロフィール")
     
@@ -442,15 +703,43 @@ def show_profile_tab():
     
     if user:
         with st.container(border=True):
+            avatar = avatars.img_tag(user["avatar_hash"], avatars.LARGE)
+            if avatar:
+                st.markdown(avatar, unsafe_allow_html=True)
             st.write(f"**ユーザー名**: {user['username']}")
             st.write(f"**性別**: {user['gender']}")
             st.write(f"**年齢**: {user['age']}")
         
+        # The image is decoded and thumbnailed once here, never when pages render it
+        upload = st.file_uploader("プロフィール画像", type=["png", "jpg", "jpeg", "webp", "gif"], key="avatar_upload")
+        if upload is not None and st.button("画像を保存", key="save_avatar", use_container_width=True):
+            success, result = set_avatar(st.session_state.user_id, upload.getvalue())
+            if success:
+                st.success("プロフィール画像を更新しました。")
+                st.rerun()
+            else:
+                st.error(result)
+        
+        if is_admin() and st.button("パフォーマンス", key="open_admin", use_container_width=True):
+            st.session_state.page = "admin"
+            st.rerun()
+        
+        if is_admin() and st.button("需要分析", key="open_analytics", use_container_width=True):
+            st.session_state.page = "analytics"
+            st.rerun()
+        
         if st.button("ログアウト", key="logout", use_container_width=True):
             for key in list(st.session_state.keys()):
                 del st.session_state[key]
             st.rerun()
 
+# Dashboard tabs in display order
+DASHBOARD_TABS = {
+    "マッチング": show_matching_tab,
+    "メッセージ": show_messages_tab,
+    "プロフィール": show_profile_tab,
+}
+
 def show_chat_page():
     if "active_match" not in st.session_state:
         st.error("マッチングが選択されていません")
@@ -460,11 +749,12 @@ def show_chat_page():
         return
     
     match_id = st.session_state.active_match
-    messages = get_messages(match_id)
+    
+    # Rerun as soon as someone posts to this chat
+    watch_live_updates(notify.match_topic(match_id))
     
     # Get match details
-    matches = get_user_matches(st.session_state.user_id)
-    current_match = next((m for m in matches if m["match_id"] == match_id), None)
+    current_match = session_view(("match", match_id), lambda: get_match(match_id, st.session_state.user_id))
     
     if not current_match:
         st.error("マッチングが見つかりません")
@@ -473,42 +763,36 @@ def show_chat_page():
             st.rerun()
         return
     
-    st.header(f"{current_match['match_username']} さんとのチャット")
+    avatar = avatars.img_tag(current_match["match_avatar"], avatars.SMALL)
+    st.markdown(f"<h2>{avatar}{html.escape(current_match['match_username'])} さんとのチャット</h2>", unsafe_allow_html=True)
     st.subheader(f"{current_match['area']} / {current_match['time_slot']}")
     st.write(f"人数: あなた {current_match['my_group_size']}人 / 相手 {current_match['match_group_size']}人")
     
-    # Display messages
+    # Only messages newer than the ones already in session state are read
+    chat = load_chat_messages(match_id)
+    
+    # Only the most recent window is rendered; "load older" widens it
+    windows = st.session_state.setdefault("chat_window", {})
+    window = windows.get(match_id, chat_render.WINDOW)
+    if chat["has_older"] or len(chat["messages"]) > window:
+        if st.button("以前のメッセージを読み込む", key="load_older", use_container_width=True):
+            window += chat_render.WINDOW
+            windows[match_id] = window
+            if window > len(chat["messages"]) and chat["has_older"]:
+                chat = load_older_messages(match_id)
+    
+    # Advance the read cursor only when something new was shown
+    if chat["messages"]:
+        newest_id = chat["messages"][-1]["message_id"]
+        read_marks = st.session_state.setdefault("read_marks", {})
+        if read_marks.get(match_id, 0) < newest_id:
+            mark_read(st.session_state.user_id, match_id, newest_id)
+            read_marks[match_id] = newest_id
+    
+    # Display messages as a single pre-escaped HTML fragment
     with st.container(border=True):
-        for msg in messages:
-            is_me = msg["sender_id"] == st.session_state.user_id
-            
-            if is_me:
-                message_container = st.container()
-                with message_container:
-                    st.markdown(f"""
-                    <div style="display: flex; justify-content: flex-end;">
-                        <div style="background-color: #dcf8c6; padding: 10px; border-radius: 10px; max-width: 70%;">
-                            {msg["text"]}
-                            <div style="font-size: 0.8em; color: #888; text-align: right;">
-                                {msg["timestamp"]}
-                            </div>
-                        </div>
-                    </div>
-                    """, unsafe_allow_html=True)
-            else:
-                message_container = st.container()
-                with message_container:
-                    st.markdown(f"""
-                    <div style="display: flex; justify-content: flex-start;">
-                        <div style="background-color: #f1f0f0; padding: 10px; border-radius: 10px; max-width: 70%;">
-                            <strong>{msg["sender_username"]}</strong><br>
-                            {msg["text"]}
-                            <div style="font-size: 0.8em; color: #888;">
-                                {msg["timestamp"]}
-                            </div>
-                        </div>
-                    </div>
-                    """, unsafe_allow_html=True)
+        st.markdown(chat_render.render_window(chat["messages"], st.session_state.user_id, window),
+                    unsafe_allow_html=True)
     
     # Send new message
     with st.form(key="message_form"):
@@ -526,8 +810,119 @@ def show_chat_page():
         st.session_state.page = "dashboard"
         st.rerun()
 
+def is_admin():
+    return st.session_state.get("username") in ADMIN_USERS
+
+# Admin-only view of the rolling hot-path metrics
+def show_admin_page():
+    import pandas as pd  # only admins pay for the import
+    
+    st.markdown("<h1 style='text-align: center; color: #ff5a5f;'>パフォーマンス</h1>", unsafe_allow_html=True)
+    st.caption(f"直近 {metrics.WINDOW_SECONDS * metrics.WINDOWS // 60} 分間・このサーバープロセスのみ")
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("ダッシュボードに戻る", key="admin_back", use_container_width=True):
+            st.session_state.page = "dashboard"
+            st.rerun()
+    with col2:
+        if st.button("リセット", key="admin_reset", use_container_width=True):
+            metrics.registry.reset()
+            st.rerun()
+    
+    rows = pd.DataFrame(metrics.snapshot(), columns=metrics.FIELDS)
+    for kind, title in (("rerun", "ページ再実行"), ("function", "データアクセス関数"), ("sql", "SQL")):
+        st.subheader(title)
+        table = rows[rows["kind"] == kind].drop(columns="kind")
+        if table.empty:
+            st.info("まだ計測データがありません")
+        else:
+            st.dataframe(table, hide_index=True, use_container_width=True)
+    
+    st.subheader("キャッシュ")
+    st.json(cache.stats())
+    
+    st.subheader("アバター画像キャッシュ")
+    st.json(avatars.cache.stats())
+    
+    st.subheader("パスワードハッシュ")
+    st.json(passwords.stats())
+    
+    st.subheader("書き込みロック待ち")
+    st.json(db.lock_wait_stats())
+    
+    st.subheader("期限切れリクエストの回収")
+    sweeps = sweeper.start()
+    st.write(f"回収済み: {sweeps.total_expired} 件")
+    if sweeps.reports:
+        st.dataframe(pd.DataFrame([r._asdict() for r in sweeps.reports]), hide_index=True, use_container_width=True)
+    
+    st.subheader("チャットのアーカイブ")
+    archives = list(archive.start().reports)
+    if archives:
+        st.dataframe(pd.DataFrame([r._asdict() for r in archives]), hide_index=True, use_container_width=True)
+    else:
+        st.info("まだアーカイブは実行されていません")
+    
+    if matching.MODE == "batch":
+        from meetup import scheduler
+        st.subheader("バッチマッチング")
+        reports = list(scheduler.start().reports)
+        if reports:
+            st.dataframe(pd.DataFrame([r._asdict() for r in reports]), hide_index=True, use_container_width=True)
+
+# Metrics the analytics heatmap can show: column, label, vega-lite format
+ANALYTICS_METRICS = {
+    "pending": ("待機中のリクエスト", "d"),
+    "matched": ("マッチ数", "d"),
+    "match_rate": ("マッチ率", ".0%"),
+    "median_wait_min": ("待ち時間の中央値 (分)", ".1f"),
+    "mean_wait_min": ("平均待ち時間 (分)", ".1f"),
+    "cancelled": ("キャンセル数", "d"),
+    "expired": ("期限切れ数", "d"),
+}
+
+# Admin-only demand heatmaps, read from the trigger-maintained aggregate tables
+def show_analytics_page():
+    st.markdown("<h1 style='text-align: center; color: #ff5a5f;'>需要分析</h1>", unsafe_allow_html=True)
+    st.caption("エリア × 時間帯の集計 (リクエストとマッチの書き込み時に更新)")
+    
+    if st.button("ダッシュボードに戻る", key="analytics_back", use_container_width=True):
+        st.session_state.page = "dashboard"
+        st.rerun()
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        gender = st.selectbox("性別", ["全体", "男性", "女性"], key="analytics_gender")
+    with col2:
+        metric = st.selectbox("指標", list(ANALYTICS_METRICS), format_func=lambda m: ANALYTICS_METRICS[m][0],
+                              key="analytics_metric")
+    
+    frame = analytics.frames(by_gender=gender != "全体")
+    if gender != "全体":
+        frame = frame[frame["gender"] == gender].drop(columns="gender")
+    if frame.empty:
+        st.info("まだリクエストがありません")
+        return
+    
+    # Busiest stations first, as in the request form; unknown areas last
+    areas = [area for area in geo.STATIONS if area in set(frame["area"])]
+    areas += sorted(set(frame["area"]) - set(areas))
+    label, number_format = ANALYTICS_METRICS[metric]
+    st.vega_lite_chart(frame, {
+        "mark": {"type": "rect", "tooltip": True},
+        "encoding": {
+            "x": {"field": "time_slot", "type": "ordinal", "title": "時間帯"},
+            "y": {"field": "area", "type": "ordinal", "title": "エリア", "sort": areas},
+            "color": {"field": metric, "type": "quantitative", "title": label,
+                      "scale": {"scheme": "reds"}, "legend": {"format": number_format}},
+        },
+    }, use_container_width=True)
+    
+    st.dataframe(frame, hide_index=True, use_container_width=True)
+
 def main():
-    # Initialize the database
+    # Initialize the database (no-op after the first run in this process)
     init_db()
     
     # Initialize session state
@@ -570,17 +965,16 @@ def main():
         font-weight: 600;
         color: #484848;
     }
-    .stTabs [data-baseweb="tab-list"] {
+    .stRadio [role="radiogroup"] {
         gap: 1px;
     }
-    .stTabs [data-baseweb="tab"] {
-        height: 50px;
-        border-radius: 15px 15px 0 0;
+    .stRadio [role="radiogroup"] > label {
         background-color: #f8f8f8;
+        border-radius: 15px 15px 0 0;
         padding: 10px 20px;
         color: #484848;
     }
-    .stTabs [aria-selected="true"] {
+    .stRadio [role="radiogroup"] > label:has(input:checked) {
         background-color: #ff5a5f;
         color: white;
     }
@@ -597,25 +991,41 @@ def main():
     </style>
     """, unsafe_allow_html=True)
     
-    # Show the appropriate page based on session state
-    if st.session_state.page == "login":
+    # Show the appropriate page based on session state, timing the render
+    with metrics.rerun(st.session_state.page):
+        show_page(st.session_state.page)
+
+def show_page(page):
+    if page == "login":
         show_login_page()
-    elif st.session_state.page == "register":
+    elif page == "register":
         show_register_page()
-    elif st.session_state.page == "dashboard":
+    elif page == "dashboard":
         if "user_id" not in st.session_state:
             st.warning("ログインが必要です")
             st.session_state.page = "login"
             st.rerun()
         else:
             show_dashboard()
-    elif st.session_state.page == "chat":
+    elif page == "chat":
         if "user_id" not in st.session_state:
             st.warning("ログインが必要です")
             st.session_state.page = "login"
             st.rerun()
         else:
             show_chat_page()
+    elif page == "admin":
+        if not is_admin():
+            st.session_state.page = "dashboard" if "user_id" in st.session_state else "login"
+            st.rerun()
+        else:
+            show_admin_page()
+    elif page == "analytics":
+        if not is_admin():
+            st.session_state.page = "dashboard" if "user_id" in st.session_state else "login"
+            st.rerun()
+        else:
+            show_analytics_page()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,6 @@
+"""Benchmarks for the data-access layer.
+
+    python -m benchmarks.datagen bench.db --users 10000 --requests 100000 --messages 1000000
+    python -m benchmarks.run bench.db --out results.json
+    python -m benchmarks.compare baseline.json results.json
+"""
@@ -0,0 +1,41 @@
+"""Compare two benchmark result files.
+
+    python -m benchmarks.compare baseline.json results.json
+"""
+import argparse
+import json
+
+METRICS = ("p50_ms", "p95_ms", "p99_ms", "vm_steps_per_call")
+
+
+def compare(baseline, current):
+    """``[(function, metric, before, after, ratio)]`` for functions in both runs."""
+    rows = []
+    for name, after in current["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        for metric in METRICS:
+            old, new = before.get(metric, 0), after.get(metric, 0)
+            rows.append((name, metric, old, new, new / old if old else float("inf")))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    args = parser.parse_args(argv)
+
+    with open(args.baseline, encoding="utf-8") as fh:
+        baseline = json.load(fh)
+    with open(args.current, encoding="utf-8") as fh:
+        current = json.load(fh)
+
+    print(f"{'function':<22}{'metric':<20}{'before':>12}{'after':>12}{'ratio':>8}")
+    for name, metric, old, new, ratio in compare(baseline, current):
+        print(f"{name:<22}{metric:<20}{old:>12.3f}{new:>12.3f}{ratio:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
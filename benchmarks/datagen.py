@@ -0,0 +1,169 @@
+"""Synthetic data generator for meetup_app.db-shaped databases.
+
+Fills a fresh database through the app's own migrations, so indexes,
+triggers and derived tables match production. Scale and skew are
+configurable. Areas and time slots follow a Zipf distribution, so a few are
+much more popular. Messages follow another one over matches, so a handful
+of chats are very long while most are short.
+
+    python -m benchmarks.datagen bench.db --users 10000 --requests 100000 --messages 1000000
+"""
+import argparse
+import datetime
+import os
+import random
+import time
+
+from meetup import db, geo, schema
+
+AREAS = ["新宿", "渋谷", "池袋", "上野", "秋葉原", "吉祥寺", "下北沢", "高田馬場", "中野", "品川"]
+TIME_SLOTS = ["20:00-22:00", "18:00-20:00", "22:00-24:00", "24:00-26:00"]
+
+# Every synthetic user logs in with this password.
+PASSWORD = "password"
+
+BATCH = 50000
+
+
+def zipf_weights(n, skew):
+    return [1.0 / (rank ** skew) for rank in range(1, n + 1)]
+
+
+def _timestamp(moment):
+    return moment.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _remove(path):
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def _insert(conn, sql, rows):
+    for start in range(0, len(rows), BATCH):
+        conn.executemany(sql, rows[start:start + BATCH])
+
+
+def generate(path, users=10000, requests=100000, messages=1000000, pending_ratio=0.05,
+             area_skew=1.1, slot_skew=0.6, chat_skew=1.2, days=30, seed=0):
+    """Create ``path`` from scratch and return a summary of what was written."""
+    rng = random.Random(seed)
+    started = time.perf_counter()
+    _remove(path)
+    db.configure(path)
+    schema.ensure_schema()
+
+    # Hash once; the KDF cost per user is irrelevant to what we measure.
+    import app
+    password_hash = app.hash_password(PASSWORD)
+
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    origin = now - datetime.timedelta(days=days)
+    span = days * 86400
+
+    area_weights = zipf_weights(len(AREAS), area_skew)
+    slot_weights = zipf_weights(len(TIME_SLOTS), slot_skew)
+
+    with db.connection() as conn:
+        conn.execute("PRAGMA synchronous=OFF")
+
+        genders = ["男性" if rng.random() < 0.5 else "女性" for _ in range(users)]
+        user_rows = [
+            (user_id, f"user{user_id}", password_hash, genders[user_id - 1], rng.randint(18, 30),
+             _timestamp(origin + datetime.timedelta(seconds=rng.randrange(span))))
+            for user_id in range(1, users + 1)
+        ]
+        _insert(conn, "INSERT INTO users (user_id, username, password, gender, age, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                user_rows)
+        men = [u for u in range(1, users + 1) if genders[u - 1] == "男性"]
+        women = [u for u in range(1, users + 1) if genders[u - 1] == "女性"]
+
+        # At most one pending request per user, the rest matched in pairs.
+        pending_count = min(int(requests * pending_ratio), users)
+        pair_count = (requests - pending_count) // 2
+
+        request_rows, match_rows, participants = [], [], []
+        request_id = 0
+        buckets = rng.choices(range(len(AREAS)), area_weights, k=pair_count)
+        slots = rng.choices(range(len(TIME_SLOTS)), slot_weights, k=pair_count)
+        for match_id in range(1, pair_count + 1):
+            area, slot = AREAS[buckets[match_id - 1]], TIME_SLOTS[slots[match_id - 1]]
+            waited = origin + datetime.timedelta(seconds=rng.randrange(span))
+            matched = waited + datetime.timedelta(seconds=rng.randrange(1, 3600))
+            man, woman = rng.choice(men), rng.choice(women)
+            first, second = (man, woman) if rng.random() < 0.5 else (woman, man)
+            request_rows.append((request_id + 1, first, area, slot, rng.randint(1, 10), "matched", _timestamp(waited)))
+            request_rows.append((request_id + 2, second, area, slot, rng.randint(1, 10), "matched", _timestamp(matched)))
+            match_rows.append((match_id, request_id + 1, request_id + 2, _timestamp(matched)))
+            participants.append((first, second, matched))
+            request_id += 2
+
+        for user_id in rng.sample(range(1, users + 1), pending_count):
+            request_id += 1
+            area = AREAS[rng.choices(range(len(AREAS)), area_weights)[0]]
+            slot = TIME_SLOTS[rng.choices(range(len(TIME_SLOTS)), slot_weights)[0]]
+            created = now - datetime.timedelta(seconds=rng.randrange(6 * 3600))
+            request_rows.append((request_id, user_id, area, slot, rng.randint(1, 10), "pending", _timestamp(created)))
+
+        # Coordinates and grid cell from the station table, as the engine stores them.
+        points = {area: (*geo.locate(area), geo.cell_of(*geo.locate(area))) for area in AREAS}
+        _insert(conn, "INSERT INTO requests (request_id, user_id, area, time_slot, group_size, status, created_at, lat, lon, cell) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [row + points[row[2]] for row in request_rows])
+        _insert(conn, "INSERT INTO matches (match_id, request_id_1, request_id_2, matched_at) VALUES (?, ?, ?, ?)",
+                match_rows)
+
+        # A few very long chats, many short ones.
+        message_rows = []
+        if pair_count and messages:
+            ranked = list(range(1, pair_count + 1))
+            rng.shuffle(ranked)
+            targets = rng.choices(ranked, zipf_weights(pair_count, chat_skew), k=messages)
+            step = span / messages
+            for message_id, match_id in enumerate(targets, start=1):
+                first, second, matched = participants[match_id - 1]
+                # Monotonic clock, never before the match itself.
+                sent = max(matched, origin + datetime.timedelta(seconds=message_id * step))
+                message_rows.append((message_id, match_id, first if rng.random() < 0.5 else second,
+                                     f"メッセージ {message_id} です。よろしくお願いします！", _timestamp(sent)))
+        _insert(conn, "INSERT INTO messages (message_id, match_id, sender_user_id, message_text, timestamp) VALUES (?, ?, ?, ?, ?)",
+                message_rows)
+
+        conn.commit()
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("ANALYZE")
+
+    return {
+        "path": path,
+        "users": users,
+        "requests": len(request_rows),
+        "pending": pending_count,
+        "matches": pair_count,
+        "messages": len(message_rows),
+        "seconds": round(time.perf_counter() - started, 2),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--requests", type=int, default=100000)
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--pending-ratio", type=float, default=0.05)
+    parser.add_argument("--area-skew", type=float, default=1.1)
+    parser.add_argument("--slot-skew", type=float, default=0.6)
+    parser.add_argument("--chat-skew", type=float, default=1.2)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    summary = generate(
+        args.path, users=args.users, requests=args.requests, messages=args.messages,
+        pending_ratio=args.pending_ratio, area_skew=args.area_skew, slot_skew=args.slot_skew,
+        chat_skew=args.chat_skew, seed=args.seed,
+    )
+    print(summary)
+
+
+if __name__ == "__main__":
+    main()
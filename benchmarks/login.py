@@ -0,0 +1,169 @@
+"""Login throughput and latency under concurrent bursts.
+
+Creates --users accounts in a scratch database. A --legacy share of them
+keep the old unsalted SHA-256 hash, which their first login upgrades to
+scrypt. The runner then fires --bursts bursts: --threads threads start
+together, and each calls app.login_user --attempts times. A --wrong share
+of those attempts use a bad password. --attackers more threads per burst
+guess at a single account in parallel. The failure limiter should let only
+MAX_FAILURES of their guesses reach scrypt per lockout window, and turn the
+rest away without any hashing.
+
+Reported per outcome (ok, wrong, rejected): calls, throughput and
+p50/p95/p99 latency. The run also reports how many guesses were hashed,
+how many legacy hashes were upgraded, and the pool's own counters,
+including how long hashes queued.
+Compare --workers and --cost settings to size the pool:
+
+    python -m benchmarks.login login.db --threads 32 --workers 2 --cost 14
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+
+from benchmarks.run import percentile
+from meetup import db, passwords, schema
+
+PASSWORD = "password"
+
+
+def create_users(path, users, legacy, seed):
+    """Insert ``users`` accounts; one scrypt hash is shared, as in datagen."""
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    db.configure(path)
+    schema.ensure_schema()
+
+    rng = random.Random(seed)
+    current, old = passwords.hash_password(PASSWORD), passwords.legacy_hash(PASSWORD)
+    rows = [
+        (f"login_{i}", old if rng.random() < legacy else current, rng.choice(["男性", "女性"]), 20)
+        for i in range(users)
+    ]
+    with db.transaction() as conn:
+        conn.executemany("INSERT INTO users (username, password, gender, age) VALUES (?, ?, ?, ?)", rows)
+    return [name for name, _, _, _ in rows]
+
+
+def _legacy_count():
+    with db.connection() as conn:
+        return conn.execute("SELECT COUNT(*) FROM users WHERE password NOT LIKE 'scrypt$%'").fetchone()[0]
+
+
+def run(path, users=200, threads=16, attackers=4, bursts=5, attempts=4, wrong=0.2, legacy=0.5, cost=None, workers=None,
+        seed=0):
+    passwords.configure(cost=cost, workers=workers)
+    usernames = create_users(path, users, legacy, seed)
+    import app
+
+    target, accounts = usernames[0], usernames[1:]
+    legacy_before = _legacy_count()
+    latencies = defaultdict(list)
+    guesses_hashed = 0
+    lock = threading.Lock()
+
+    # Record per thread whether the limiter let the attempt through.
+    admitted = threading.local()
+    acquire = passwords.limiter.acquire
+
+    def recording_acquire(username):
+        admitted.value = acquire(username)
+        return admitted.value
+
+    def attempt(username, password):
+        nonlocal guesses_hashed
+        started = time.perf_counter()
+        user_id, _, _ = app.login_user(username, password)
+        elapsed = time.perf_counter() - started
+        outcome = "ok" if user_id else "wrong" if admitted.value else "rejected"
+        with lock:
+            latencies[outcome].append(elapsed)
+            guesses_hashed += username == target and admitted.value
+
+    def worker(barrier, seed):
+        rng = random.Random(seed)
+        barrier.wait()
+        for _ in range(attempts):
+            password = PASSWORD if rng.random() >= wrong else "wrong-" + PASSWORD
+            attempt(rng.choice(accounts), password)
+
+    def attacker(barrier, seed):
+        barrier.wait()
+        for guess in range(attempts):
+            attempt(target, f"guess-{seed}-{guess}")
+
+    passwords.limiter.acquire = recording_acquire
+    started = time.perf_counter()
+    try:
+        for burst in range(bursts):
+            base = seed * 1_000_000 + burst * 1000
+            barrier = threading.Barrier(threads + attackers)
+            pool = [threading.Thread(target=worker, args=(barrier, base + i)) for i in range(threads)]
+            pool += [threading.Thread(target=attacker, args=(barrier, base + threads + i)) for i in range(attackers)]
+            for thread in pool:
+                thread.start()
+            for thread in pool:
+                thread.join()
+    finally:
+        elapsed = time.perf_counter() - started
+        passwords.limiter.acquire = acquire
+
+    outcomes = {}
+    for outcome, values in sorted(latencies.items()):
+        ordered = sorted(values)
+        outcomes[outcome] = {
+            "calls": len(ordered),
+            "per_second": round(len(ordered) / elapsed, 1),
+            "p50_ms": round(percentile(ordered, 0.50) * 1000, 3),
+            "p95_ms": round(percentile(ordered, 0.95) * 1000, 3),
+            "p99_ms": round(percentile(ordered, 0.99) * 1000, 3),
+            "max_ms": round(ordered[-1] * 1000, 3),
+        }
+    calls = sum(len(values) for values in latencies.values())
+    legacy_after = _legacy_count()
+    return {
+        "elapsed_seconds": round(elapsed, 2),
+        "calls": calls,
+        "calls_per_second": round(calls / elapsed, 1),
+        "outcomes": outcomes,
+        "guesses": attackers * attempts * bursts,
+        "guesses_hashed": guesses_hashed,
+        "legacy_upgraded": legacy_before - legacy_after,
+        "legacy_remaining": legacy_after,
+        "pool": passwords.stats(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path", help="scratch database, recreated on every run")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--attackers", type=int, default=4, help="threads guessing at one account")
+    parser.add_argument("--bursts", type=int, default=5)
+    parser.add_argument("--attempts", type=int, default=4, help="logins per thread and burst")
+    parser.add_argument("--wrong", type=float, default=0.2, help="share of attempts with a bad password")
+    parser.add_argument("--legacy", type=float, default=0.5, help="share of accounts with a SHA-256 hash")
+    parser.add_argument("--cost", type=int, help="scrypt cost (log2 n); default MEETUP_SCRYPT_COST")
+    parser.add_argument("--workers", type=int, help="hashing threads; default MEETUP_PASSWORD_WORKERS")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="write the JSON summary here")
+    args = parser.parse_args(argv)
+
+    summary = run(
+        args.path, users=args.users, threads=args.threads, attackers=args.attackers, bursts=args.bursts, attempts=args.attempts,
+        wrong=args.wrong, legacy=args.legacy, cost=args.cost, workers=args.workers, seed=args.seed,
+    )
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as fh:
+            json.dump(summary, fh, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""Query-plan regression check for the data-access layer.
+
+Runs every data-access function in app.py against a scratch database,
+captures the SQL each one actually executes, and asks SQLite for its query
+plan. Any statement that falls back to a full table or index scan is
+reported, and the process exits non-zero so CI can gate on it:
+
+    python -m benchmarks.query_plans
+
+tests/test_query_plans.py runs the same check under pytest.
+"""
+import os
+import re
+import sys
+import tempfile
+
+from meetup import db, message_queue, schema
+
+# Plan rows that mean "read the whole table/index". "SCAN CONSTANT ROW" is
+# SQLite's name for a VALUES clause and costs nothing; "SCAN (subquery-N)"
+# walks the rows of a subquery whose own plan rows are checked separately.
+FULL_SCAN = re.compile(r"^SCAN (?!CONSTANT ROW|\(subquery-)")
+# A virtual table (the FTS index) queried through a constraint such as
+# MATCH or LIKE reports "INDEX <n>:<constraints>"; no constraints means a scan.
+VIRTUAL_LOOKUP = re.compile(r"VIRTUAL TABLE INDEX \d+:\S")
+SCAN_INDEX = re.compile(r"USING (?:COVERING )?INDEX (\w+)")
+# Aggregate tables bounded by areas x time slots x genders, which pages are
+# meant to read whole (see meetup.analytics).
+SMALL_TABLES = {"demand_stats", "demand_wait_histogram"}
+
+# Statements that are not data-access queries, and the "-- TRIGGER name"
+# lines SQLite traces when a trigger body runs.
+IGNORED = re.compile(r"^\s*(--|(BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE|PRAGMA|CREATE|DROP|ANALYZE)\b)", re.I)
+# FTS5's own reads of its shadow tables ('main'.'messages_fts_config' ...),
+# traced whenever a connection first opens the index.
+FTS_INTERNAL = re.compile(r"'\w+'\.'\w+_(config|data|idx|docsize|content)'")
+
+
+def exercise(app):
+    """Call each data-access function at least once, covering its branches."""
+    from meetup import analytics, archive, notify, search, sweeper, versions
+    app.register_user("plan_m", "pw", "男性", 20)
+    app.register_user("plan_f", "pw", "女性", 21)
+    app.register_user("plan_m", "pw", "男性", 20)  # duplicate username
+    user_m, _, _ = app.login_user("plan_m", "pw")
+    user_f, _, _ = app.login_user("plan_f", "pw")
+    app.get_user_details(user_m)
+
+    app.create_request(user_m, "新宿", "18:00-20:00", 3)
+    app.create_request(user_m, "新宿", "18:00-20:00", 3)  # already pending
+    app.get_pending_request(user_m)
+    _, match_id = app.create_request(user_f, "新宿", "18:00-20:00", 2)
+    app.get_user_matches(user_m)
+    app.get_match(match_id, user_m)
+    app.set_avatar(user_m, _sample_image())
+    app.set_avatar(user_f, b"not an image")
+
+    app.send_message(match_id, user_m, "こんにちは")
+    app.get_user_matches(user_f)
+    app.mark_read(user_f, match_id, app.get_messages(match_id)[-1]["message_id"])
+    app.get_messages(match_id)
+    app.get_messages_after(match_id, 0)
+    app.get_messages_before(match_id, None, 50)
+    app.search_messages(user_m, "こんにちは")
+    app.search_messages(user_m, "こん")
+
+    # Move the chat to cold storage, then read it through the same calls.
+    archive.inactive_matches(days=0)
+    archive.archive_match(match_id)
+    app.send_message(match_id, user_f, "お久しぶりです")
+    app.get_messages(match_id)
+    app.get_messages_after(match_id, 0)
+    app.get_messages_before(match_id, None, 50)
+    app.search_messages(user_f, "こんにちは")
+    search.backfill_once()
+
+    app.create_request(user_f, "渋谷", "20:00-22:00", 4)
+    pending = app.get_pending_request(user_f)
+    app.cancel_request(pending["request_id"])
+    app.get_pending_demand("渋谷", 5.0)
+    versions.current(notify.user_topic(user_f))
+
+    # An area missing from the station table is matched by name only.
+    app.create_request(user_m, "どこか", "20:00-22:00", 2)
+    app.cancel_request(app.get_pending_request(user_m)["request_id"])
+
+    # A request whose slot ended long ago, for the expiry sweeper.
+    app.create_request(user_f, "池袋", "18:00-20:00", 2)
+    with db.transaction() as conn:
+        conn.execute("UPDATE requests SET created_at = '2000-01-01 00:00:00' WHERE user_id = ? AND status = 'pending'",
+                     (user_f,))
+    sweeper.sweep_once()
+    analytics.load()
+
+
+def _sample_image():
+    import io
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 48), "#ff5a5f").save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def capture_statements(app):
+    statements = []
+    # Everything on this thread's connection, so no writer thread either.
+    with db.connection() as conn, message_queue.synchronous():
+        conn.set_trace_callback(statements.append)
+        try:
+            exercise(app)
+        finally:
+            conn.set_trace_callback(None)
+
+    seen = set()
+    unique = []
+    for statement in statements:
+        key = " ".join(statement.split())
+        if IGNORED.match(key) or FTS_INTERNAL.search(key) or key in seen:
+            continue
+        seen.add(key)
+        unique.append(statement)
+    return unique
+
+
+def partial_indexes(conn):
+    rows = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL").fetchall()
+    return {name for name, sql in rows if " WHERE " in " ".join(sql.upper().split())}
+
+
+def full_scans(conn, statement):
+    # Walking a partial index only touches the rows it covers (e.g. pending
+    # requests), which is the hot subset by design, so it is not a full scan.
+    allowed = partial_indexes(conn)
+    rows = conn.execute("EXPLAIN QUERY PLAN " + statement).fetchall()
+    scans = []
+    for _, _, _, detail in rows:
+        if not FULL_SCAN.match(detail) or VIRTUAL_LOOKUP.search(detail):
+            continue
+        index = SCAN_INDEX.search(detail)
+        if index and index.group(1) in allowed:
+            continue
+        if detail.split()[1] in SMALL_TABLES:
+            continue
+        scans.append(detail)
+    return scans
+
+
+def check(app):
+    """Return ``[(statement, [scan details])]`` for every offending query."""
+    failures = []
+    for statement in capture_statements(app):
+        with db.connection() as conn:
+            scans = full_scans(conn, statement)
+        if scans:
+            failures.append((statement, scans))
+    return failures
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        db.configure(os.path.join(tmp, "plans.db"))
+        schema.ensure_schema()
+        import app
+
+        failures = check(app)
+        db.get_pool().close()
+
+    for statement, scans in failures:
+        print("FULL SCAN:", " ".join(statement.split()))
+        for detail in scans:
+            print("    ", detail)
+    if failures:
+        print(f"{len(failures)} quer{'y' if len(failures) == 1 else 'ies'} fell back to a full scan")
+        return 1
+    print("all data-access queries use an index")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
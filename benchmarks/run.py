@@ -0,0 +1,195 @@
+"""Time the app.py data-access functions against a generated database.
+
+Each function is called with inputs sampled from the database (popular and
+unpopular users, long and short chats). The runner reports p50/p95/p99
+latency, rows returned, and SQLite VM steps per call. VM steps are the
+virtual-machine instructions the statements executed, which tracks rows
+scanned. They are counted in a separate pass, so the counting does not
+distort the timings. Results are written as JSON for benchmarks.compare.
+
+Read lookups go around the read-through cache by default, so they measure
+the database work; pass --with-cache to time what a rerun actually pays.
+Write benchmarks modify the database, so run them on a throwaway copy.
+
+    python -m benchmarks.run bench.db --out results.json
+"""
+import argparse
+import datetime
+import inspect
+import json
+import platform
+import random
+import sqlite3
+import subprocess
+import time
+
+from meetup import db, message_queue, schema
+
+# Calls timed per function, and calls used for counting VM steps.
+ITERATIONS = 500
+COUNTED = 50
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    index = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def _rows(result):
+    if result is None:
+        return 0
+    if isinstance(result, list):
+        return len(result)
+    return 1
+
+
+def _uncached(func, with_cache):
+    # Strips the metrics wrapper too, so only the database work is timed.
+    return func if with_cache else inspect.unwrap(func)
+
+
+def build_workloads(app, rng, iterations, with_cache=False):
+    """``{name: (function, [args, ...])}`` with inputs sampled from the database."""
+    with db.connection() as conn:
+        users = [row[0] for row in conn.execute("SELECT user_id FROM users ORDER BY random() LIMIT ?", (iterations,))]
+        usernames = [row[0] for row in conn.execute("SELECT username FROM users ORDER BY random() LIMIT ?", (iterations,))]
+        participants = conn.execute(
+            "SELECT match_id, user_id FROM match_participants ORDER BY random() LIMIT ?", (iterations,)
+        ).fetchall()
+        # Skewed on purpose: the longest chats are the interesting ones.
+        long_chats = [row[0] for row in conn.execute(
+            "SELECT match_id FROM messages GROUP BY match_id ORDER BY COUNT(*) DESC LIMIT 10"
+        )]
+        idle = [row[0] for row in conn.execute(
+            """
+            SELECT user_id FROM users
+            WHERE user_id NOT IN (SELECT user_id FROM requests WHERE status = 'pending')
+            ORDER BY random() LIMIT ?
+            """, (iterations,)
+        )]
+    chats = [m for m, _ in participants] + long_chats * max(len(participants) // 100, 1)
+    rng.shuffle(chats)
+
+    from benchmarks.datagen import AREAS, PASSWORD, TIME_SLOTS
+    return {
+        "login_user": (app.login_user, [(name, PASSWORD) for name in usernames]),
+        "get_user_details": (_uncached(app.get_user_details, with_cache), [(u,) for u in users]),
+        "get_pending_request": (_uncached(app.get_pending_request, with_cache), [(u,) for u in users]),
+        "get_user_matches": (_uncached(app.get_user_matches, with_cache), [(u,) for _, u in participants]),
+        "get_match": (app.get_match, participants),
+        "get_messages": (app.get_messages, [(m,) for m in chats]),
+        "get_messages_before": (app.get_messages_before, [(m, None, 50) for m in chats]),
+        "get_messages_after": (app.get_messages_after, [(m, 0) for m in chats[:len(chats) // 10]]),
+        "send_message": (app.send_message, [(m, u, "ベンチマーク") for m, u in participants]),
+        "create_request": (app.create_request, [
+            (u, rng.choice(AREAS), rng.choice(TIME_SLOTS), rng.randint(1, 10)) for u in idle
+        ]),
+    }
+
+
+def time_calls(func, calls):
+    timings, rows = [], 0
+    for args in calls:
+        started = time.perf_counter()
+        result = func(*args)
+        timings.append((time.perf_counter() - started) * 1000)
+        rows += _rows(result)
+    return sorted(timings), rows
+
+
+def count_vm_steps(func, calls):
+    steps = [0]
+
+    def tick():
+        steps[0] += 1
+        return 0
+
+    # Messages are written on this thread, where the handler can count them.
+    with db.connection() as conn, message_queue.synchronous():
+        conn.set_progress_handler(tick, 1)
+        try:
+            for args in calls:
+                func(*args)
+        finally:
+            conn.set_progress_handler(None, 1)
+    return steps[0] / len(calls) if calls else 0.0
+
+
+def run(path, iterations=ITERATIONS, counted=COUNTED, only=None, with_cache=False, seed=0):
+    db.configure(path)
+    schema.ensure_schema()
+    import app
+
+    rng = random.Random(seed)
+    workloads = build_workloads(app, rng, iterations, with_cache)
+    results = {}
+    for name, (func, calls) in workloads.items():
+        if only and name not in only or not calls:
+            continue
+        # Counting first keeps write workloads from measuring their own rows.
+        vm_steps = count_vm_steps(func, calls[:counted])
+        timings, rows = time_calls(func, calls[counted:] or calls)
+        results[name] = {
+            "calls": len(timings),
+            "p50_ms": round(percentile(timings, 0.50), 4),
+            "p95_ms": round(percentile(timings, 0.95), 4),
+            "p99_ms": round(percentile(timings, 0.99), 4),
+            "mean_ms": round(sum(timings) / len(timings), 4),
+            "max_ms": round(timings[-1], 4),
+            "rows_per_call": round(rows / len(timings), 2),
+            "vm_steps_per_call": round(vm_steps, 1),
+        }
+    return {"meta": _meta(path, iterations, with_cache), "results": results}
+
+
+def _meta(path, iterations, with_cache):
+    with db.connection() as conn:
+        counts = {
+            table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in ("users", "requests", "matches", "messages")
+        }
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "database": path,
+        "rows": counts,
+        "iterations": iterations,
+        "with_cache": with_cache,
+        "commit": commit,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "started_at": datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+
+
+def format_table(report):
+    lines = [f"{'function':<22}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'rows':>10}{'vm steps':>12}"]
+    for name, r in report["results"].items():
+        lines.append(f"{name:<22}{r['p50_ms']:>10.3f}{r['p95_ms']:>10.3f}{r['p99_ms']:>10.3f}"
+                     f"{r['rows_per_call']:>10.1f}{r['vm_steps_per_call']:>12.0f}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path")
+    parser.add_argument("--out", help="write JSON results here")
+    parser.add_argument("--iterations", type=int, default=ITERATIONS)
+    parser.add_argument("--only", nargs="*", help="benchmark only these functions")
+    parser.add_argument("--with-cache", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    report = run(args.path, iterations=args.iterations, only=args.only, with_cache=args.with_cache, seed=args.seed)
+    print(format_table(report))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as fh:
+            json.dump(report, fh, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""Cold-start and rerun timings for the Streamlit app.
+
+Cold start is measured in fresh interpreters: how long importing app.py
+takes on top of streamlit itself, and which heavy modules that import pulls
+in. Rerun times come from streamlit's AppTest, which runs the real script:
+the login page, then the dashboard once per tab, each with the SQL
+statements a rerun issued. Pending background work (search backfill,
+request expiry) is finished first so it does not run during timing. The
+read-through cache is cleared before every rerun unless --warm-cache is
+given, so the numbers show the database work a rerun can cost.
+
+    python -m benchmarks.startup bench.db --out startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from meetup import db, schema
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+
+# Modules whose presence after import means a slow cold start.
+HEAVY_MODULES = ("pandas", "numpy", "PIL", "pyarrow")
+
+DASHBOARD_TABS = ("マッチング", "メッセージ", "プロフィール")
+
+_IMPORT_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import streamlit
+imported_streamlit = time.perf_counter()
+import app
+imported_app = time.perf_counter()
+print(json.dumps({
+    "streamlit_ms": (imported_streamlit - started) * 1000,
+    "app_ms": (imported_app - imported_streamlit) * 1000,
+    "heavy_modules": [name for name in %r if name in sys.modules],
+}))
+"""
+
+
+def measure_import(path, runs):
+    env = dict(os.environ, MEETUP_DB_PATH=path)
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-c", _IMPORT_PROBE % (HEAVY_MODULES,)],
+            cwd=os.path.dirname(APP_PATH), env=env, capture_output=True, text=True, check=True,
+        ).stdout
+        samples.append(json.loads(out.strip().splitlines()[-1]))
+    return {
+        "streamlit_ms": round(statistics.median(s["streamlit_ms"] for s in samples), 2),
+        "app_ms": round(statistics.median(s["app_ms"] for s in samples), 2),
+        "heavy_modules": samples[-1]["heavy_modules"],
+    }
+
+
+def _busiest_user():
+    with db.connection() as conn:
+        return conn.execute("""
+        SELECT u.user_id, u.username, u.gender FROM match_participants p
+        JOIN users u ON u.user_id = p.user_id
+        GROUP BY p.user_id ORDER BY COUNT(*) DESC LIMIT 1
+        """).fetchone()
+
+
+def _time_reruns(at, runs, warm_cache):
+    from meetup import cache, metrics
+
+    timings, statements = [], []
+    for _ in range(runs):
+        if not warm_cache:
+            cache.cache.clear()
+        metrics.registry.reset()
+        started = time.perf_counter()
+        at.run()
+        timings.append((time.perf_counter() - started) * 1000)
+        if at.exception:
+            raise RuntimeError(at.exception[0].value)
+        statements.append(sum(r["calls"] for r in metrics.snapshot() if r["kind"] == "sql"))
+    timings.sort()
+    return {
+        "p50_ms": round(statistics.median(timings), 2),
+        "max_ms": round(timings[-1], 2),
+        "statements": statistics.median(statements),
+    }
+
+
+def measure_reruns(runs, warm_cache=False):
+    from streamlit.testing.v1 import AppTest
+
+    results = {}
+    at = AppTest.from_file(APP_PATH, default_timeout=60)
+    results["login"] = _time_reruns(at, runs, warm_cache)
+
+    user = _busiest_user()
+    if user is None:
+        return results
+    user_id, username, gender = user
+    for tab in DASHBOARD_TABS:
+        at = AppTest.from_file(APP_PATH, default_timeout=60)
+        at.session_state.page = "dashboard"
+        at.session_state.user_id = user_id
+        at.session_state.username = username
+        at.session_state.gender = gender
+        at.session_state.dashboard_tab = tab
+        results[f"dashboard:{tab}"] = _time_reruns(at, runs, warm_cache)
+    return results
+
+
+def settle():
+    """Finish the one-off background work so it does not run during timing."""
+    from meetup import search, sweeper
+
+    while search.backfill_once():
+        pass
+    sweeper.sweep_once()
+
+
+def run(path, import_runs=5, rerun_runs=20, warm_cache=False):
+    db.configure(path)
+    schema.ensure_schema()
+    settle()
+    return {
+        "database": path,
+        "import": measure_import(path, import_runs),
+        "reruns": measure_reruns(rerun_runs, warm_cache),
+        "warm_cache": warm_cache,
+    }
+
+
+def format_report(report):
+    imported = report["import"]
+    lines = [
+        f"import streamlit: {imported['streamlit_ms']:.1f} ms, import app: {imported['app_ms']:.1f} ms, "
+        f"heavy modules: {', '.join(imported['heavy_modules']) or 'none'}",
+        f"{'page':<24}{'p50 ms':>10}{'max ms':>10}{'statements':>12}",
+    ]
+    for page, r in report["reruns"].items():
+        lines.append(f"{page:<24}{r['p50_ms']:>10.1f}{r['max_ms']:>10.1f}{r['statements']:>12}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path")
+    parser.add_argument("--import-runs", type=int, default=5)
+    parser.add_argument("--reruns", type=int, default=20)
+    parser.add_argument("--warm-cache", action="store_true")
+    parser.add_argument("--out", help="write the JSON report here")
+    args = parser.parse_args(argv)
+
+    report = run(args.path, args.import_runs, args.reruns, args.warm_cache)
+    print(format_report(report))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as fh:
+            json.dump(report, fh, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+"""Concurrent load and contention harness.
+
+Simulates many Streamlit sessions hitting the app.py data functions at once,
+from several worker processes with several threads each, against one local
+SQLite file. Each session registers, logs in, submits a matching request,
+polls until it is matched or gives up and cancels, then chats with its
+partner.
+
+Reported per run:
+- throughput and latency percentiles per operation
+- errors per operation, with "database is locked" counted separately
+- time spent waiting for the write lock
+- matching invariants checked against the database afterwards
+
+Caches and live notifications are per process. With several processes, a
+session can therefore see a match only after the cache TTL has passed.
+Those sessions show up as poll timeouts, not as invariant violations.
+
+    python -m benchmarks.stress stress.db --processes 4 --threads 16 --sessions 10
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import time
+from collections import defaultdict
+
+from benchmarks.datagen import AREAS, TIME_SLOTS, zipf_weights
+from benchmarks.run import percentile
+from meetup import db, geo, schema
+
+PASSWORD = "password"
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.locked = defaultdict(int)
+        self.counters = defaultdict(int)
+
+    def call(self, name, func, *args):
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        except sqlite3.OperationalError as exc:
+            if "locked" in str(exc) or "busy" in str(exc):
+                self.locked[name] += 1
+            self.errors[name] += 1
+            return None
+        except Exception:
+            self.errors[name] += 1
+            return None
+        finally:
+            self.latencies[name].append(time.perf_counter() - started)
+
+    def merge(self, other):
+        for name, values in other["latencies"].items():
+            self.latencies[name].extend(values)
+        for field in ("errors", "locked", "counters"):
+            target = getattr(self, field)
+            for name, value in other[field].items():
+                target[name] += value
+
+    def export(self):
+        return {
+            "latencies": dict(self.latencies),
+            "errors": dict(self.errors),
+            "locked": dict(self.locked),
+            "counters": dict(self.counters),
+        }
+
+
+def session(app, rng, recorder, username, polls, poll_interval, messages, think):
+    """One user's visit, following the same calls the UI makes."""
+    gender = rng.choice(["男性", "女性"])
+    recorder.call("register_user", app.register_user, username, PASSWORD, gender, rng.randint(18, 30))
+    user_id, _, _ = recorder.call("login_user", app.login_user, username, PASSWORD) or (None, None, None)
+    if user_id is None:
+        recorder.counters["login_failed"] += 1
+        return
+    recorder.call("get_user_details", app.get_user_details, user_id)
+
+    area = rng.choices(AREAS[:3], zipf_weights(3, 1.0))[0]
+    slot = rng.choices(TIME_SLOTS, zipf_weights(len(TIME_SLOTS), 0.6))[0]
+    result = recorder.call("create_request", app.create_request, user_id, area, slot, rng.randint(1, 10))
+    match_id = result[1] if result and result[0] else None
+
+    for _ in range(polls if match_id is None else 0):
+        time.sleep(poll_interval)
+        pending = recorder.call("get_pending_request", app.get_pending_request, user_id)
+        if pending is None:
+            matches = recorder.call("get_user_matches", app.get_user_matches, user_id) or []
+            if matches:
+                match_id = matches[0]["match_id"]
+                break
+
+    if match_id is None:
+        recorder.counters["poll_timeouts"] += 1
+        pending = recorder.call("get_pending_request", app.get_pending_request, user_id)
+        if pending:
+            recorder.call("cancel_request", app.cancel_request, pending["request_id"])
+        return
+
+    recorder.counters["matched_sessions"] += 1
+    recorder.call("get_match", app.get_match, match_id, user_id)
+    last_id = 0
+    for index in range(messages):
+        time.sleep(think * rng.random())
+        recorder.call("send_message", app.send_message, match_id, user_id, f"{username} のメッセージ {index}")
+        new = recorder.call("get_messages_after", app.get_messages_after, match_id, last_id) or []
+        if new:
+            last_id = new[-1]["message_id"]
+
+
+def _thread_worker(app, seed, prefix, sessions, options, recorder):
+    rng = random.Random(seed)
+    for index in range(sessions):
+        session(app, rng, recorder, f"{prefix}_{index}", **options)
+
+
+def process_worker(path, worker, threads, sessions, options, seed):
+    """Run ``threads`` threads of ``sessions`` sessions each; returns metrics."""
+    import threading
+
+    db.configure(path)
+    schema.ensure_schema()
+    import app
+
+    db.reset_lock_wait_stats()
+    recorder = Recorder()
+    pool = [
+        threading.Thread(
+            target=_thread_worker,
+            args=(app, seed * 1000 + worker * 100 + t, f"p{worker}t{t}s{seed}", sessions, options, recorder),
+        )
+        for t in range(threads)
+    ]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+
+    metrics = recorder.export()
+    metrics["lock_wait"] = db.lock_wait_stats()
+    return metrics
+
+
+def _orphaned_pending(conn):
+    # Men left waiting while a woman in the same slot waits within the
+    # matching radius (or at the same area, for areas without coordinates).
+    pending = conn.execute("""
+        SELECT u.gender, r.area, r.time_slot, r.lat, r.lon FROM requests r
+        JOIN users u ON u.user_id = r.user_id
+        WHERE r.status = 'pending'
+    """).fetchall()
+    women = [row for row in pending if row[0] == "女性"]
+
+    def compatible(a, b):
+        if a[2] != b[2]:
+            return False
+        if a[3] is None or b[3] is None:
+            return a[3] is None and b[3] is None and a[1] == b[1]
+        return geo.distance_km(a[3], a[4], b[3], b[4]) <= geo.RADIUS_KM
+
+    return sum(
+        1 for man in pending
+        if man[0] == "男性" and any(compatible(man, woman) for woman in women)
+    )
+
+
+def check_invariants(path):
+    """Return ``{invariant: violation count}``; all zero means the run was clean."""
+    conn = sqlite3.connect(path)
+    try:
+        checks = {
+            # A request appears in at most one match.
+            "request_matched_twice": """
+                SELECT COUNT(*) FROM (
+                    SELECT request_id FROM (
+                        SELECT request_id_1 AS request_id FROM matches
+                        UNION ALL SELECT request_id_2 FROM matches
+                    ) GROUP BY request_id HAVING COUNT(*) > 1
+                )
+            """,
+            # Every matched request belongs to a match and vice versa.
+            "matched_without_match": """
+                SELECT COUNT(*) FROM requests r
+                WHERE r.status = 'matched'
+                AND NOT EXISTS (SELECT 1 FROM matches m WHERE r.request_id IN (m.request_id_1, m.request_id_2))
+            """,
+            "match_with_unmatched_request": """
+                SELECT COUNT(*) FROM matches m
+                JOIN requests r ON r.request_id IN (m.request_id_1, m.request_id_2)
+                WHERE r.status != 'matched'
+            """,
+            "multiple_pending_per_user": """
+                SELECT COUNT(*) FROM (
+                    SELECT user_id FROM requests WHERE status = 'pending' GROUP BY user_id HAVING COUNT(*) > 1
+                )
+            """,
+        }
+        invariants = {name: conn.execute(sql).fetchone()[0] for name, sql in checks.items()}
+        invariants["orphaned_pending"] = _orphaned_pending(conn)
+        return invariants
+    finally:
+        conn.close()
+
+
+def summarise(recorder, lock_waits, elapsed, invariants):
+    operations = {}
+    total_calls = 0
+    for name, values in sorted(recorder.latencies.items()):
+        ordered = sorted(values)
+        total_calls += len(ordered)
+        operations[name] = {
+            "calls": len(ordered),
+            "per_second": round(len(ordered) / elapsed, 1),
+            "p50_ms": round(percentile(ordered, 0.50) * 1000, 3),
+            "p95_ms": round(percentile(ordered, 0.95) * 1000, 3),
+            "p99_ms": round(percentile(ordered, 0.99) * 1000, 3),
+            "max_ms": round(ordered[-1] * 1000, 3),
+            "errors": recorder.errors.get(name, 0),
+            "locked_errors": recorder.locked.get(name, 0),
+            "error_rate": round(recorder.errors.get(name, 0) / len(ordered), 5),
+        }
+    return {
+        "elapsed_seconds": round(elapsed, 2),
+        "calls": total_calls,
+        "calls_per_second": round(total_calls / elapsed, 1),
+        "operations": operations,
+        "lock_wait": {
+            "count": sum(w["count"] for w in lock_waits),
+            "total_seconds": round(sum(w["seconds"] for w in lock_waits), 4),
+            "max_ms": round(max((w["max_seconds"] for w in lock_waits), default=0) * 1000, 3),
+        },
+        "sessions": dict(recorder.counters),
+        "invariants": invariants,
+    }
+
+
+def run(path, processes=2, threads=8, sessions=5, polls=20, poll_interval=0.05, messages=5, think=0.02,
+        fresh=True, seed=0):
+    if fresh:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    db.configure(path)
+    schema.ensure_schema()
+
+    options = {"polls": polls, "poll_interval": poll_interval, "messages": messages, "think": think}
+    jobs = [(path, worker, threads, sessions, options, seed) for worker in range(processes)]
+
+    started = time.perf_counter()
+    if processes == 1:
+        results = [process_worker(*jobs[0])]
+    else:
+        with multiprocessing.get_context("spawn").Pool(processes) as pool:
+            results = pool.starmap(process_worker, jobs)
+    elapsed = time.perf_counter() - started
+
+    recorder = Recorder()
+    for metrics in results:
+        recorder.merge(metrics)
+    return summarise(recorder, [m["lock_wait"] for m in results], elapsed, check_invariants(path))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path")
+    parser.add_argument("--processes", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--sessions", type=int, default=5, help="sessions per thread")
+    parser.add_argument("--polls", type=int, default=20)
+    parser.add_argument("--poll-interval", type=float, default=0.05)
+    parser.add_argument("--messages", type=int, default=5)
+    parser.add_argument("--think", type=float, default=0.02)
+    parser.add_argument("--keep", action="store_true", help="reuse the existing database")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="write the JSON summary here")
+    args = parser.parse_args(argv)
+
+    summary = run(
+        args.path, processes=args.processes, threads=args.threads, sessions=args.sessions,
+        polls=args.polls, poll_interval=args.poll_interval, messages=args.messages, think=args.think,
+        fresh=not args.keep, seed=args.seed,
+    )
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as fh:
+            json.dump(summary, fh, ensure_ascii=False, indent=2)
+    if any(summary["invariants"].values()):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""Demand analytics kept up to date by triggers.
+
+``demand_stats`` holds one row per (area, time_slot, gender): requests
+pending now, and how many were matched, cancelled or expired so far, plus
+the total wait of the matched ones. ``demand_wait_histogram`` counts matched
+requests per wait bucket (WAIT_BOUNDS), which is enough for a median.
+
+Triggers installed by migration 12 (meetup.schema) move the counters on the same writes
+that change the requests, inside the same transaction, whichever code path
+makes them. A new pending request adds one to pending. A pending request
+leaving ``requests`` (matched, cancelled or expired) takes one away.
+Inserting a match adds both sides' waits. Cancelled and expired requests are
+archived into ``requests_archive``, and that insert counts them. The tables
+are a few hundred rows at most, so the analytics page reads them whole
+instead of grouping over requests and matches.
+
+``rebuild`` recomputes both tables from the source rows and ``verify``
+compares the two. From the command line, exiting non-zero on a mismatch
+(``--rebuild`` also repairs it):
+
+    python -m meetup.analytics [--db PATH] [--rebuild]
+"""
+import argparse
+import sys
+
+from meetup import db
+
+# Upper bounds (seconds) of the wait-time buckets; the last bucket is open.
+# Migration 12 writes them into the trigger, so changing them takes a new
+# migration that recreates trg_demand_match and rebuilds the histogram.
+WAIT_BOUNDS = (60, 300, 600, 1800, 3600, 7200, 14400, 28800, 86400)
+
+STAT_COLUMNS = ("pending", "matched", "cancelled", "expired", "wait_seconds")
+
+
+def wait_bucket_sql(seconds):
+    """SQL for the WAIT_BOUNDS bucket of the wait expression ``seconds``."""
+    cases = " ".join(f"WHEN {seconds} < {bound} THEN {i}" for i, bound in enumerate(WAIT_BOUNDS))
+    return f"CASE {cases} ELSE {len(WAIT_BOUNDS)} END"
+
+
+# What the triggers should have counted, computed from the source rows.
+_MATCH_WAITS = """
+SELECT r.area, r.time_slot, u.gender, MAX((julianday(m.matched_at) - julianday(r.created_at)) * 86400, 0) AS wait
+FROM matches m
+JOIN requests r ON r.request_id IN (m.request_id_1, m.request_id_2)
+JOIN users u ON u.user_id = r.user_id
+"""
+
+STATS_FROM_SCRATCH = f"""
+SELECT area, time_slot, gender, SUM(pending), SUM(matched), SUM(cancelled), SUM(expired), SUM(wait_seconds)
+FROM (
+    SELECT r.area, r.time_slot, u.gender, 1 AS pending, 0 AS matched, 0 AS cancelled, 0 AS expired, 0 AS wait_seconds
+    FROM requests r JOIN users u ON u.user_id = r.user_id
+    WHERE r.status = 'pending'
+    UNION ALL
+    SELECT a.area, a.time_slot, u.gender, 0, 0, a.status = 'cancelled', a.status = 'expired', 0
+    FROM requests_archive a JOIN users u ON u.user_id = a.user_id
+    UNION ALL
+    SELECT area, time_slot, gender, 0, 1, 0, 0, wait FROM ({_MATCH_WAITS})
+)
+GROUP BY area, time_slot, gender
+"""
+
+HISTOGRAM_FROM_SCRATCH = f"""
+SELECT area, time_slot, gender, {wait_bucket_sql("wait")} AS bucket, COUNT(*)
+FROM ({_MATCH_WAITS})
+GROUP BY area, time_slot, gender, bucket
+"""
+
+
+def rebuild(conn):
+    """Replace both tables with values computed from the source rows."""
+    conn.execute("DELETE FROM demand_stats")
+    conn.execute("DELETE FROM demand_wait_histogram")
+    conn.execute(f"""
+    INSERT INTO demand_stats (area, time_slot, gender, {", ".join(STAT_COLUMNS)})
+    {STATS_FROM_SCRATCH}
+    """)
+    conn.execute(f"INSERT INTO demand_wait_histogram (area, time_slot, gender, bucket, matches) {HISTOGRAM_FROM_SCRATCH}")
+
+
+def _read(conn):
+    stats = conn.execute(f"SELECT area, time_slot, gender, {', '.join(STAT_COLUMNS)} FROM demand_stats").fetchall()
+    histogram = conn.execute("SELECT area, time_slot, gender, bucket, matches FROM demand_wait_histogram").fetchall()
+    return stats, histogram
+
+
+def load():
+    """``(stats rows, histogram rows)`` as stored."""
+    with db.connection() as conn:
+        return _read(conn)
+
+
+def verify():
+    """Differences between the stored and the recomputed numbers.
+
+    Returns ``[(table, key, column, stored, expected)]``; empty means the
+    incremental tables are exact.
+    """
+    with db.transaction() as conn:  # one snapshot for both sides
+        stored_stats, stored_histogram = _read(conn)
+        expected_stats = conn.execute(STATS_FROM_SCRATCH).fetchall()
+        expected_histogram = conn.execute(HISTOGRAM_FROM_SCRATCH).fetchall()
+
+    differences = []
+    for table, stored, expected, columns, width in (
+        ("demand_stats", stored_stats, expected_stats, STAT_COLUMNS, 3),
+        ("demand_wait_histogram", stored_histogram, expected_histogram, ("matches",), 4),
+    ):
+        stored = {row[:width]: row[width:] for row in stored}
+        expected = {row[:width]: row[width:] for row in expected}
+        zero = (0,) * len(columns)
+        for key in sorted(set(stored) | set(expected)):
+            for column, have, want in zip(columns, stored.get(key, zero), expected.get(key, zero)):
+                if abs(have - want) > 1e-6 * max(1, abs(want)):  # wait_seconds is a float sum
+                    differences.append((table, key, column, have, want))
+    return differences
+
+
+def median_wait(counts):
+    """Median wait in seconds from ``{bucket: matches}``, interpolated within its bucket."""
+    total = sum(counts.values())
+    if not total:
+        return None
+    seen = 0
+    for bucket in range(len(WAIT_BOUNDS) + 1):
+        in_bucket = counts.get(bucket, 0)
+        if in_bucket and seen + in_bucket >= total / 2:
+            if bucket == len(WAIT_BOUNDS):
+                return float(WAIT_BOUNDS[-1])  # open-ended: report its lower bound
+            low = WAIT_BOUNDS[bucket - 1] if bucket else 0
+            return low + (WAIT_BOUNDS[bucket] - low) * (total / 2 - seen) / in_bucket
+        seen += in_bucket
+    return None
+
+
+def frames(by_gender=True):
+    """The stored analytics as a pandas DataFrame.
+
+    One row per area, time slot and gender, or per area and time slot with
+    both genders added up when ``by_gender`` is false. Adds ``resolved``
+    (matched + cancelled + expired), ``match_rate`` (matched / resolved),
+    ``mean_wait_min`` and ``median_wait_min``.
+    """
+    import pandas as pd
+
+    keys = ["area", "time_slot", "gender"] if by_gender else ["area", "time_slot"]
+    stats, histogram = load()
+    frame = pd.DataFrame(stats, columns=["area", "time_slot", "gender", *STAT_COLUMNS])
+    if not by_gender:
+        frame = frame.groupby(keys, as_index=False)[list(STAT_COLUMNS)].sum()
+    counts = {}
+    for row in histogram:
+        buckets = counts.setdefault(row[:len(keys)], {})
+        buckets[row[3]] = buckets.get(row[3], 0) + row[4]
+
+    frame["resolved"] = frame["matched"] + frame["cancelled"] + frame["expired"]
+    frame["match_rate"] = (frame["matched"] / frame["resolved"]).where(frame["resolved"] > 0)
+    frame["mean_wait_min"] = (frame["wait_seconds"] / frame["matched"] / 60).where(frame["matched"] > 0)
+    medians = [median_wait(counts.get(key, {})) for key in zip(*(frame[k] for k in keys))]
+    frame["median_wait_min"] = pd.Series(medians, index=frame.index, dtype=float) / 60
+    return frame.drop(columns="wait_seconds")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check or rebuild the incrementally maintained demand analytics.")
+    parser.add_argument("--db", help="database file (default: MEETUP_DB_PATH)")
+    parser.add_argument("--rebuild", action="store_true", help="recompute the tables from scratch")
+    args = parser.parse_args(argv)
+
+    from meetup import schema
+    if args.db:
+        db.configure(args.db)
+    schema.ensure_schema()
+
+    differences = verify()
+    for table, key, column, stored, expected in differences[:50]:
+        print(f"{table} {'/'.join(map(str, key))} {column}: stored {stored}, expected {expected}")
+    print(f"{len(differences)} differences")
+    if differences and args.rebuild:
+        with db.transaction(immediate=True) as conn:
+            rebuild(conn)
+        print("rebuilt")
+        return 0
+    return 1 if differences else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
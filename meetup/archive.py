@@ -0,0 +1,288 @@
+"""Cold storage for the messages of inactive chats.
+
+Once a match has had no message for ARCHIVE_AFTER_DAYS, its messages move
+out of SQLite into append-only segment files. Each match is cut into blocks
+of up to BLOCK_MESSAGES rows, and each block is zlib-compressed JSON. The
+``archive_blocks`` table indexes the blocks as (match_id, first and last
+message_id, segment, offset, length), so a read looks up the blocks it
+needs and decompresses only those slices of a memory-mapped segment.
+
+Bytes are appended and fsynced before the index rows and the DELETE from
+``messages`` commit, all under the database write lock. A crash can
+therefore leave unreferenced bytes at the end of a segment, but never an
+index row pointing at missing data. Archived ids always precede the live
+ones of the same match, so readers put cold rows in front of live rows.
+
+    python -m meetup.archive --days 30
+"""
+import argparse
+import datetime
+import functools
+import json
+import logging
+import mmap
+import os
+import threading
+import time
+import zlib
+from collections import deque, namedtuple
+
+from meetup import db
+
+logger = logging.getLogger(__name__)
+
+# Segment directory; defaults to "<database>.archive" next to the database.
+ARCHIVE_DIR = os.environ.get("MEETUP_ARCHIVE_DIR")
+
+# A match is archived once its last message is older than this.
+ARCHIVE_AFTER_DAYS = float(os.environ.get("MEETUP_ARCHIVE_AFTER_DAYS", "30"))
+
+# Seconds between archival runs, and matches archived per run.
+ARCHIVE_INTERVAL = float(os.environ.get("MEETUP_ARCHIVE_INTERVAL", "3600"))
+MATCHES_PER_RUN = int(os.environ.get("MEETUP_ARCHIVE_MATCHES_PER_RUN", "500"))
+
+# Messages per compressed block, and the size at which a new segment starts.
+BLOCK_MESSAGES = 256
+SEGMENT_BYTES = int(os.environ.get("MEETUP_ARCHIVE_SEGMENT_BYTES", str(64 * 1024 * 1024)))
+
+# Decompressed blocks kept in memory, so paging back through a cold chat
+# does not inflate the same block again.
+BLOCK_CACHE_SIZE = 256
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+MAX_ID = 2**63 - 1
+
+ArchiveReport = namedtuple("ArchiveReport", "started_at duration_ms matches blocks messages bytes")
+
+
+def archive_dir():
+    return ARCHIVE_DIR or db.DB_PATH + ".archive"
+
+
+def segment_path(directory, segment):
+    return os.path.join(directory, f"segment-{segment:06d}.zlog")
+
+
+# Reading
+
+_maps = {}
+_maps_lock = threading.Lock()
+
+
+def _segment_map(path, needed):
+    # Segments only grow, so a mapping taken before the last append may be
+    # too short; map the file again. Old mappings close once unreferenced.
+    mapped = _maps.get(path)
+    if mapped is None or len(mapped) < needed:
+        with _maps_lock:
+            mapped = _maps.get(path)
+            if mapped is None or len(mapped) < needed:
+                with open(path, "rb") as fh:
+                    mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+                _maps[path] = mapped
+    return mapped
+
+
+@functools.lru_cache(maxsize=BLOCK_CACHE_SIZE)
+def load_block(path, offset, length):
+    """The rows of one block, oldest first, as tuples."""
+    payload = _segment_map(path, offset + length)[offset:offset + length]
+    return tuple(tuple(row) for row in json.loads(zlib.decompress(payload)))
+
+
+def read_messages(conn, match_id, after_id=0, before_id=None, limit=None):
+    """Archived ``(message_id, sender_id, username, text, timestamp)`` rows, oldest first.
+
+    Only rows with ``after_id < message_id < before_id`` are returned; with
+    ``limit``, only the newest ``limit`` of those.
+    """
+    before_id = MAX_ID if before_id is None else before_id
+    blocks = conn.execute("""
+    SELECT segment, offset, length FROM archive_blocks
+    WHERE match_id = ? AND first_message_id < ? AND last_message_id > ?
+    ORDER BY first_message_id DESC
+    """, (match_id, before_id, after_id)).fetchall()
+    if not blocks:
+        return []
+
+    directory = archive_dir()
+    rows = []
+    for segment, offset, length in blocks:  # newest block first
+        block = load_block(segment_path(directory, segment), offset, length)
+        rows[:0] = [row for row in block if after_id < row[0] < before_id]
+        if limit is not None and len(rows) >= limit:
+            return rows[-limit:]
+    return rows
+
+
+# Writing
+
+def _current_segment(directory):
+    numbers = [
+        int(name[len("segment-"):-len(".zlog")])
+        for name in os.listdir(directory)
+        if name.startswith("segment-") and name.endswith(".zlog")
+    ]
+    segment = max(numbers, default=1)
+    path = segment_path(directory, segment)
+    if os.path.exists(path) and os.path.getsize(path) >= SEGMENT_BYTES:
+        segment += 1
+    return segment
+
+
+def _append(payloads):
+    directory = archive_dir()
+    os.makedirs(directory, exist_ok=True)
+    segment = _current_segment(directory)
+    path = segment_path(directory, segment)
+    created = not os.path.exists(path)
+
+    placements = []
+    with open(path, "ab") as fh:
+        for payload in payloads:
+            placements.append((segment, fh.tell(), len(payload)))
+            fh.write(payload)
+        fh.flush()
+        os.fsync(fh.fileno())
+    if created and hasattr(os, "O_DIRECTORY"):
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    return placements
+
+
+def archive_match(match_id):
+    """Move every live message of ``match_id`` to cold storage.
+
+    Returns ``(blocks, messages, bytes)`` written.
+    """
+    with db.transaction(immediate=True) as conn:
+        rows = conn.execute("""
+        SELECT m.message_id, m.sender_user_id, u.username, m.message_text, m.timestamp
+        FROM messages m
+        JOIN users u ON m.sender_user_id = u.user_id
+        WHERE m.match_id = ?
+        ORDER BY m.message_id
+        """, (match_id,)).fetchall()
+        if not rows:
+            return 0, 0, 0
+
+        blocks = [rows[i:i + BLOCK_MESSAGES] for i in range(0, len(rows), BLOCK_MESSAGES)]
+        payloads = [zlib.compress(json.dumps(block, ensure_ascii=False).encode("utf-8")) for block in blocks]
+        placements = _append(payloads)
+        conn.executemany("""
+        INSERT INTO archive_blocks
+            (match_id, first_message_id, last_message_id, message_count, segment, offset, length)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, [
+            (match_id, block[0][0], block[-1][0], len(block), segment, offset, length)
+            for block, (segment, offset, length) in zip(blocks, placements)
+        ])
+        conn.execute("DELETE FROM messages WHERE match_id = ? AND message_id <= ?", (match_id, rows[-1][0]))
+    return len(blocks), len(rows), sum(len(p) for p in payloads)
+
+
+def inactive_matches(now=None, days=ARCHIVE_AFTER_DAYS, limit=MATCHES_PER_RUN):
+    """Matches with live messages, none newer than ``days`` days, oldest first."""
+    now = now or datetime.datetime.utcnow()
+    cutoff = (now - datetime.timedelta(days=days)).strftime(TIMESTAMP_FORMAT)
+    with db.connection() as conn:
+        return [row[0] for row in conn.execute("""
+        SELECT m.match_id FROM matches m
+        WHERE m.matched_at < ?
+        AND EXISTS (SELECT 1 FROM messages WHERE match_id = m.match_id)
+        AND NOT EXISTS (SELECT 1 FROM messages WHERE match_id = m.match_id AND timestamp >= ?)
+        ORDER BY m.matched_at
+        LIMIT ?
+        """, (cutoff, cutoff, limit))]
+
+
+def archive_once(now=None, days=ARCHIVE_AFTER_DAYS, limit=MATCHES_PER_RUN):
+    """Archive up to ``limit`` inactive matches and return an ArchiveReport."""
+    started = time.perf_counter()
+    started_at = datetime.datetime.now()
+    matches = blocks = messages = written = 0
+    for match_id in inactive_matches(now, days, limit):
+        b, m, n = archive_match(match_id)
+        if m:
+            matches += 1
+            blocks += b
+            messages += m
+            written += n
+    return ArchiveReport(
+        started_at=started_at,
+        duration_ms=(time.perf_counter() - started) * 1000,
+        matches=matches,
+        blocks=blocks,
+        messages=messages,
+        bytes=written,
+    )
+
+
+class Archiver(threading.Thread):
+    def __init__(self, interval=ARCHIVE_INTERVAL):
+        super().__init__(name="chat-archiver", daemon=True)
+        self.interval = interval
+        self.reports = deque(maxlen=100)
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                report = archive_once()
+            except Exception:
+                logger.exception("chat archival run failed")
+                continue
+            self.reports.append(report)
+            if report.matches:
+                logger.info("archived %d messages of %d matches into %d blocks (%d bytes, %.1f ms)",
+                            report.messages, report.matches, report.blocks, report.bytes, report.duration_ms)
+
+    def stop(self):
+        self._stop_event.set()
+
+
+_archiver = None
+_archiver_lock = threading.Lock()
+
+
+def start():
+    """Start the process-wide archiver once; later calls return it."""
+    global _archiver
+    with _archiver_lock:
+        if _archiver is None or not _archiver.is_alive():
+            _archiver = Archiver()
+            _archiver.start()
+        return _archiver
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Move inactive chats into compressed segment files.")
+    parser.add_argument("--db", help="database file (default: MEETUP_DB_PATH)")
+    parser.add_argument("--days", type=float, default=ARCHIVE_AFTER_DAYS)
+    parser.add_argument("--vacuum", action="store_true", help="shrink the database file afterwards")
+    args = parser.parse_args(argv)
+
+    from meetup import schema
+    if args.db:
+        db.configure(args.db)
+    schema.ensure_schema()
+
+    total = ArchiveReport(None, 0.0, 0, 0, 0, 0)
+    while True:
+        report = archive_once(days=args.days)
+        total = total._replace(**{f: getattr(total, f) + getattr(report, f)
+                                  for f in ("duration_ms", "matches", "blocks", "messages", "bytes")})
+        if report.matches < MATCHES_PER_RUN:
+            break
+    print(f"archived {total.messages} messages of {total.matches} matches "
+          f"into {total.blocks} blocks ({total.bytes} bytes) in {total.duration_ms:.0f} ms")
+    if args.vacuum:
+        with db.connection() as conn:
+            conn.execute("VACUUM")
+
+
+if __name__ == "__main__":
+    main()
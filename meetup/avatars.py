@@ -0,0 +1,190 @@
+"""Content-addressed avatar storage.
+
+An upload is identified by the SHA-256 of its bytes. Its thumbnails live
+next to the database in ``<avatar dir>/<hash[:2]>/<hash>-<size>.webp``, so
+identical uploads share one set of files and an upload whose thumbnails
+already exist is never decoded. Otherwise the image is decoded once with
+Pillow, cropped to a square, and every size in SIZES is resized and encoded
+on a small worker pool shared by all sessions, which bounds the CPU spent
+on uploads. Files are written to a temporary name and renamed into place.
+
+Pages only ever read finished files, through an LRU cache of data URIs
+bounded by CACHE_BYTES. Rendering an avatar never imports Pillow.
+"""
+import base64
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from meetup import db
+
+# Thumbnail directory; defaults to "<database>.avatars" next to the database.
+AVATAR_DIR = os.environ.get("MEETUP_AVATAR_DIR")
+
+# Square thumbnail edges in pixels: list rows and the chat header, the profile.
+SMALL, LARGE = 48, 160
+SIZES = (SMALL, LARGE)
+
+# Uploads above these limits are rejected before or right after decoding.
+MAX_BYTES = int(os.environ.get("MEETUP_AVATAR_MAX_BYTES", str(5 * 1024 * 1024)))
+MAX_PIXELS = 40_000_000
+
+# Threads resizing and encoding thumbnails, per process.
+WORKERS = int(os.environ.get("MEETUP_AVATAR_WORKERS", "2"))
+
+# Encoded thumbnails kept in memory for rendering.
+CACHE_BYTES = int(os.environ.get("MEETUP_AVATAR_CACHE_BYTES", str(16 * 1024 * 1024)))
+
+FORMAT, EXTENSION, MIME = "WEBP", "webp", "image/webp"
+QUALITY = 85
+
+
+class InvalidImage(Exception):
+    """The upload is not an image Pillow can read, or is too large."""
+
+
+def avatar_dir():
+    return AVATAR_DIR or db.DB_PATH + ".avatars"
+
+
+def thumbnail_path(digest, size, directory=None):
+    return os.path.join(directory or avatar_dir(), digest[:2], f"{digest}-{size}.{EXTENSION}")
+
+
+# Writing
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _executor():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="avatar")
+        return _pool
+
+
+def _decode(data):
+    from PIL import Image, ImageOps
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        if image.width * image.height > MAX_PIXELS:
+            raise InvalidImage(f"{image.width}x{image.height} pixels")
+        image = ImageOps.exif_transpose(image).convert("RGB")
+    except (OSError, ValueError, Image.DecompressionBombError) as exc:
+        raise InvalidImage(str(exc)) from exc
+
+    # Centre square, loaded once and only read by the workers.
+    edge = min(image.size)
+    left, top = (image.width - edge) // 2, (image.height - edge) // 2
+    square = image.crop((left, top, left + edge, top + edge))
+    square.load()
+    return square
+
+
+def _write_thumbnail(square, size, path):
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    square.resize((size, size), Image.LANCZOS).save(buffer, FORMAT, quality=QUALITY)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary, "wb") as fh:
+        fh.write(buffer.getvalue())
+    os.replace(temporary, path)
+    return path
+
+
+def store(data):
+    """Store an uploaded image and return its content hash.
+
+    Raises InvalidImage if the bytes are not a usable image.
+    """
+    if len(data) > MAX_BYTES:
+        raise InvalidImage(f"{len(data)} bytes")
+    digest = hashlib.sha256(data).hexdigest()
+    directory = avatar_dir()
+    missing = [size for size in SIZES if not os.path.exists(thumbnail_path(digest, size, directory))]
+    if not missing:
+        return digest  # the same image was uploaded before
+
+    square = _decode(data)
+    futures = [
+        _executor().submit(_write_thumbnail, square, size, thumbnail_path(digest, size, directory))
+        for size in missing
+    ]
+    for future in futures:
+        future.result()
+    return digest
+
+
+# Reading
+
+class ByteLRU:
+    """LRU mapping bounded by the total length of its values."""
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old)
+            self._entries[key] = value
+            self.bytes += len(value)
+            while self.bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.bytes, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses}
+
+
+cache = ByteLRU()
+
+
+def data_uri(digest, size):
+    """``data:`` URI of a stored thumbnail, or None if it is missing."""
+    key = (digest, size)
+    uri = cache.get(key)
+    if uri is None:
+        try:
+            with open(thumbnail_path(digest, size), "rb") as fh:
+                encoded = base64.b64encode(fh.read()).decode("ascii")
+        except FileNotFoundError:
+            return None
+        uri = f"data:{MIME};base64,{encoded}"
+        cache.put(key, uri)
+    return uri
+
+
+def img_tag(digest, size):
+    """An <img> for ``digest`` at ``size`` px, or "" without an avatar."""
+    uri = data_uri(digest, size) if digest else None
+    if uri is None:
+        return ""
+    return (f'<img src="{uri}" width="{size}" height="{size}" '
+            f'style="border-radius: 50%; vertical-align: middle; margin-right: 8px;">')
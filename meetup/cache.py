@@ -0,0 +1,120 @@
+"""Process-wide read-through cache for hot lookups.
+
+Entries expire after TTL seconds and the least recently used entry is evicted
+once MAX_ENTRIES is reached. Writers invalidate exactly the keys they affect.
+Values are shared between sessions, so callers must treat them as read-only.
+
+Hit, miss and eviction counters, overall and per namespace, are available
+from ``stats()`` for sizing the cache.
+"""
+import functools
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+MAX_ENTRIES = int(os.environ.get("MEETUP_CACHE_SIZE", "10000"))
+TTL = float(os.environ.get("MEETUP_CACHE_TTL", "60"))
+
+# Namespaces of the cached lookups, shared by readers and invalidating writers.
+USER_DETAILS = "user_details"
+USER_MATCHES = "user_matches"
+PENDING_REQUEST = "pending_request"
+PENDING_DEMAND = "pending_demand"  # expires by TTL only, nothing invalidates it
+
+_MISSING = object()
+
+
+class TTLCache:
+    def __init__(self, max_entries=MAX_ENTRIES, ttl=TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped by every invalidation. A miss that started before an
+        # invalidation must not store what may be a pre-write value.
+        self._epoch = 0
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self.evictions = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits[key[0]] += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses[key[0]] += 1
+            return _MISSING
+
+    def epoch(self):
+        return self._epoch
+
+    def set(self, key, value, epoch=None):
+        with self._lock:
+            if epoch is not None and epoch != self._epoch:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._epoch += 1
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            namespaces = sorted(set(self.hits) | set(self.misses))
+            hits = sum(self.hits.values())
+            misses = sum(self.misses.values())
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+                "evictions": self.evictions,
+                "namespaces": {
+                    name: {"hits": self.hits[name], "misses": self.misses[name]} for name in namespaces
+                },
+            }
+
+
+cache = TTLCache()
+
+
+def cached(namespace):
+    """Cache a lookup by its positional arguments under ``namespace``."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            key = (namespace,) + args
+            value = cache.get(key)
+            if value is _MISSING:
+                epoch = cache.epoch()
+                value = func(*args)
+                cache.set(key, value, epoch)
+            return value
+        return wrapper
+    return decorator
+
+
+def invalidate(namespace, *args):
+    cache.invalidate((namespace,) + args)
+
+
+def stats():
+    return cache.stats()
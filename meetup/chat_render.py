@@ -0,0 +1,64 @@
+"""Chat rendering.
+
+The chat page shows only the most recent WINDOW messages, built into a
+single HTML fragment and sent with one ``st.markdown`` call. Messages never
+change once sent, so each bubble's escaped HTML is cached by message id and
+rendering cost depends on the window size, not on the chat length.
+"""
+import html
+import re
+from functools import lru_cache
+
+# Messages shown when a chat is opened, and added per "load older" click.
+WINDOW = 50
+
+_MINE = (
+    '<div style="display: flex; justify-content: flex-end; margin-bottom: 8px;">'
+    '<div style="background-color: #dcf8c6; padding: 10px; border-radius: 10px; max-width: 70%;">'
+    '{text}'
+    '<div style="font-size: 0.8em; color: #888; text-align: right;">{timestamp}</div>'
+    '</div></div>'
+)
+
+_THEIRS = (
+    '<div style="display: flex; justify-content: flex-start; margin-bottom: 8px;">'
+    '<div style="background-color: #f1f0f0; padding: 10px; border-radius: 10px; max-width: 70%;">'
+    '<strong>{username}</strong><br>'
+    '{text}'
+    '<div style="font-size: 0.8em; color: #888;">{timestamp}</div>'
+    '</div></div>'
+)
+
+
+def _escape(value):
+    return html.escape(str(value)).replace("\n", "<br>")
+
+
+@lru_cache(maxsize=20000)
+def _bubble(message_id, is_me, username, text, timestamp):
+    template = _MINE if is_me else _THEIRS
+    return template.format(username=_escape(username), text=_escape(text), timestamp=_escape(timestamp))
+
+
+def render_message(message, is_me):
+    return _bubble(message["message_id"], is_me, message["sender_username"], message["text"], message["timestamp"])
+
+
+def render_window(messages, user_id, window=WINDOW):
+    """HTML for the last ``window`` messages as one fragment."""
+    visible = messages[-window:] if window else messages
+    return "".join(render_message(m, m["sender_id"] == user_id) for m in visible)
+
+
+def highlight(text, terms):
+    """Escaped ``text`` with every occurrence of ``terms`` wrapped in <mark>."""
+    if not terms:
+        return _escape(text)
+    pattern = re.compile("|".join(re.escape(term) for term in sorted(terms, key=len, reverse=True)), re.I)
+    parts, last = [], 0
+    for found in pattern.finditer(text):
+        parts.append(_escape(text[last:found.start()]))
+        parts.append(f"<mark>{_escape(found.group())}</mark>")
+        last = found.end()
+    parts.append(_escape(text[last:]))
+    return "".join(parts)
@@ -0,0 +1,177 @@
+"""Shared SQLite connection layer.
+
+Every data-access function borrows a connection from a per-process pool
+instead of opening its own. Pooled connections are configured once (WAL
+journal, busy timeout, pragmas, statement cache) and handed to one thread at
+a time; nested borrows on the same thread reuse the connection already held.
+"""
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from meetup import metrics
+
+# Database file, overridable so tests, benchmarks and deployments can point
+# the app somewhere other than the working directory.
+DB_PATH = os.environ.get("MEETUP_DB_PATH", "meetup_app.db")
+
+# Seconds a connection waits on a locked database before raising.
+BUSY_TIMEOUT = float(os.environ.get("MEETUP_DB_BUSY_TIMEOUT", "5.0"))
+
+# Idle connections kept open per process.
+MAX_IDLE = int(os.environ.get("MEETUP_DB_POOL_SIZE", "8"))
+
+# Prepared statements cached per connection.
+STATEMENT_CACHE_SIZE = 256
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+class ConnectionPool:
+    def __init__(self, path, max_idle=MAX_IDLE, busy_timeout=BUSY_TIMEOUT):
+        self.path = path
+        self.max_idle = max_idle
+        self.busy_timeout = busy_timeout
+        self.pid = os.getpid()
+        self._idle = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+            factory=metrics.InstrumentedConnection,
+        )
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout * 1000)}")
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._connect()
+
+    def release(self, conn):
+        # Never hand out a connection with a half-finished transaction.
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    @contextmanager
+    def connection(self):
+        held = getattr(self._local, "conn", None)
+        if held is not None:
+            yield held
+            return
+
+        conn = self.acquire()
+        self._local.conn = conn
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            self.release(conn)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# Time spent waiting for the write lock in BEGIN IMMEDIATE, per process.
+_lock_waits = {"count": 0, "seconds": 0.0, "max_seconds": 0.0}
+_lock_waits_lock = threading.Lock()
+
+
+def configure(path=None, **options):
+    """Point the pool at a different database file and drop old connections."""
+    global DB_PATH, _pool
+    with _pool_lock:
+        if path is not None:
+            DB_PATH = path
+        if _pool is not None:
+            _pool.close()
+        _pool = ConnectionPool(DB_PATH, **options)
+    return _pool
+
+
+def get_pool():
+    global _pool
+    pool = _pool
+    # A forked child must not reuse its parent's sqlite handles.
+    if pool is None or pool.pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool.pid != os.getpid():
+                _pool = ConnectionPool(DB_PATH)
+            pool = _pool
+    return pool
+
+
+def connection():
+    """Borrow a pooled connection for the duration of a ``with`` block."""
+    return get_pool().connection()
+
+
+@contextmanager
+def transaction(immediate=False):
+    """Run the block in one transaction, committing on success.
+
+    ``immediate=True`` takes the database write lock up front (BEGIN
+    IMMEDIATE), so read-then-write sequences cannot interleave with another
+    writer. Nested use joins the enclosing transaction.
+    """
+    with connection() as conn:
+        if conn.in_transaction:
+            yield conn
+            return
+
+        if immediate:
+            started = time.perf_counter()
+            conn.execute("BEGIN IMMEDIATE")
+            _record_lock_wait(time.perf_counter() - started)
+        else:
+            conn.execute("BEGIN")
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+
+def _record_lock_wait(seconds):
+    with _lock_waits_lock:
+        _lock_waits["count"] += 1
+        _lock_waits["seconds"] += seconds
+        _lock_waits["max_seconds"] = max(_lock_waits["max_seconds"], seconds)
+
+
+def lock_wait_stats():
+    """Count, total and worst wait for the write lock in this process."""
+    with _lock_waits_lock:
+        return dict(_lock_waits)
+
+
+def reset_lock_wait_stats():
+    with _lock_waits_lock:
+        _lock_waits.update(count=0, seconds=0.0, max_seconds=0.0)
@@ -0,0 +1,121 @@
+"""Station coordinates and the spatial grid used for radius matching.
+
+Requests name a station; its coordinates come from the offline STATIONS
+table below, so nothing is geocoded at request time. Each point also gets a
+grid cell: the world is cut into CELL_DEGREES squares and a cell is one
+integer, stored in ``requests.cell`` and indexed. Everything within a
+radius of a point lies in the few cells ``neighbourhood`` returns, so a
+candidate search reads those cells only, however many stations and
+requests there are. Exact distances are checked on what the cells yield.
+"""
+import math
+import os
+
+# Approximate station coordinates (latitude, longitude), busiest first;
+# the request form lists them in this order.
+STATIONS = {
+    "新宿": (35.6896, 139.7006),
+    "渋谷": (35.6580, 139.7016),
+    "池袋": (35.7295, 139.7109),
+    "東京": (35.6812, 139.7671),
+    "品川": (35.6285, 139.7388),
+    "上野": (35.7138, 139.7773),
+    "秋葉原": (35.6984, 139.7731),
+    "高田馬場": (35.7126, 139.7038),
+    "早稲田": (35.7056, 139.7215),
+    "飯田橋": (35.7020, 139.7450),
+    "御茶ノ水": (35.6996, 139.7650),
+    "神田": (35.6917, 139.7709),
+    "有楽町": (35.6751, 139.7630),
+    "銀座": (35.6717, 139.7650),
+    "新橋": (35.6663, 139.7583),
+    "四ツ谷": (35.6860, 139.7302),
+    "赤坂": (35.6724, 139.7363),
+    "六本木": (35.6628, 139.7315),
+    "代々木": (35.6830, 139.7020),
+    "原宿": (35.6702, 139.7027),
+    "恵比寿": (35.6467, 139.7101),
+    "中目黒": (35.6441, 139.6990),
+    "目黒": (35.6339, 139.7157),
+    "五反田": (35.6258, 139.7238),
+    "大崎": (35.6197, 139.7286),
+    "浅草": (35.7111, 139.7966),
+    "錦糸町": (35.6967, 139.8143),
+    "北千住": (35.7497, 139.8049),
+    "中野": (35.7056, 139.6657),
+    "荻窪": (35.7045, 139.6200),
+    "吉祥寺": (35.7031, 139.5798),
+    "国分寺": (35.7000, 139.4806),
+    "立川": (35.6980, 139.4137),
+    "下北沢": (35.6613, 139.6680),
+    "三軒茶屋": (35.6437, 139.6705),
+    "自由が丘": (35.6077, 139.6687),
+    "町田": (35.5421, 139.4455),
+    "川崎": (35.5313, 139.6968),
+    "横浜": (35.4660, 139.6223),
+    "大宮": (35.9064, 139.6239),
+}
+
+# Grid cell size in degrees (about 2.2 km north-south, 1.8 km east-west in
+# Tokyo). Cells are stored in requests.cell, so changing this needs the
+# column recomputed.
+CELL_DEGREES = 0.02
+_COLUMNS = round(360 / CELL_DEGREES)
+
+# Requests are matched with partners at most this far away.
+RADIUS_KM = float(os.environ.get("MEETUP_MATCH_RADIUS_KM", "2.0"))
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def locate(area):
+    """``(lat, lon)`` of a station, or None for a name not in the table."""
+    return STATIONS.get(area)
+
+
+def _row(lat):
+    return math.floor((lat + 90) / CELL_DEGREES)
+
+
+def _column(lon):
+    return math.floor((lon + 180) / CELL_DEGREES) % _COLUMNS
+
+
+def cell_of(lat, lon):
+    return _row(lat) * _COLUMNS + _column(lon)
+
+
+def bounding_box(lat, lon, radius_km=RADIUS_KM):
+    """``(min_lat, max_lat, min_lon, max_lon)`` enclosing the circle."""
+    dlat = radius_km / KM_PER_DEGREE
+    dlon = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+    return lat - dlat, lat + dlat, lon - dlon, lon + dlon
+
+
+def neighbourhood(lat, lon, radius_km=RADIUS_KM):
+    """Every cell that may hold a point within ``radius_km`` of (lat, lon)."""
+    min_lat, max_lat, min_lon, max_lon = bounding_box(lat, lon, radius_km)
+    columns = range(math.floor((min_lon + 180) / CELL_DEGREES), math.floor((max_lon + 180) / CELL_DEGREES) + 1)
+    return [
+        row * _COLUMNS + column % _COLUMNS
+        for row in range(_row(min_lat), _row(max_lat) + 1)
+        for column in columns
+    ]
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance (haversine)."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def nearby_stations(area, radius_km=RADIUS_KM):
+    """Stations within ``radius_km`` of ``area``, nearest first, with distances."""
+    origin = locate(area)
+    if origin is None:
+        return [(area, 0.0)]
+    found = [(name, distance_km(*origin, *point)) for name, point in STATIONS.items()]
+    return sorted((item for item in found if item[1] <= radius_km), key=lambda item: item[1])
@@ -0,0 +1,289 @@
+"""In-memory matching engine.
+
+Requests are matched with the opposite gender in the same time slot within
+geo.RADIUS_KM of their station. Pending requests live in FIFO queues keyed
+by (grid cell, time_slot, gender), so finding a partner walks the queues of
+the few cells around the request (see geo.neighbourhood), oldest first,
+rather than every pending row. Requests for an area without coordinates
+queue under the area name and only match that exact name. When the queues
+yield nobody, one indexed lookup checks for requests queued by other server
+processes. SQLite stays the source of truth: the queues are rebuilt from it
+when the engine starts, and every pairing is
+persisted in one BEGIN IMMEDIATE transaction whose conditional UPDATE only
+succeeds while both requests are still pending. Together with the engine
+lock this means a request is never matched twice, even under parallel load.
+"""
+import heapq
+import os
+import threading
+from collections import defaultdict, deque, namedtuple
+
+from meetup import cache, db, geo, notify, versions
+
+# "instant" pairs a request as soon as it arrives; "batch" only queues it and
+# leaves pairing to the periodic scheduler in meetup.scheduler.
+MODE = os.environ.get("MEETUP_MATCHING_MODE", "instant")
+
+PendingRequest = namedtuple(
+    "PendingRequest", "request_id user_id gender area time_slot group_size created_at lat lon"
+)
+
+
+class AlreadyPending(Exception):
+    """The user already has a request waiting for a match."""
+
+
+def opposite_gender(gender):
+    return "女性" if gender == "男性" else "男性"
+
+
+def _place(area, lat, lon):
+    # Queue key part for a location: its grid cell, or the bare area name.
+    return geo.cell_of(lat, lon) if lat is not None else area
+
+
+def _places(area, lat, lon):
+    # Queue key parts that can hold a partner for this location.
+    return geo.neighbourhood(lat, lon) if lat is not None else [area]
+
+
+def _in_reach(request, lat, lon):
+    if request.lat is None or lat is None:
+        return True  # matched by area name alone
+    return geo.distance_km(request.lat, request.lon, lat, lon) <= geo.RADIUS_KM
+
+
+class MatchingEngine:
+    def __init__(self, path=None, instant=None):
+        self.path = path or db.DB_PATH
+        self.instant = MODE != "batch" if instant is None else instant
+        self.pid = os.getpid()
+        self._lock = threading.RLock()
+        self._queues = defaultdict(deque)
+        self._pending = {}
+
+    def rebuild(self):
+        """Reload every pending request from SQLite, oldest first."""
+        with self._lock:
+            self._queues.clear()
+            self._pending.clear()
+            with db.connection() as conn:
+                rows = conn.execute("""
+                SELECT r.request_id, r.user_id, u.gender, r.area, r.time_slot, r.group_size, r.created_at, r.lat, r.lon
+                FROM requests r
+                JOIN users u ON r.user_id = u.user_id
+                WHERE r.status = 'pending'
+                ORDER BY r.created_at, r.request_id
+                """).fetchall()
+            for row in rows:
+                self._enqueue(PendingRequest(*row))
+
+    def _enqueue(self, request):
+        self._pending[request.request_id] = request
+        key = (_place(request.area, request.lat, request.lon), request.time_slot, request.gender)
+        self._queues[key].append(request.request_id)
+
+    def _head(self, key):
+        # Cancelled or externally matched requests are removed from
+        # _pending only; drop their queue entries lazily when they surface.
+        queue = self._queues.get(key)
+        while queue:
+            request = self._pending.get(queue[0])
+            if request is not None:
+                return request
+            queue.popleft()
+        return None
+
+    def _reachable(self, key, user_id, lat, lon):
+        # Live requests of one queue that are close enough, oldest first.
+        self._head(key)
+        for candidate_id in self._queues.get(key, ()):
+            candidate = self._pending.get(candidate_id)
+            if candidate is not None and candidate.user_id != user_id and _in_reach(candidate, lat, lon):
+                yield candidate
+
+    def candidates(self, user_id, area, lat, lon, time_slot, gender):
+        """Queued requests ``user_id`` could be paired with, oldest first."""
+        with self._lock:
+            queues = [
+                self._reachable((place, time_slot, gender), user_id, lat, lon)
+                for place in _places(area, lat, lon)
+            ]
+            return heapq.merge(*queues, key=lambda r: (r.created_at, r.request_id))
+
+    def discard(self, request_id):
+        """Forget a request that is no longer pending (cancelled, expired...)."""
+        with self._lock:
+            self._pending.pop(request_id, None)
+
+    def snapshot(self):
+        """Every request currently waiting, as PendingRequest tuples."""
+        with self._lock:
+            return list(self._pending.values())
+
+    def submit(self, user_id, area, time_slot, group_size):
+        """Persist a new request and pair it with the oldest compatible one.
+
+        Returns ``(request_id, match_id)``; ``match_id`` is None while the
+        request waits. Raises AlreadyPending if the user is already waiting.
+        """
+        with self._lock:
+            with db.transaction(immediate=True) as conn:
+                c = conn.cursor()
+                c.execute("SELECT request_id FROM requests WHERE user_id = ? AND status = 'pending'", (user_id,))
+                if c.fetchone():
+                    raise AlreadyPending(user_id)
+
+                c.execute("SELECT gender FROM users WHERE user_id = ?", (user_id,))
+                gender = c.fetchone()[0]
+
+                lat, lon = geo.locate(area) or (None, None)
+                c.execute("""
+                INSERT INTO requests (user_id, area, time_slot, group_size, status, lat, lon, cell)
+                VALUES (?, ?, ?, ?, 'pending', ?, ?, ?)
+                """, (user_id, area, time_slot, group_size, lat, lon, None if lat is None else geo.cell_of(lat, lon)))
+                request_id = c.lastrowid
+                c.execute("SELECT created_at FROM requests WHERE request_id = ?", (request_id,))
+                created_at = c.fetchone()[0]
+                request = PendingRequest(request_id, user_id, gender, area, time_slot, group_size, created_at, lat, lon)
+
+                partner, match_id, stale = None, None, []
+                if self.instant:
+                    partner, match_id, stale = self._pair(c, request)
+                bumped = versions.bump(c, notify.user_topic(user_id),
+                                       *([notify.user_topic(partner.user_id)] if partner else []))
+
+            # Only touch the queues once the transaction has committed.
+            for request_id_gone in stale:
+                self._pending.pop(request_id_gone, None)
+            cache.invalidate(cache.PENDING_REQUEST, user_id)
+            if partner is not None:
+                self._pending.pop(partner.request_id, None)
+                self._matched([user_id, partner.user_id], bumped)
+            else:
+                self._enqueue(request)
+                versions.publish(bumped)
+            return request_id, match_id
+
+    def _pair(self, c, request):
+        stale = []
+        gender = opposite_gender(request.gender)
+        candidates = self.candidates(request.user_id, request.area, request.lat, request.lon, request.time_slot, gender)
+        for candidate in candidates:
+            # Another process may have matched or cancelled the candidate.
+            c.execute("UPDATE requests SET status = 'matched' WHERE request_id = ? AND status = 'pending'",
+                      (candidate.request_id,))
+            if c.rowcount != 1:
+                stale.append(candidate.request_id)
+                continue
+
+            c.execute("UPDATE requests SET status = 'matched' WHERE request_id = ?", (request.request_id,))
+            c.execute("INSERT INTO matches (request_id_1, request_id_2) VALUES (?, ?)",
+                      (candidate.request_id, request.request_id))
+            return candidate, c.lastrowid, stale
+
+        # Requests queued by another process never reach our queues. These
+        # indexed lookups find them; with a single process they find nothing.
+        for candidate in self._stored_candidates(c, request, gender):
+            c.execute("UPDATE requests SET status = 'matched' WHERE request_id IN (?, ?)",
+                      (candidate.request_id, request.request_id))
+            c.execute("INSERT INTO matches (request_id_1, request_id_2) VALUES (?, ?)",
+                      (candidate.request_id, request.request_id))
+            return candidate, c.lastrowid, stale
+        return None, None, stale
+
+    def _stored_candidates(self, c, request, gender):
+        select = """
+        SELECT r.request_id, r.user_id, u.gender, r.area, r.time_slot, r.group_size, r.created_at, r.lat, r.lon
+        FROM requests r
+        JOIN users u ON r.user_id = u.user_id
+        WHERE r.status = 'pending'
+        """
+        if request.lat is None:
+            c.execute(select + """
+            AND r.area = ? AND r.time_slot = ? AND r.user_id != ? AND u.gender = ?
+            ORDER BY r.created_at ASC
+            LIMIT 1
+            """, (request.area, request.time_slot, request.user_id, gender))
+            yield from map(PendingRequest._make, c.fetchall())
+            return
+
+        # The bounding box trims the cells' corners; the exact distance is
+        # checked on the way out, oldest first.
+        cells = geo.neighbourhood(request.lat, request.lon)
+        min_lat, max_lat, min_lon, max_lon = geo.bounding_box(request.lat, request.lon)
+        c.execute(select + f"""
+        AND r.cell IN ({",".join("?" * len(cells))}) AND r.time_slot = ?
+        AND r.lat BETWEEN ? AND ? AND r.lon BETWEEN ? AND ?
+        AND r.user_id != ? AND u.gender = ?
+        ORDER BY r.created_at ASC, r.request_id ASC
+        """, (*cells, request.time_slot, min_lat, max_lat, min_lon, max_lon, request.user_id, gender))
+        for row in c.fetchall():
+            candidate = PendingRequest._make(row)
+            if _in_reach(candidate, request.lat, request.lon):
+                yield candidate
+                return
+
+    def _matched(self, user_ids, bumped):
+        for user_id in user_ids:
+            cache.invalidate(cache.PENDING_REQUEST, user_id)
+            cache.invalidate(cache.USER_MATCHES, user_id)
+        versions.publish(bumped)
+
+    def pair_many(self, pairs):
+        """Persist pairs chosen by a batch run in a single transaction.
+
+        ``pairs`` holds ``(older_request_id, newer_request_id)`` tuples. A pair
+        is skipped if either side stopped being pending in the meantime.
+        Returns the ``(request_id_1, request_id_2, match_id)`` rows created.
+        """
+        made = []
+        stale = set()
+        topics = set()
+        with self._lock:
+            with db.transaction(immediate=True) as conn:
+                c = conn.cursor()
+                for first, second in pairs:
+                    c.execute("SAVEPOINT pair")
+                    c.execute("UPDATE requests SET status = 'matched' WHERE request_id IN (?, ?) AND status = 'pending'",
+                              (first, second))
+                    if c.rowcount != 2:
+                        c.execute("ROLLBACK TO pair")
+                        c.execute("RELEASE pair")
+                        c.execute("SELECT request_id FROM requests WHERE request_id IN (?, ?) AND status = 'pending'",
+                                  (first, second))
+                        still_pending = {row[0] for row in c.fetchall()}
+                        stale.update({first, second} - still_pending)
+                        continue
+                    c.execute("INSERT INTO matches (request_id_1, request_id_2) VALUES (?, ?)", (first, second))
+                    made.append((first, second, c.lastrowid))
+                    c.execute("RELEASE pair")
+                    c.execute("SELECT user_id FROM requests WHERE request_id IN (?, ?)", (first, second))
+                    topics.update(notify.user_topic(row[0]) for row in c.fetchall())
+                bumped = versions.bump(c, *topics)
+
+            users = []
+            for first, second, _ in made:
+                users += [r.user_id for r in (self._pending.pop(first, None), self._pending.pop(second, None)) if r]
+            self._matched(users, bumped)
+            for request_id in stale:
+                self._pending.pop(request_id, None)
+        return made
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """The process-wide engine for the configured database, built on first use."""
+    global _engine
+    engine = _engine
+    if engine is None or engine.path != db.DB_PATH or engine.pid != os.getpid():
+        with _engine_lock:
+            if _engine is None or _engine.path != db.DB_PATH or _engine.pid != os.getpid():
+                engine = MatchingEngine()
+                engine.rebuild()
+                _engine = engine
+            engine = _engine
+    return engine
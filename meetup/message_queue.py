@@ -0,0 +1,226 @@
+"""Write-behind pipeline for chat messages.
+
+``send_message`` hands its row to a per-process writer thread and waits for
+the acknowledgement. The writer takes messages off a bounded queue and
+gathers up to BATCH_SIZE of them: those already queued plus any arriving
+within BATCH_LATENCY seconds of the first. It then inserts the whole batch in one
+transaction, so one fsync and one hold of the write lock cover every
+message in it. Each sender is acknowledged with its message id once that
+commit is durable; the writer's connection runs with ``synchronous=FULL``.
+The same transaction bumps the change versions of the chats and of their
+participants, whose match lists show unread counts and previews; after the
+commit those lists are invalidated and the versions published.
+
+A full queue blocks senders, which gives backpressure instead of unbounded
+memory. On shutdown the writer drains what is queued before exiting.
+"""
+import atexit
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+from meetup import cache, db, metrics, notify, versions
+
+logger = logging.getLogger(__name__)
+
+# Set to 0 to insert each message synchronously on the caller's thread.
+ENABLED = os.environ.get("MEETUP_MESSAGE_WRITE_BEHIND", "1") != "0"
+
+# Most messages committed together, and the longest a message waits for
+# company before its batch is written. With 0 a batch is whatever queued up
+# while the previous commit ran, which already groups well under load
+# because senders block on their acknowledgement.
+BATCH_SIZE = int(os.environ.get("MEETUP_MESSAGE_BATCH_SIZE", "64"))
+BATCH_LATENCY = float(os.environ.get("MEETUP_MESSAGE_BATCH_LATENCY", "0"))
+
+# Messages waiting for the writer before senders block.
+QUEUE_SIZE = int(os.environ.get("MEETUP_MESSAGE_QUEUE_SIZE", "1024"))
+
+# Seconds a sender waits for a queue slot and then for its acknowledgement.
+ACK_TIMEOUT = float(os.environ.get("MEETUP_MESSAGE_ACK_TIMEOUT", "10"))
+
+INSERT = "INSERT INTO messages (match_id, sender_user_id, message_text) VALUES (?, ?, ?)"
+
+_STOP = object()
+
+
+class MessageWriter(threading.Thread):
+    def __init__(self, batch_size=BATCH_SIZE, batch_latency=BATCH_LATENCY, queue_size=QUEUE_SIZE):
+        super().__init__(name="message-writer", daemon=True)
+        self.path = db.DB_PATH
+        self.pid = os.getpid()
+        self.batch_size = batch_size
+        self.batch_latency = batch_latency
+        self._queue = queue.Queue(queue_size)
+        self._stopping = False
+        self.batches = 0
+        self.written = 0
+
+    def submit(self, match_id, sender_id, message_text, timeout=ACK_TIMEOUT):
+        """Queue one message; the returned future resolves to its message_id."""
+        if self._stopping:
+            raise RuntimeError("message writer is shut down")
+        future = Future()
+        self._queue.put((future, (match_id, sender_id, message_text)), timeout=timeout)
+        return future
+
+    def run(self):
+        metrics.set_page("message-writer")
+        with db.connection() as conn:
+            conn.execute("PRAGMA synchronous=FULL")
+            try:
+                while True:
+                    batch, stop = self._next_batch()
+                    if batch:
+                        self._write(batch)
+                    if stop:
+                        return
+            finally:
+                conn.execute("PRAGMA synchronous=NORMAL")
+
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is _STOP:
+            return self._drain(), True
+        batch = [first]
+        deadline = time.monotonic() + self.batch_latency
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch + self._drain(), True
+            batch.append(item)
+        return batch, False
+
+    def _drain(self):
+        items = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return items
+            if item is not _STOP:
+                items.append(item)
+
+    def _write(self, batch):
+        match_ids = {row[0] for _, row in batch}
+        try:
+            with db.transaction(immediate=True) as conn:
+                ids = [conn.execute(INSERT, row).lastrowid for _, row in batch]
+                user_ids = participants(conn, match_ids)
+                bumped = bump(conn, match_ids, user_ids)
+        except sqlite3.Error:
+            # Retry one by one so a single bad row fails only its own sender.
+            logger.exception("message batch of %d failed; retrying individually", len(batch))
+            for future, row in batch:
+                self._write_one(future, row)
+            return
+
+        self.batches += 1
+        self.written += len(batch)
+        delivered(user_ids, bumped)
+        for (future, _), message_id in zip(batch, ids):
+            future.set_result(message_id)
+
+    def _write_one(self, future, row):
+        try:
+            with db.transaction(immediate=True) as conn:
+                message_id = conn.execute(INSERT, row).lastrowid
+                user_ids = participants(conn, [row[0]])
+                bumped = bump(conn, [row[0]], user_ids)
+        except sqlite3.Error as exc:
+            future.set_exception(exc)
+            return
+        self.written += 1
+        delivered(user_ids, bumped)
+        future.set_result(message_id)
+
+    def stop(self, timeout=ACK_TIMEOUT):
+        """Flush everything queued so far and stop the thread."""
+        self._stopping = True
+        self._queue.put(_STOP)
+        self.join(timeout)
+
+
+def participants(conn, match_ids):
+    """Both users of each match in ``match_ids``."""
+    match_ids = list(match_ids)
+    marks = ",".join("?" * len(match_ids))
+    return {row[0] for row in conn.execute(f"""
+    SELECT r.user_id FROM matches m
+    JOIN requests r ON r.request_id IN (m.request_id_1, m.request_id_2)
+    WHERE m.match_id IN ({marks})
+    """, match_ids)}
+
+
+def bump(conn, match_ids, user_ids):
+    # Match lists carry unread counts and previews, so the participants'
+    # versions move along with the chats'.
+    return versions.bump(conn, *map(notify.match_topic, match_ids), *map(notify.user_topic, user_ids))
+
+
+def delivered(user_ids, bumped):
+    for user_id in user_ids:
+        cache.invalidate(cache.USER_MATCHES, user_id)
+    versions.publish(bumped)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """The process-wide writer for the configured database, started on first use."""
+    global _writer
+    writer = _writer
+    if writer is None or writer.path != db.DB_PATH or writer.pid != os.getpid() or not writer.is_alive():
+        with _writer_lock:
+            if _writer is None or _writer.path != db.DB_PATH or _writer.pid != os.getpid() or not _writer.is_alive():
+                if _writer is not None and _writer.pid == os.getpid() and _writer.is_alive():
+                    _writer.stop()
+                _writer = MessageWriter()
+                _writer.start()
+            writer = _writer
+    return writer
+
+
+def send(match_id, sender_id, message_text):
+    """Store one message durably and return its id."""
+    if not ENABLED:
+        with db.transaction(immediate=True) as conn:
+            message_id = conn.execute(INSERT, (match_id, sender_id, message_text)).lastrowid
+            user_ids = participants(conn, [match_id])
+            bumped = bump(conn, [match_id], user_ids)
+        delivered(user_ids, bumped)
+        return message_id
+    return get_writer().submit(match_id, sender_id, message_text).result(ACK_TIMEOUT)
+
+
+@contextmanager
+def synchronous():
+    """Write messages on the calling thread for the duration of the block.
+
+    Tools that trace or count the statements run on their own connection
+    (benchmarks.query_plans, benchmarks.run) would otherwise miss the writer's.
+    """
+    global ENABLED
+    previous, ENABLED = ENABLED, False
+    try:
+        yield
+    finally:
+        ENABLED = previous
+
+
+@atexit.register
+def shutdown():
+    writer = _writer
+    if writer is not None and writer.pid == os.getpid() and writer.is_alive():
+        writer.stop()
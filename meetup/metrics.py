@@ -0,0 +1,337 @@
+"""Hot-path instrumentation.
+
+Records wall time, query count and rows returned for every page rerun,
+every data-access function (``@timed``) and every SQL statement, which
+pooled connections report through InstrumentedConnection. Every
+measurement is attributed to the page being rendered (set with
+``set_page``). It goes into a rolling histogram: the last WINDOWS windows of
+WINDOW_SECONDS each, with log-scale latency buckets. Memory therefore stays
+fixed however long the server runs.
+
+``snapshot()`` returns the aggregated rows for the admin page, and
+``start_dumper`` writes them to a JSON or CSV file periodically.
+"""
+import bisect
+import contextvars
+import csv
+import functools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+WINDOW_SECONDS = 60
+WINDOWS = 15
+
+# Upper bounds of the latency buckets, in milliseconds.
+BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, float("inf"))
+
+# Distinct SQL texts tracked; anything beyond is folded into one row.
+MAX_STATEMENTS = 500
+
+_page = contextvars.ContextVar("metrics_page", default="background")
+_call = contextvars.ContextVar("metrics_call", default=None)
+
+
+class _Window:
+    __slots__ = ("start", "counts", "calls", "seconds", "queries", "rows")
+
+    def __init__(self, start):
+        self.start = start
+        self.counts = [0] * len(BUCKETS_MS)
+        self.calls = 0
+        self.seconds = 0.0
+        self.queries = 0
+        self.rows = 0
+
+
+class RollingHistogram:
+    def __init__(self):
+        self._windows = deque(maxlen=WINDOWS)
+
+    def _current(self, now):
+        start = now - now % WINDOW_SECONDS
+        if not self._windows or self._windows[-1].start != start:
+            self._windows.append(_Window(start))
+        return self._windows[-1]
+
+    def add(self, seconds, queries=0, rows=0, now=None):
+        window = self._current(now or time.time())
+        window.counts[bisect.bisect_left(BUCKETS_MS, seconds * 1000)] += 1
+        window.calls += 1
+        window.seconds += seconds
+        window.queries += queries
+        window.rows += rows
+
+    def add_rows(self, rows, now=None):
+        self._current(now or time.time()).rows += rows
+
+    def summary(self, now=None):
+        horizon = (now or time.time()) - WINDOW_SECONDS * WINDOWS
+        counts = [0] * len(BUCKETS_MS)
+        calls = queries = rows = 0
+        seconds = 0.0
+        for window in self._windows:
+            if window.start < horizon:
+                continue
+            for i, count in enumerate(window.counts):
+                counts[i] += count
+            calls += window.calls
+            seconds += window.seconds
+            queries += window.queries
+            rows += window.rows
+        if not calls:
+            return None
+        return {
+            "calls": calls,
+            "total_ms": round(seconds * 1000, 3),
+            "mean_ms": round(seconds * 1000 / calls, 3),
+            "p50_ms": _quantile(counts, calls, 0.50),
+            "p95_ms": _quantile(counts, calls, 0.95),
+            "p99_ms": _quantile(counts, calls, 0.99),
+            "queries_per_call": round(queries / calls, 2),
+            "rows_per_call": round(rows / calls, 2),
+        }
+
+
+def _quantile(counts, total, fraction):
+    # Upper bound of the bucket holding the quantile; the last bucket has
+    # no bound, so report the largest finite one.
+    target = fraction * total
+    seen = 0
+    for bound, count in zip(BUCKETS_MS, counts):
+        seen += count
+        if seen >= target:
+            return bound if bound != float("inf") else BUCKETS_MS[-2]
+    return BUCKETS_MS[-2]
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def series(self, kind, page, name):
+        key = (kind, page, name)
+        series = self._series.get(key)
+        if series is None:
+            with self._lock:
+                if kind == "sql" and key not in self._series:
+                    tracked = sum(1 for k in self._series if k[0] == "sql")
+                    if tracked >= MAX_STATEMENTS:
+                        key = (kind, page, "(other statements)")
+                series = self._series.setdefault(key, RollingHistogram())
+        return series
+
+    def record(self, kind, name, seconds, queries=0, rows=0):
+        series = self.series(kind, _page.get(), name)
+        with self._lock:
+            series.add(seconds, queries, rows)
+
+    def record_rows(self, kind, page, name, rows):
+        series = self.series(kind, page, name)
+        with self._lock:
+            series.add_rows(rows)
+
+    def snapshot(self):
+        with self._lock:
+            items = list(self._series.items())
+            rows = []
+            for (kind, page, name), series in items:
+                summary = series.summary()
+                if summary:
+                    rows.append({"kind": kind, "page": page, "name": name, **summary})
+        rows.sort(key=lambda r: r["total_ms"], reverse=True)
+        return rows
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+
+registry = Registry()
+
+
+def set_page(page):
+    """Attribute everything recorded on this thread to ``page`` from now on."""
+    _page.set(page)
+
+
+class rerun:
+    """Context manager timing one whole page render."""
+
+    def __init__(self, page):
+        self.page = page
+
+    def __enter__(self):
+        set_page(self.page)
+        self._counter = [0, 0]
+        self._token = _call.set(self._counter)
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self._started
+        _call.reset(self._token)
+        registry.record("rerun", self.page, elapsed, *self._counter)
+        return False
+
+
+def timed(func):
+    """Record wall time, queries and rows of each call to a data-access function."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        outer = _call.get()
+        counter = [0, 0]
+        token = _call.set(counter)
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            _call.reset(token)
+            if outer is not None:
+                outer[0] += counter[0]
+                outer[1] += counter[1]
+            registry.record("function", func.__name__, elapsed, *counter)
+    return wrapper
+
+
+def _statement_key(sql):
+    text = " ".join(sql.split())
+    return text if len(text) <= 200 else text[:197] + "..."
+
+
+def _count_query():
+    counter = _call.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+def _count_rows(page, key, rows):
+    counter = _call.get()
+    if counter is not None:
+        counter[1] += rows
+    registry.record_rows("sql", page, key, rows)
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    _metrics_key = None
+    _metrics_page = None
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._observe(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._observe(sql, time.perf_counter() - started)
+
+    def _observe(self, sql, elapsed):
+        self._metrics_key = _statement_key(sql)
+        self._metrics_page = _page.get()
+        _count_query()
+        registry.record("sql", self._metrics_key, elapsed)
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None and self._metrics_key:
+            _count_rows(self._metrics_page, self._metrics_key, 1)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        if rows and self._metrics_key:
+            _count_rows(self._metrics_page, self._metrics_key, len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        if rows and self._metrics_key:
+            _count_rows(self._metrics_page, self._metrics_key, len(rows))
+        return rows
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection whose cursors report every statement to the registry."""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def snapshot():
+    return registry.snapshot()
+
+
+FIELDS = ("kind", "page", "name", "calls", "total_ms", "mean_ms", "p50_ms", "p95_ms", "p99_ms",
+          "queries_per_call", "rows_per_call")
+
+
+def dump(path):
+    """Write the current snapshot to ``path``; CSV if it ends in .csv, else JSON."""
+    rows = snapshot()
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8", newline="") as fh:
+        if path.endswith(".csv"):
+            writer = csv.DictWriter(fh, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+        else:
+            json.dump({"generated_at": time.time(), "rows": rows}, fh, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+DUMP_PATH = os.environ.get("MEETUP_METRICS_DUMP")
+DUMP_INTERVAL = float(os.environ.get("MEETUP_METRICS_DUMP_INTERVAL", "60"))
+
+
+class MetricsDumper(threading.Thread):
+    def __init__(self, path, interval=DUMP_INTERVAL):
+        super().__init__(name="metrics-dumper", daemon=True)
+        self.path = path
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                dump(self.path)
+            except OSError:
+                logger.exception("could not write metrics to %s", self.path)
+
+    def stop(self):
+        self._stop_event.set()
+
+
+_dumper = None
+_dumper_lock = threading.Lock()
+
+
+def start_dumper(path=None, interval=None):
+    """Start the process-wide dumper once if a dump path is configured."""
+    global _dumper
+    path = path or DUMP_PATH
+    if not path:
+        return None
+    with _dumper_lock:
+        if _dumper is None or not _dumper.is_alive():
+            _dumper = MetricsDumper(path, interval or DUMP_INTERVAL)
+            _dumper.start()
+        return _dumper
@@ -0,0 +1,37 @@
+"""In-process notification hub.
+
+Topics are ``match_topic(match_id)`` and ``user_topic(user_id)``, each with
+a counter. Writers advance the counters to the versions they stored in
+``change_versions`` (see meetup.versions), so the hub mirrors the database.
+Sessions remember the counters they last rendered with and compare them on a
+short timer, and a page only reruns when one of its topics actually changed.
+"""
+import threading
+from collections import defaultdict
+
+
+def match_topic(match_id):
+    return ("match", match_id)
+
+
+def user_topic(user_id):
+    return ("user", user_id)
+
+
+class Hub:
+    def __init__(self):
+        self._versions = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def advance(self, versions):
+        """Move topics forward to the given ``{topic: version}``, never backwards."""
+        with self._lock:
+            for topic, version in versions.items():
+                if version > self._versions.get(topic, 0):
+                    self._versions[topic] = version
+
+    def version(self, topic):
+        return self._versions.get(topic, 0)
+
+
+hub = Hub()
@@ -0,0 +1,231 @@
+"""Salted scrypt password hashes, computed on a bounded worker pool.
+
+Hashes are stored as ``scrypt$<cost>$<r>$<p>$<salt>$<hash>``, where n is
+``2 ** cost`` and salt and hash are base64. scrypt is slow and memory-hard
+on purpose, so its work goes to one small pool shared by every session in
+the process. WORKERS caps how much CPU and memory a burst of logins can
+take: the attempts queue while the other sessions' reruns keep going.
+hashlib.scrypt releases the GIL, so the workers really do run in parallel.
+
+Accounts created before this module hold an unsalted SHA-256 hex digest.
+``verify`` still accepts one but reports that it needs rehashing, and
+login_user then stores a scrypt hash in its place. Hashes made with an
+older COST are upgraded the same way.
+
+Login attempts are counted per username in memory, from before their
+hash is queued. Once failed plus still-running attempts reach MAX_FAILURES
+within LOCKOUT_SECONDS, further attempts for that name are rejected before
+any database or scrypt work until the window has passed. The counters are
+per server process.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# scrypt parameters: n = 2 ** COST (about 16 MB and tens of ms at 14).
+COST = int(os.environ.get("MEETUP_SCRYPT_COST", "14"))
+BLOCK_SIZE, PARALLELISM = 8, 1
+SALT_BYTES, HASH_BYTES = 16, 32
+
+# Hashes computed at once, per process.
+WORKERS = int(os.environ.get("MEETUP_PASSWORD_WORKERS", "2"))
+
+# Failed logins allowed per username before it is locked out for a while.
+MAX_FAILURES = int(os.environ.get("MEETUP_LOGIN_MAX_FAILURES", "5"))
+LOCKOUT_SECONDS = float(os.environ.get("MEETUP_LOGIN_LOCKOUT_SECONDS", "300"))
+
+PREFIX = "scrypt"
+
+
+def legacy_hash(password):
+    """The unsalted SHA-256 digest accounts were created with originally."""
+    return hashlib.sha256(password.encode()).hexdigest()
+
+
+def is_legacy(stored):
+    return not stored.startswith(PREFIX + "$")
+
+
+# Worker pool
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# Hashes computed and time spent queueing for and inside the pool.
+_stats = {"hashes": 0, "queued_seconds": 0.0, "max_queued_ms": 0.0, "hash_seconds": 0.0}
+_stats_lock = threading.Lock()
+
+
+def _executor():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="password")
+        return _pool
+
+
+def configure(cost=None, workers=None):
+    """Change the cost or pool width, e.g. from a benchmark; waits for running hashes."""
+    global COST, WORKERS, _pool
+    with _pool_lock:
+        if cost is not None:
+            COST = cost
+        if workers is not None:
+            WORKERS = workers
+        if _pool is not None:
+            _pool.shutdown(wait=True)
+            _pool = None
+
+
+def _scrypt(password, salt, cost, r, p, length, submitted):
+    started = time.perf_counter()
+    n = 1 << cost
+    derived = hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, dklen=length,
+                             maxmem=128 * r * (n + p + 2) + 1024 * 1024)
+    finished = time.perf_counter()
+    with _stats_lock:
+        _stats["hashes"] += 1
+        _stats["queued_seconds"] += started - submitted
+        _stats["max_queued_ms"] = max(_stats["max_queued_ms"], (started - submitted) * 1000)
+        _stats["hash_seconds"] += finished - started
+    return derived
+
+
+def _derive(password, salt, cost, r, p, length):
+    return _executor().submit(_scrypt, password, salt, cost, r, p, length, time.perf_counter()).result()
+
+
+def stats():
+    with _stats_lock:
+        result = dict(_stats)
+    result.update(cost=COST, workers=WORKERS, limiter=limiter.stats())
+    return result
+
+
+# Hashing and checking
+
+def _b64(raw):
+    return base64.b64encode(raw).decode("ascii")
+
+
+def hash_password(password):
+    """A new salted scrypt hash of ``password`` at the current COST."""
+    salt = os.urandom(SALT_BYTES)
+    derived = _derive(password, salt, COST, BLOCK_SIZE, PARALLELISM, HASH_BYTES)
+    return f"{PREFIX}${COST}${BLOCK_SIZE}${PARALLELISM}${_b64(salt)}${_b64(derived)}"
+
+
+_dummy = None
+
+
+def _check_dummy(password):
+    # Spend one scrypt check at the current cost on a throwaway hash.
+    global _dummy
+    if _dummy is None:
+        _dummy = hash_password(os.urandom(8).hex())
+    verify(password, _dummy)
+
+
+def verify(password, stored):
+    """``(matches, needs_rehash)`` for ``password`` against a stored hash.
+
+    ``stored`` may be None for an unknown username. Unknown names and
+    legacy SHA-256 hashes are also checked against a dummy scrypt hash, so
+    the reply takes as long as for an account with a current hash.
+    """
+    if stored is None:
+        _check_dummy(password)
+        return False, False
+
+    if is_legacy(stored):
+        _check_dummy(password)
+        matches = hmac.compare_digest(legacy_hash(password), stored)
+        return matches, matches
+
+    try:
+        _, cost, r, p, salt, expected = stored.split("$")
+        cost, r, p = int(cost), int(r), int(p)
+        salt, expected = base64.b64decode(salt), base64.b64decode(expected)
+    except ValueError:
+        return False, False
+    matches = hmac.compare_digest(_derive(password, salt, cost, r, p, len(expected)), expected)
+    return matches, matches and (cost, r, p) != (COST, BLOCK_SIZE, PARALLELISM)
+
+
+# Brute-force limiter
+
+class FailureLimiter:
+    """Failed and in-flight attempts per username in a fixed window, bounded in size.
+
+    An attempt counts from ``acquire`` on, before any hashing, so a burst of
+    parallel guesses is cut off at ``max_failures`` just like a sequential one.
+    """
+
+    def __init__(self, max_failures=MAX_FAILURES, window=LOCKOUT_SECONDS, max_entries=100_000):
+        self.max_failures = max_failures
+        self.window = window
+        self.max_entries = max_entries
+        self.rejected = 0
+        self._entries = OrderedDict()  # username -> [failures, in flight, window start]
+        self._lock = threading.Lock()
+
+    def _current(self, username, now):
+        entry = self._entries.get(username)
+        if entry is not None and now - entry[2] > self.window:
+            if not entry[1]:
+                del self._entries[username]
+                return None
+            entry[0], entry[2] = 0, now  # a new window; attempts still running stay counted
+        return entry
+
+    def acquire(self, username):
+        """Start an attempt; False (and a counted rejection) once the name is used up.
+
+        Every acquire that returns True must be followed by ``release``.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._current(username, now)
+            if entry is None:
+                entry = self._entries[username] = [0, 0, now]
+            if entry[0] + entry[1] >= self.max_failures:
+                self.rejected += 1
+                return False
+            entry[1] += 1
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return True
+
+    def release(self, username, succeeded):
+        """Finish an attempt: a success clears the name, a failure counts against it."""
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None:
+                return  # evicted meanwhile
+            entry[1] -= 1
+            if succeeded:
+                entry[0] = 0
+            else:
+                entry[0] += 1
+            if not entry[0] and not entry[1]:
+                del self._entries[username]
+
+    def blocked(self, username):
+        """True while ``username`` has used up its attempts (counts nothing)."""
+        with self._lock:
+            entry = self._current(username, time.monotonic())
+            return entry is not None and entry[0] + entry[1] >= self.max_failures
+
+    def stats(self):
+        with self._lock:
+            return {"tracked": len(self._entries), "rejected": self.rejected,
+                    "max_failures": self.max_failures, "window_seconds": self.window}
+
+
+limiter = FailureLimiter()
@@ -0,0 +1,242 @@
+"""Batch matching scheduler.
+
+In batch mode (MEETUP_MATCHING_MODE=batch) new requests only join the
+matching engine's queues. Every BATCH_INTERVAL seconds this scheduler takes a
+snapshot of all pending requests, splits it into (area, time_slot) buckets
+(a station each; the radius matching of instant mode does not apply here)
+and pairs men and women in each bucket so that the total group-size
+mismatch is minimal, preferring requests that have waited longest when
+several pairings are equally good.
+
+Equal group sizes are paired first; what is left goes through a dynamic
+programme over both sides sorted by group size, where each DP row is a
+handful of NumPy operations. A bucket with thousands of requests is paired
+in milliseconds.
+"""
+import datetime
+import logging
+import os
+import threading
+import time
+from collections import deque, namedtuple
+
+import numpy as np
+import pandas as pd
+
+from meetup import matching
+
+logger = logging.getLogger(__name__)
+
+BATCH_INTERVAL = float(os.environ.get("MEETUP_BATCH_INTERVAL", "30"))
+
+# Largest group-size difference a batch is allowed to pair; None = no limit.
+MAX_SIZE_GAP = int(os.environ["MEETUP_MAX_SIZE_GAP"]) if os.environ.get("MEETUP_MAX_SIZE_GAP") else None
+
+# How much waiting time counts against size mismatch. Each side's wait is
+# normalised to [0, 1) within its bucket, so with a weight below 0.5 waiting
+# only breaks ties and never buys a worse size fit.
+WAIT_WEIGHT = 0.25
+
+# Reward per pair; larger than any achievable cost so the DP always prefers
+# matching more requests over leaving someone out for a better fit.
+PAIR_REWARD = 1000.0
+
+BatchReport = namedtuple(
+    "BatchReport", "started_at duration_ms plan_ms buckets candidates matches total_size_gap mean_size_gap"
+)
+
+
+def pair_bucket(sizes_a, waits_a, sizes_b, waits_b, max_gap=MAX_SIZE_GAP, wait_weight=WAIT_WEIGHT):
+    """Pair two sides of one bucket; returns ``[(index_a, index_b)]``.
+
+    Inputs are NumPy arrays of group sizes and waiting times (seconds). The
+    result maximises the number of pairs, then minimises total size gap,
+    then favours long waits.
+    """
+    if len(sizes_a) == 0 or len(sizes_b) == 0:
+        return []
+
+    if max_gap is None:
+        # Pairing equal sizes first never makes the optimum worse (swap
+        # argument on a line), and it usually leaves only a few requests
+        # for the DP. With a gap limit the swap can break the limit, so
+        # the DP has to see everything.
+        exact, rest_a, rest_b = [], [], []
+        for size in np.intersect1d(sizes_a, sizes_b):
+            index_a = np.flatnonzero(sizes_a == size)
+            index_b = np.flatnonzero(sizes_b == size)
+            index_a = index_a[np.argsort(-waits_a[index_a], kind="stable")]
+            index_b = index_b[np.argsort(-waits_b[index_b], kind="stable")]
+            k = min(len(index_a), len(index_b))
+            exact.extend(zip(index_a[:k].tolist(), index_b[:k].tolist()))
+            rest_a.append(index_a[k:])
+            rest_b.append(index_b[k:])
+        if exact:
+            rest_a.append(np.flatnonzero(~np.isin(sizes_a, sizes_b)))
+            rest_b.append(np.flatnonzero(~np.isin(sizes_b, sizes_a)))
+            rest_a, rest_b = np.concatenate(rest_a), np.concatenate(rest_b)
+            remainder = _pair_sorted(
+                sizes_a[rest_a], waits_a[rest_a], sizes_b[rest_b], waits_b[rest_b], max_gap, wait_weight
+            )
+            return exact + [(int(rest_a[i]), int(rest_b[j])) for i, j in remainder]
+
+    return _pair_sorted(sizes_a, waits_a, sizes_b, waits_b, max_gap, wait_weight)
+
+
+def _pair_sorted(sizes_a, waits_a, sizes_b, waits_b, max_gap, wait_weight):
+    n, m = len(sizes_a), len(sizes_b)
+    if n == 0 or m == 0:
+        return []
+
+    order_a = np.lexsort((-waits_a, sizes_a))
+    order_b = np.lexsort((-waits_b, sizes_b))
+    sa, sb = sizes_a[order_a].astype(float), sizes_b[order_b].astype(float)
+
+    wmax = max(waits_a.max(), waits_b.max(), 1.0) * 1.0001
+    bonus_a = wait_weight * waits_a[order_a] / wmax
+    bonus_b = wait_weight * waits_b[order_b] / wmax
+
+    base_b = -bonus_b - PAIR_REWARD
+
+    # dp[j]: best cost pairing the first i of A with the first j of B.
+    dp = np.zeros(m + 1)
+    took = np.zeros((n + 1, m + 1), dtype=bool)
+    from_left = np.zeros((n + 1, m + 1), dtype=bool)
+    for i in range(1, n + 1):
+        gap = np.abs(sb - sa[i - 1])
+        cost = gap + base_b - bonus_a[i - 1]
+        if max_gap is not None:
+            cost[gap > max_gap] = np.inf
+        take = dp[:-1] + cost
+        best = dp.copy()  # leave A[i] unpaired
+        took[i, 1:] = take < best[1:]
+        best[1:] = np.where(took[i, 1:], take, best[1:])
+        row = np.minimum.accumulate(best)  # or leave B[j] unpaired
+        from_left[i] = row < best
+        dp = row
+
+    pairs = []
+    i, j = n, m
+    while i > 0 and j > 0:
+        if from_left[i, j]:
+            j -= 1
+        elif took[i, j]:
+            pairs.append((int(order_a[i - 1]), int(order_b[j - 1])))
+            i -= 1
+            j -= 1
+        else:
+            i -= 1
+    pairs.reverse()
+    return pairs
+
+
+def plan_batch(pending, now=None):
+    """Choose pairs for a snapshot of PendingRequest tuples.
+
+    Returns ``(pairs, buckets, total_size_gap)`` where each pair is
+    ``(older_request_id, newer_request_id)``.
+    """
+    if not pending:
+        return [], 0, 0
+    now = now or datetime.datetime.utcnow()
+
+    frame = pd.DataFrame(pending, columns=matching.PendingRequest._fields)
+    frame["wait"] = (now - pd.to_datetime(frame["created_at"])).dt.total_seconds().clip(lower=0)
+
+    pairs = []
+    total_gap = 0
+    buckets = 0
+    for _, bucket in frame.groupby(["area", "time_slot"], sort=False):
+        men = bucket[bucket["gender"] == "男性"]
+        women = bucket[bucket["gender"] != "男性"]
+        if men.empty or women.empty:
+            continue
+        buckets += 1
+
+        chosen = pair_bucket(
+            men["group_size"].to_numpy(), men["wait"].to_numpy(),
+            women["group_size"].to_numpy(), women["wait"].to_numpy(),
+        )
+        if not chosen:
+            continue
+        index_m, index_w = map(np.asarray, zip(*chosen))
+        man, woman = men.iloc[index_m], women.iloc[index_w]
+        total_gap += int(np.abs(man["group_size"].to_numpy() - woman["group_size"].to_numpy()).sum())
+
+        # request_id_1 is the side that was waiting first, as in instant mode.
+        m_created, w_created = man["created_at"].to_numpy(), woman["created_at"].to_numpy()
+        m_id, w_id = man["request_id"].to_numpy(), woman["request_id"].to_numpy()
+        man_first = (m_created < w_created) | ((m_created == w_created) & (m_id < w_id))
+        first = np.where(man_first, m_id, w_id)
+        second = np.where(man_first, w_id, m_id)
+        pairs.extend(zip(first.tolist(), second.tolist()))
+    return pairs, buckets, total_gap
+
+
+def run_once(engine=None):
+    """Run a single batch and return its BatchReport."""
+    engine = engine or matching.get_engine()
+    started = time.perf_counter()
+    started_at = datetime.datetime.now()
+
+    # Resync first so requests queued by other processes are included.
+    engine.rebuild()
+    pending = engine.snapshot()
+    pairs, buckets, total_gap = plan_batch(pending)
+    planned = time.perf_counter()
+    made = engine.pair_many(pairs) if pairs else []
+
+    # Pairs skipped because a side went away must not count towards the gap.
+    if len(made) != len(pairs):
+        sizes = {p.request_id: p.group_size for p in pending}
+        total_gap = sum(abs(sizes[a] - sizes[b]) for a, b, _ in made)
+
+    return BatchReport(
+        started_at=started_at,
+        duration_ms=(time.perf_counter() - started) * 1000,
+        plan_ms=(planned - started) * 1000,
+        buckets=buckets,
+        candidates=len(pending),
+        matches=len(made),
+        total_size_gap=total_gap,
+        mean_size_gap=total_gap / len(made) if made else 0.0,
+    )
+
+
+class BatchScheduler(threading.Thread):
+    def __init__(self, interval=BATCH_INTERVAL):
+        super().__init__(name="batch-matcher", daemon=True)
+        self.interval = interval
+        self.reports = deque(maxlen=100)
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                report = run_once()
+            except Exception:
+                logger.exception("batch matching run failed")
+                continue
+            self.reports.append(report)
+            if report.matches:
+                logger.info(
+                    "batch matched %d pairs from %d candidates in %.1f ms (size gap %d)",
+                    report.matches, report.candidates, report.duration_ms, report.total_size_gap,
+                )
+
+    def stop(self):
+        self._stop_event.set()
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def start():
+    """Start the process-wide scheduler once; later calls return it."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None or not _scheduler.is_alive():
+            _scheduler = BatchScheduler()
+            _scheduler.start()
+        return _scheduler
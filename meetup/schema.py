@@ -0,0 +1,475 @@
+"""Versioned schema migrations, applied once per server process.
+
+Each migration is numbered and recorded in ``schema_version``. The first call
+to ``ensure_schema`` brings the database up to date; every later call in the
+same process returns immediately, so Streamlit reruns never touch the schema.
+"""
+import threading
+
+from meetup import db
+
+# (version, description, statements). Statements are SQL strings or
+# callables taking the connection. Append new migrations; never edit old ones.
+MIGRATIONS = [
+    (1, "initial tables", (
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            gender TEXT NOT NULL,
+            age INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS requests (
+            request_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            area TEXT NOT NULL,
+            time_slot TEXT NOT NULL,
+            group_size INTEGER NOT NULL,
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS matches (
+            match_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            request_id_1 INTEGER NOT NULL,
+            request_id_2 INTEGER NOT NULL,
+            matched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (request_id_1) REFERENCES requests (request_id),
+            FOREIGN KEY (request_id_2) REFERENCES requests (request_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS messages (
+            message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            match_id INTEGER NOT NULL,
+            sender_user_id INTEGER NOT NULL,
+            message_text TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (match_id) REFERENCES matches (match_id),
+            FOREIGN KEY (sender_user_id) REFERENCES users (user_id)
+        )
+        """,
+    )),
+    (2, "indexes for matching, pending and chat lookups", (
+        # Opposite-gender candidate search in create_request.
+        """
+        CREATE INDEX IF NOT EXISTS idx_requests_pending_bucket
+        ON requests (area, time_slot, created_at) WHERE status = 'pending'
+        """,
+        # "Does this user already have a pending request?"
+        """
+        CREATE INDEX IF NOT EXISTS idx_requests_pending_user
+        ON requests (user_id) WHERE status = 'pending'
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_requests_user ON requests (user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_matches_request_1 ON matches (request_id_1)",
+        "CREATE INDEX IF NOT EXISTS idx_matches_request_2 ON matches (request_id_2)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_match_time ON messages (match_id, timestamp)",
+    )),
+    (3, "keyset index for chat paging", (
+        "CREATE INDEX IF NOT EXISTS idx_messages_match_id ON messages (match_id, message_id)",
+    )),
+    (4, "match_participants: one row per user and match", (
+        """
+        CREATE TABLE IF NOT EXISTS match_participants (
+            user_id INTEGER NOT NULL,
+            match_id INTEGER NOT NULL,
+            partner_user_id INTEGER NOT NULL,
+            area TEXT NOT NULL,
+            time_slot TEXT NOT NULL,
+            my_group_size INTEGER NOT NULL,
+            partner_group_size INTEGER NOT NULL,
+            matched_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (user_id, match_id)
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_match_participants_recent ON match_participants (user_id, matched_at)",
+        # Kept in step with matches whichever code path creates the match.
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_matches_participants AFTER INSERT ON matches
+        BEGIN
+            INSERT INTO match_participants
+                (user_id, match_id, partner_user_id, area, time_slot, my_group_size, partner_group_size, matched_at)
+            SELECT r1.user_id, NEW.match_id, r2.user_id, r1.area, r1.time_slot, r1.group_size, r2.group_size, NEW.matched_at
+            FROM requests r1, requests r2
+            WHERE r1.request_id = NEW.request_id_1 AND r2.request_id = NEW.request_id_2;
+            INSERT INTO match_participants
+                (user_id, match_id, partner_user_id, area, time_slot, my_group_size, partner_group_size, matched_at)
+            SELECT r2.user_id, NEW.match_id, r1.user_id, r2.area, r2.time_slot, r2.group_size, r1.group_size, NEW.matched_at
+            FROM requests r1, requests r2
+            WHERE r1.request_id = NEW.request_id_1 AND r2.request_id = NEW.request_id_2;
+        END
+        """,
+        """
+        INSERT OR IGNORE INTO match_participants
+            (user_id, match_id, partner_user_id, area, time_slot, my_group_size, partner_group_size, matched_at)
+        SELECT r1.user_id, m.match_id, r2.user_id, r1.area, r1.time_slot, r1.group_size, r2.group_size, m.matched_at
+        FROM matches m
+        JOIN requests r1 ON r1.request_id = m.request_id_1
+        JOIN requests r2 ON r2.request_id = m.request_id_2
+        UNION ALL
+        SELECT r2.user_id, m.match_id, r1.user_id, r2.area, r2.time_slot, r2.group_size, r1.group_size, m.matched_at
+        FROM matches m
+        JOIN requests r1 ON r1.request_id = m.request_id_1
+        JOIN requests r2 ON r2.request_id = m.request_id_2
+        """,
+    )),
+    (5, "requests_archive for expired requests", (
+        """
+        CREATE TABLE IF NOT EXISTS requests_archive (
+            request_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            area TEXT NOT NULL,
+            time_slot TEXT NOT NULL,
+            group_size INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_requests_archive_user ON requests_archive (user_id)",
+    )),
+    (6, "archive_blocks: index of chat messages moved to segment files", (
+        """
+        CREATE TABLE IF NOT EXISTS archive_blocks (
+            match_id INTEGER NOT NULL,
+            first_message_id INTEGER NOT NULL,
+            last_message_id INTEGER NOT NULL,
+            message_count INTEGER NOT NULL,
+            segment INTEGER NOT NULL,
+            offset INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (match_id, first_message_id)
+        ) WITHOUT ROWID
+        """,
+        # Oldest-first walk when looking for chats to archive.
+        "CREATE INDEX IF NOT EXISTS idx_matches_matched_at ON matches (matched_at)",
+    )),
+    (7, "messages_fts: trigram full-text index over chat messages", (
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            message_text, content='messages', content_rowid='message_id', tokenize='trigram'
+        )
+        """,
+        # Rows up to high_water predate the index and are added by
+        # meetup.search.backfill_once; everything newer comes from the triggers.
+        """
+        CREATE TABLE IF NOT EXISTS fts_backfill (
+            name TEXT PRIMARY KEY,
+            done_through INTEGER NOT NULL,
+            high_water INTEGER NOT NULL
+        )
+        """,
+        """
+        INSERT OR IGNORE INTO fts_backfill (name, done_through, high_water)
+        SELECT 'messages_fts', 0, COALESCE(MAX(message_id), 0) FROM messages
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_messages_fts_insert AFTER INSERT ON messages
+        BEGIN
+            INSERT INTO messages_fts (rowid, message_text) VALUES (NEW.message_id, NEW.message_text);
+        END
+        """,
+        # Only rows already in the index may be deleted from it.
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_messages_fts_delete AFTER DELETE ON messages
+        WHEN OLD.message_id <= (SELECT done_through FROM fts_backfill WHERE name = 'messages_fts')
+          OR OLD.message_id > (SELECT high_water FROM fts_backfill WHERE name = 'messages_fts')
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message_text) VALUES ('delete', OLD.message_id, OLD.message_text);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_messages_fts_update AFTER UPDATE OF message_text ON messages
+        WHEN OLD.message_id <= (SELECT done_through FROM fts_backfill WHERE name = 'messages_fts')
+          OR OLD.message_id > (SELECT high_water FROM fts_backfill WHERE name = 'messages_fts')
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message_text) VALUES ('delete', OLD.message_id, OLD.message_text);
+            INSERT INTO messages_fts (rowid, message_text) VALUES (NEW.message_id, NEW.message_text);
+        END
+        """,
+    )),
+    (8, "read_cursors and a covering index for unread counts", (
+        """
+        CREATE TABLE IF NOT EXISTS read_cursors (
+            user_id INTEGER NOT NULL,
+            match_id INTEGER NOT NULL,
+            last_read_message_id INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, match_id)
+        ) WITHOUT ROWID
+        """,
+        # Counting a partner's unread messages reads only this index; it
+        # also serves the keyset paging idx_messages_match_id was made for.
+        "CREATE INDEX IF NOT EXISTS idx_messages_match_sender ON messages (match_id, message_id, sender_user_id)",
+        "DROP INDEX IF EXISTS idx_messages_match_id",
+    )),
+    (9, "change_versions: one counter per user and match", (
+        # One counter per ("user", id) / ("match", id); see meetup.versions.
+        """
+        CREATE TABLE IF NOT EXISTS change_versions (
+            scope TEXT NOT NULL,
+            topic_id INTEGER NOT NULL,
+            version INTEGER NOT NULL,
+            PRIMARY KEY (scope, topic_id)
+        ) WITHOUT ROWID
+        """,
+    )),
+    (10, "request coordinates with a grid-cell index", (
+        "ALTER TABLE requests ADD COLUMN lat REAL",
+        "ALTER TABLE requests ADD COLUMN lon REAL",
+        "ALTER TABLE requests ADD COLUMN cell INTEGER",
+        # Existing requests get their station's coordinates in one pass; the
+        # station table is frozen here as it was when this migration shipped.
+        # Areas missing from it keep NULL and match by name.
+        """
+        WITH station_points (area, lat, lon, cell) AS (VALUES
+            ('新宿', 35.6896, 139.7006, 113127985),
+            ('渋谷', 35.658, 139.7016, 113091985),
+            ('池袋', 35.7295, 139.7109, 113163985),
+            ('東京', 35.6812, 139.7671, 113127988),
+            ('品川', 35.6285, 139.7388, 113073986),
+            ('上野', 35.7138, 139.7773, 113145988),
+            ('秋葉原', 35.6984, 139.7731, 113127988),
+            ('高田馬場', 35.7126, 139.7038, 113145985),
+            ('早稲田', 35.7056, 139.7215, 113145986),
+            ('飯田橋', 35.702, 139.745, 113145987),
+            ('御茶ノ水', 35.6996, 139.765, 113127988),
+            ('神田', 35.6917, 139.7709, 113127988),
+            ('有楽町', 35.6751, 139.763, 113109988),
+            ('銀座', 35.6717, 139.765, 113109988),
+            ('新橋', 35.6663, 139.7583, 113109987),
+            ('四ツ谷', 35.686, 139.7302, 113127986),
+            ('赤坂', 35.6724, 139.7363, 113109986),
+            ('六本木', 35.6628, 139.7315, 113109986),
+            ('代々木', 35.683, 139.702, 113127985),
+            ('原宿', 35.6702, 139.7027, 113109985),
+            ('恵比寿', 35.6467, 139.7101, 113091985),
+            ('中目黒', 35.6441, 139.699, 113091984),
+            ('目黒', 35.6339, 139.7157, 113073985),
+            ('五反田', 35.6258, 139.7238, 113073986),
+            ('大崎', 35.6197, 139.7286, 113055986),
+            ('浅草', 35.7111, 139.7966, 113145989),
+            ('錦糸町', 35.6967, 139.8143, 113127990),
+            ('北千住', 35.7497, 139.8049, 113181990),
+            ('中野', 35.7056, 139.6657, 113145983),
+            ('荻窪', 35.7045, 139.62, 113145981),
+            ('吉祥寺', 35.7031, 139.5798, 113145978),
+            ('国分寺', 35.7, 139.4806, 113145974),
+            ('立川', 35.698, 139.4137, 113127970),
+            ('下北沢', 35.6613, 139.668, 113109983),
+            ('三軒茶屋', 35.6437, 139.6705, 113091983),
+            ('自由が丘', 35.6077, 139.6687, 113055983),
+            ('町田', 35.5421, 139.4455, 113001972),
+            ('川崎', 35.5313, 139.6968, 112983984),
+            ('横浜', 35.466, 139.6223, 112929981),
+            ('大宮', 35.9064, 139.6239, 113325981)
+        )
+        UPDATE requests SET lat = s.lat, lon = s.lon, cell = s.cell
+        FROM station_points s WHERE s.area = requests.area
+        """,
+        # Radius matching reads the pending requests of a few grid cells.
+        """
+        CREATE INDEX IF NOT EXISTS idx_requests_pending_cell
+        ON requests (cell, time_slot, created_at) WHERE status = 'pending'
+        """,
+    )),
+    (11, "users.avatar_hash: content hash of the profile image", (
+        # Thumbnails are files named by this hash; see meetup.avatars.
+        "ALTER TABLE users ADD COLUMN avatar_hash TEXT",
+    )),
+    (12, "demand_stats and demand_wait_histogram, maintained by triggers", (
+        # Counters per area, time slot and gender; see meetup.analytics.
+        """
+        CREATE TABLE IF NOT EXISTS demand_stats (
+            area TEXT NOT NULL,
+            time_slot TEXT NOT NULL,
+            gender TEXT NOT NULL,
+            pending INTEGER NOT NULL DEFAULT 0,
+            matched INTEGER NOT NULL DEFAULT 0,
+            cancelled INTEGER NOT NULL DEFAULT 0,
+            expired INTEGER NOT NULL DEFAULT 0,
+            wait_seconds REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (area, time_slot, gender)
+        ) WITHOUT ROWID
+        """,
+        # Matched requests per wait bucket; bucket i holds waits below the
+        # i-th bound in seconds, the last one everything from a day up.
+        """
+        CREATE TABLE IF NOT EXISTS demand_wait_histogram (
+            area TEXT NOT NULL,
+            time_slot TEXT NOT NULL,
+            gender TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            matches INTEGER NOT NULL,
+            PRIMARY KEY (area, time_slot, gender, bucket)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_demand_request_pending AFTER INSERT ON requests
+        WHEN NEW.status = 'pending'
+        BEGIN
+            INSERT INTO demand_stats (area, time_slot, gender, pending)
+            VALUES (NEW.area, NEW.time_slot, (SELECT gender FROM users WHERE user_id = NEW.user_id), 1)
+            ON CONFLICT (area, time_slot, gender) DO UPDATE SET pending = pending + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_demand_request_resolved AFTER UPDATE OF status ON requests
+        WHEN OLD.status = 'pending' AND NEW.status != 'pending'
+        BEGIN
+            UPDATE demand_stats SET pending = pending - 1
+            WHERE area = OLD.area AND time_slot = OLD.time_slot
+              AND gender = (SELECT gender FROM users WHERE user_id = OLD.user_id);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_demand_request_removed AFTER DELETE ON requests
+        WHEN OLD.status = 'pending'
+        BEGIN
+            UPDATE demand_stats SET pending = pending - 1
+            WHERE area = OLD.area AND time_slot = OLD.time_slot
+              AND gender = (SELECT gender FROM users WHERE user_id = OLD.user_id);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_demand_request_archived AFTER INSERT ON requests_archive
+        BEGIN
+            INSERT INTO demand_stats (area, time_slot, gender, cancelled, expired)
+            VALUES (NEW.area, NEW.time_slot, (SELECT gender FROM users WHERE user_id = NEW.user_id),
+                    NEW.status = 'cancelled', NEW.status = 'expired')
+            ON CONFLICT (area, time_slot, gender) DO UPDATE
+            SET cancelled = cancelled + excluded.cancelled, expired = expired + excluded.expired;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_demand_match AFTER INSERT ON matches
+        BEGIN
+            INSERT INTO demand_stats (area, time_slot, gender, matched, wait_seconds)
+            SELECT r.area, r.time_slot, u.gender, 1,
+                   MAX((julianday(NEW.matched_at) - julianday(r.created_at)) * 86400, 0)
+            FROM requests r JOIN users u ON u.user_id = r.user_id
+            WHERE r.request_id IN (NEW.request_id_1, NEW.request_id_2)
+            ON CONFLICT (area, time_slot, gender) DO UPDATE
+            SET matched = matched + 1, wait_seconds = wait_seconds + excluded.wait_seconds;
+            INSERT INTO demand_wait_histogram (area, time_slot, gender, bucket, matches)
+            SELECT area, time_slot, gender,
+                   CASE WHEN wait < 60 THEN 0 WHEN wait < 300 THEN 1 WHEN wait < 600 THEN 2
+                        WHEN wait < 1800 THEN 3 WHEN wait < 3600 THEN 4 WHEN wait < 7200 THEN 5
+                        WHEN wait < 14400 THEN 6 WHEN wait < 28800 THEN 7 WHEN wait < 86400 THEN 8
+                        ELSE 9 END, 1
+            FROM (
+                SELECT r.area, r.time_slot, u.gender,
+                       (julianday(NEW.matched_at) - julianday(r.created_at)) * 86400 AS wait
+                FROM requests r JOIN users u ON u.user_id = r.user_id
+                WHERE r.request_id IN (NEW.request_id_1, NEW.request_id_2)
+            )
+            WHERE true
+            ON CONFLICT (area, time_slot, gender, bucket) DO UPDATE SET matches = matches + 1;
+        END
+        """,
+        # Fill both tables from the rows already there.
+        """
+        INSERT INTO demand_stats (area, time_slot, gender, pending, matched, cancelled, expired, wait_seconds)
+        SELECT area, time_slot, gender, SUM(pending), SUM(matched), SUM(cancelled), SUM(expired), SUM(wait_seconds)
+        FROM (
+            SELECT r.area, r.time_slot, u.gender, 1 AS pending, 0 AS matched, 0 AS cancelled, 0 AS expired,
+                   0 AS wait_seconds
+            FROM requests r JOIN users u ON u.user_id = r.user_id
+            WHERE r.status = 'pending'
+            UNION ALL
+            SELECT a.area, a.time_slot, u.gender, 0, 0, a.status = 'cancelled', a.status = 'expired', 0
+            FROM requests_archive a JOIN users u ON u.user_id = a.user_id
+            UNION ALL
+            SELECT r.area, r.time_slot, u.gender, 0, 1, 0, 0,
+                   MAX((julianday(m.matched_at) - julianday(r.created_at)) * 86400, 0)
+            FROM matches m
+            JOIN requests r ON r.request_id IN (m.request_id_1, m.request_id_2)
+            JOIN users u ON u.user_id = r.user_id
+        )
+        GROUP BY area, time_slot, gender
+        """,
+        """
+        INSERT INTO demand_wait_histogram (area, time_slot, gender, bucket, matches)
+        SELECT area, time_slot, gender,
+               CASE WHEN wait < 60 THEN 0 WHEN wait < 300 THEN 1 WHEN wait < 600 THEN 2
+                    WHEN wait < 1800 THEN 3 WHEN wait < 3600 THEN 4 WHEN wait < 7200 THEN 5
+                    WHEN wait < 14400 THEN 6 WHEN wait < 28800 THEN 7 WHEN wait < 86400 THEN 8
+                    ELSE 9 END AS bucket,
+               COUNT(*)
+        FROM (
+            SELECT r.area, r.time_slot, u.gender,
+                   MAX((julianday(m.matched_at) - julianday(r.created_at)) * 86400, 0) AS wait
+            FROM matches m
+            JOIN requests r ON r.request_id IN (m.request_id_1, m.request_id_2)
+            JOIN users u ON u.user_id = r.user_id
+        )
+        GROUP BY area, time_slot, gender, bucket
+        """,
+    )),
+]
+
+
+_applied_path = None
+_lock = threading.Lock()
+
+
+def current_version(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT NOT NULL,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    conn.commit()
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def migrate(conn):
+    """Apply every pending migration; returns the list of versions applied."""
+    applied = []
+    for version, description, statements in MIGRATIONS:
+        if version <= current_version(conn):
+            continue
+
+        # Take the write lock first so two processes starting together
+        # cannot both apply the same migration.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,)).fetchone()
+            if row is None:
+                for statement in statements:
+                    if callable(statement):
+                        statement(conn)
+                    else:
+                        conn.execute(statement)
+                conn.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                             (version, description))
+                applied.append(version)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return applied
+
+
+def ensure_schema():
+    """Bring the configured database up to date, once per process and path."""
+    global _applied_path
+    if _applied_path == db.DB_PATH:
+        return
+    with _lock:
+        if _applied_path == db.DB_PATH:
+            return
+        with db.connection() as conn:
+            migrate(conn)
+        _applied_path = db.DB_PATH
@@ -0,0 +1,206 @@
+"""Full-text search over chat messages.
+
+``messages_fts`` is an external-content FTS5 index over
+``messages.message_text`` built with the trigram tokenizer. Trigrams need no
+word segmentation, so Japanese text matches by substring. Triggers on
+``messages`` keep the index current.
+
+Messages that existed before the index was created are added by
+``backfill_once`` in small chunks up to the high-water mark recorded by the
+migration. The delete trigger only touches rows the index already holds,
+because deleting an unindexed row from an external-content table would
+corrupt it.
+
+Trigram matching needs at least three characters per term; shorter queries
+fall back to LIKE over the user's own chats. Archived chats are no longer
+in ``messages``, so their blocks are searched by substring separately.
+
+    python -m meetup.search --backfill
+"""
+import argparse
+import logging
+import os
+import re
+import threading
+
+from meetup import archive, db
+
+logger = logging.getLogger(__name__)
+
+# Rows indexed per backfill transaction, and the pause between chunks so
+# user writes get the lock in between.
+BACKFILL_CHUNK = int(os.environ.get("MEETUP_FTS_BACKFILL_CHUNK", "2000"))
+BACKFILL_PAUSE = 0.05
+
+# Trigram index lookups need terms of at least this many characters.
+MIN_TERM_LENGTH = 3
+
+
+def terms(query):
+    return [term for term in re.split(r"\s+", query.strip()) if term]
+
+
+def fts_query(query):
+    """FTS5 MATCH expression requiring every term, each as a literal phrase."""
+    return " AND ".join('"' + term.replace('"', '""') + '"' for term in terms(query))
+
+
+def like_pattern(term):
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def uses_index(query):
+    found = terms(query)
+    return bool(found) and all(len(term) >= MIN_TERM_LENGTH for term in found)
+
+
+def search_archive(conn, user_id, query, limit):
+    """Hits in the user's archived chats, newest first, shaped like the app's search rows:
+    ``(message_id, match_id, partner_username, sender_id, sender_username, text, timestamp)``.
+
+    Blocks are read newest first and reading stops once ``limit`` hits are
+    newer than anything the remaining blocks hold, so a page of recent hits
+    does not decompress the user's whole archive.
+    """
+    needles = [term.casefold() for term in terms(query)]
+    blocks = conn.execute("""
+    SELECT b.match_id, partner.username, b.last_message_id, b.segment, b.offset, b.length
+    FROM match_participants p
+    JOIN users partner ON partner.user_id = p.partner_user_id
+    JOIN archive_blocks b ON b.match_id = p.match_id
+    WHERE p.user_id = ?
+    ORDER BY b.last_message_id DESC
+    """, (user_id,)).fetchall()
+    directory = archive.archive_dir()
+    hits = []
+    for match_id, partner_username, last_message_id, segment, offset, length in blocks:
+        if len(hits) >= limit and last_message_id < hits[-1][0]:
+            break
+        for message_id, sender_id, username, text, timestamp in archive.load_block(
+            archive.segment_path(directory, segment), offset, length
+        ):
+            folded = text.casefold()
+            if all(needle in folded for needle in needles):
+                hits.append((message_id, match_id, partner_username, sender_id, username, text, timestamp))
+        hits.sort(reverse=True)
+        del hits[limit:]
+    return hits
+
+
+# Backfill
+
+def backfill_state(conn):
+    """``(done_through, high_water)`` of the initial indexing pass."""
+    return conn.execute(
+        "SELECT done_through, high_water FROM fts_backfill WHERE name = 'messages_fts'"
+    ).fetchone()
+
+
+def backfill_once(chunk=BACKFILL_CHUNK):
+    """Index the next chunk of pre-existing messages; returns rows indexed."""
+    with db.transaction(immediate=True) as conn:
+        done_through, high_water = backfill_state(conn)
+        if done_through >= high_water:
+            return 0
+        ids = [row[0] for row in conn.execute("""
+        SELECT message_id FROM messages
+        WHERE message_id > ? AND message_id <= ?
+        ORDER BY message_id
+        LIMIT ?
+        """, (done_through, high_water, chunk))]
+        last = ids[-1] if len(ids) == chunk else high_water
+        conn.execute("""
+        INSERT INTO messages_fts (rowid, message_text)
+        SELECT message_id, message_text FROM messages
+        WHERE message_id > ? AND message_id <= ?
+        """, (done_through, last))
+        conn.execute("UPDATE fts_backfill SET done_through = ? WHERE name = 'messages_fts'", (last,))
+    return len(ids)
+
+
+# Database whose backfill is known to be complete; the high-water mark never
+# moves, so once done it stays done and start() needs no query at all.
+_complete_path = None
+
+
+def backfill_pending():
+    global _complete_path
+    with db.connection() as conn:
+        done_through, high_water = backfill_state(conn)
+    if done_through >= high_water:
+        _complete_path = db.DB_PATH
+    return done_through < high_water
+
+
+class Backfiller(threading.Thread):
+    def __init__(self, chunk=BACKFILL_CHUNK):
+        super().__init__(name="fts-backfill", daemon=True)
+        self.chunk = chunk
+        self.indexed = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                if not backfill_pending():
+                    break
+                self.indexed += backfill_once(self.chunk)
+            except Exception:
+                logger.exception("search index backfill failed")
+                return
+            self._stop_event.wait(BACKFILL_PAUSE)
+        if self.indexed:
+            logger.info("search index backfill finished (%d messages)", self.indexed)
+
+    def stop(self):
+        self._stop_event.set()
+
+
+_backfiller = None
+_backfiller_lock = threading.Lock()
+
+
+def start():
+    """Start the backfill thread if the index still misses old messages."""
+    global _backfiller
+    if _complete_path == db.DB_PATH:
+        return _backfiller
+    with _backfiller_lock:
+        if (_backfiller is None or not _backfiller.is_alive()) and backfill_pending():
+            _backfiller = Backfiller()
+            _backfiller.start()
+        return _backfiller
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the chat message search index.")
+    parser.add_argument("--db", help="database file (default: MEETUP_DB_PATH)")
+    parser.add_argument("--backfill", action="store_true", help="index every pre-existing message now")
+    parser.add_argument("--rebuild", action="store_true", help="rebuild the whole index from messages")
+    args = parser.parse_args(argv)
+
+    from meetup import schema
+    if args.db:
+        db.configure(args.db)
+    schema.ensure_schema()
+
+    if args.rebuild:
+        with db.transaction(immediate=True) as conn:
+            conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+            conn.execute("UPDATE fts_backfill SET done_through = high_water WHERE name = 'messages_fts'")
+    if args.backfill:
+        total = 0
+        while True:
+            indexed = backfill_once()
+            total += indexed
+            if not indexed:
+                break
+        print(f"indexed {total} messages")
+    with db.connection() as conn:
+        done_through, high_water = backfill_state(conn)
+    print(f"backfill: {done_through}/{high_water}")
+
+
+if __name__ == "__main__":
+    main()
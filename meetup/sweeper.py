@@ -0,0 +1,164 @@
+"""Background expiry of pending requests.
+
+A pending request is dead once its time slot has ended or once it is older
+than MAX_AGE. The sweeper moves such rows from ``requests`` into
+``requests_archive`` (status 'expired'), which keeps the pending set the
+matching engine and ``get_pending_request`` work on small. It also stops
+anyone being matched for a slot that is already over.
+
+Time slots are local times ("22:00-24:00", "24:00-26:00" runs past
+midnight), while ``created_at`` is SQLite's UTC CURRENT_TIMESTAMP. A request
+counts for the first occurrence of its slot that ends after it was created.
+That rule reduces to one created_at cutoff per slot, which is the most
+recent slot end before now, so each (area, time_slot) bucket is swept with
+an indexed range query. Work is done in BATCH_SIZE transactions so the write
+lock is never held for long.
+"""
+import datetime
+import logging
+import os
+import threading
+import time
+from collections import deque, namedtuple
+
+from meetup import cache, db, matching, notify, versions
+
+logger = logging.getLogger(__name__)
+
+# Local time zone of the time slots, as hours east of UTC (Japan by default).
+TZ_OFFSET = datetime.timedelta(hours=float(os.environ.get("MEETUP_TZ_OFFSET_HOURS", "9")))
+
+# Requests older than this expire even if their slot is still ahead.
+MAX_AGE = datetime.timedelta(hours=float(os.environ.get("MEETUP_REQUEST_MAX_AGE_HOURS", "24")))
+
+# Seconds between sweeps, and rows expired per transaction.
+SWEEP_INTERVAL = float(os.environ.get("MEETUP_SWEEP_INTERVAL", "60"))
+BATCH_SIZE = int(os.environ.get("MEETUP_SWEEP_BATCH_SIZE", "200"))
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+SweepReport = namedtuple("SweepReport", "started_at duration_ms buckets batches expired")
+
+
+def parse_slot(time_slot):
+    """``"22:00-24:00"`` -> (start, end) offsets from local midnight, or None."""
+    try:
+        start, end = (
+            datetime.timedelta(hours=int(h), minutes=int(m))
+            for h, m in (part.split(":") for part in time_slot.split("-"))
+        )
+    except ValueError:
+        return None
+    return start, end
+
+
+def expiry_cutoff(time_slot, now):
+    """UTC created_at before which a pending request for ``time_slot`` has expired."""
+    cutoff = now - MAX_AGE
+    slot = parse_slot(time_slot)
+    if slot is None:
+        return cutoff
+
+    local_now = now + TZ_OFFSET
+    slot_end = datetime.datetime.combine(local_now.date(), datetime.time()) + slot[1]
+    while slot_end > local_now:
+        slot_end -= datetime.timedelta(days=1)
+    return max(cutoff, slot_end - TZ_OFFSET)
+
+
+def _expire_batch(engine, area, time_slot, before, limit):
+    with db.transaction(immediate=True) as conn:
+        rows = conn.execute("""
+        SELECT request_id, user_id FROM requests
+        WHERE status = 'pending' AND area = ? AND time_slot = ? AND created_at < ?
+        ORDER BY created_at
+        LIMIT ?
+        """, (area, time_slot, before, limit)).fetchall()
+        if not rows:
+            return []
+        ids = [request_id for request_id, _ in rows]
+        marks = ",".join("?" * len(ids))
+        conn.execute(f"""
+        INSERT INTO requests_archive (request_id, user_id, area, time_slot, group_size, status, created_at)
+        SELECT request_id, user_id, area, time_slot, group_size, 'expired', created_at
+        FROM requests WHERE request_id IN ({marks})
+        """, ids)
+        conn.execute(f"DELETE FROM requests WHERE request_id IN ({marks})", ids)
+        bumped = versions.bump(conn, *(notify.user_topic(user_id) for _, user_id in rows))
+
+    for request_id, user_id in rows:
+        engine.discard(request_id)
+        cache.invalidate(cache.PENDING_REQUEST, user_id)
+    versions.publish(bumped)
+    return rows
+
+
+def sweep_once(engine=None, now=None, batch_size=BATCH_SIZE):
+    """Expire everything that is due and return a SweepReport."""
+    engine = engine or matching.get_engine()
+    started = time.perf_counter()
+    started_at = datetime.datetime.now()
+    now = now or datetime.datetime.utcnow()
+
+    with db.connection() as conn:
+        buckets = conn.execute("SELECT DISTINCT area, time_slot FROM requests WHERE status = 'pending'").fetchall()
+
+    batches = expired = 0
+    for area, time_slot in buckets:
+        before = expiry_cutoff(time_slot, now).strftime(TIMESTAMP_FORMAT)
+        while True:
+            rows = _expire_batch(engine, area, time_slot, before, batch_size)
+            if rows:
+                batches += 1
+                expired += len(rows)
+            if len(rows) < batch_size:
+                break
+
+    return SweepReport(
+        started_at=started_at,
+        duration_ms=(time.perf_counter() - started) * 1000,
+        buckets=len(buckets),
+        batches=batches,
+        expired=expired,
+    )
+
+
+class Sweeper(threading.Thread):
+    def __init__(self, interval=SWEEP_INTERVAL):
+        super().__init__(name="request-sweeper", daemon=True)
+        self.interval = interval
+        self.reports = deque(maxlen=100)
+        self.total_expired = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while True:
+            try:
+                report = sweep_once()
+            except Exception:
+                logger.exception("request sweep failed")
+            else:
+                self.reports.append(report)
+                self.total_expired += report.expired
+                if report.expired:
+                    logger.info("expired %d pending requests in %d batches (%.1f ms)",
+                                report.expired, report.batches, report.duration_ms)
+            if self._stop_event.wait(self.interval):
+                return
+
+    def stop(self):
+        self._stop_event.set()
+
+
+_sweeper = None
+_sweeper_lock = threading.Lock()
+
+
+def start():
+    """Start the process-wide sweeper once; later calls return it."""
+    global _sweeper
+    with _sweeper_lock:
+        if _sweeper is None or not _sweeper.is_alive():
+            _sweeper = Sweeper()
+            _sweeper.start()
+        return _sweeper
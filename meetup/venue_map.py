@@ -0,0 +1,58 @@
+"""Folium map of pending demand around a station.
+
+The map is drawn from the cached per-station aggregates of
+``app.get_pending_demand`` and rendered to one standalone page per
+(station, aggregates) pair, so reruns that show the same demand reuse it
+instead of rebuilding the map. The page is returned as a ``data:`` URL:
+a frame loaded from one gets an opaque origin, so the map's scripts cannot
+reach the app even though the popups carry text from the database. Tiles come from MEETUP_MAP_TILES,
+which can point at a caching tile proxy or a local tile server instead of
+the public OpenStreetMap servers. folium is imported on first render only.
+"""
+import base64
+import functools
+import html
+import math
+import os
+
+from meetup import geo
+
+# A folium tile name or a URL template such as "http://tiles.local/{z}/{x}/{y}.png";
+# custom URLs need an attribution.
+TILES = os.environ.get("MEETUP_MAP_TILES", "OpenStreetMap")
+ATTRIBUTION = os.environ.get("MEETUP_MAP_ATTRIBUTION")
+
+# Demand is shown this far around the chosen station.
+RADIUS_KM = float(os.environ.get("MEETUP_MAP_RADIUS_KM", "5.0"))
+
+ZOOM = 13
+HEIGHT = 420
+
+
+def by_station(demand):
+    """``{station: ((lat, lon), [(time_slot, men, women)])}`` from aggregate rows."""
+    stations = {}
+    for area, lat, lon, time_slot, men, women in demand:
+        stations.setdefault(area, ((lat, lon), []))[1].append((time_slot, men, women))
+    return stations
+
+
+@functools.lru_cache(maxsize=128)
+def render(area, demand):
+    """``data:`` URL of the map around ``area``; ``demand`` is a tuple of aggregate rows."""
+    import folium
+
+    centre = geo.locate(area)
+    fmap = folium.Map(location=centre, zoom_start=ZOOM, tiles=TILES, attr=ATTRIBUTION)
+    folium.Circle(centre, radius=geo.RADIUS_KM * 1000, color="#ff5a5f", weight=2, fill=False,
+                  tooltip=f"マッチング範囲 {geo.RADIUS_KM:g}km").add_to(fmap)
+    for station, (point, slots) in by_station(demand).items():
+        station = html.escape(station)
+        total = sum(men + women for _, men, women in slots)
+        lines = "<br>".join(f"{html.escape(slot)}: 男性 {men} / 女性 {women}" for slot, men, women in sorted(slots))
+        folium.CircleMarker(
+            point, radius=6 + 2 * math.sqrt(total), color="#ff5a5f", fill=True, fill_opacity=0.6,
+            tooltip=f"{station}: {total}件", popup=folium.Popup(f"<b>{station}</b><br>{lines}", max_width=240),
+        ).add_to(fmap)
+    page = fmap.get_root().render()
+    return "data:text/html;base64," + base64.b64encode(page.encode()).decode("ascii")
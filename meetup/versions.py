@@ -0,0 +1,61 @@
+"""Change counters per user and per match.
+
+Every write that changes what a user or a chat shows bumps a counter in
+``change_versions`` inside its own transaction. Creating, cancelling,
+matching and expiring requests bump the users involved; a new message bumps
+its match and both participants; reading a chat bumps the reader. Sessions
+keep the counter they last loaded with and skip reloading while it is
+unchanged, so checking for staleness is one primary-key lookup instead of
+the joins behind the page.
+
+Topics are the notification hub's ``("user", id)`` and ``("match", id)``
+tuples. After commit the new counters are handed to the hub, which is the
+in-memory mirror. A counter in SQLite ahead of the mirror was bumped by
+another process, so this process drops its cached lookups for that topic
+and advances the hub. With MEETUP_VERSION_CHECK=memory a single-process
+deployment skips the lookup and reads the mirror only.
+"""
+import os
+
+from meetup import cache, db, notify
+
+# "db": one indexed lookup per check, sees every process's writes.
+# "memory": read the in-process mirror only.
+CHECK = os.environ.get("MEETUP_VERSION_CHECK", "db")
+
+# Cached lookups that hang off each scope, dropped on a foreign change.
+CACHED = {"user": (cache.USER_DETAILS, cache.USER_MATCHES, cache.PENDING_REQUEST)}
+
+BUMP = """
+INSERT INTO change_versions (scope, topic_id, version) VALUES (?, ?, 1)
+ON CONFLICT (scope, topic_id) DO UPDATE SET version = version + 1
+RETURNING version
+"""
+
+
+def bump(conn, *topics):
+    """Increment ``topics`` in the caller's transaction; returns ``{topic: version}``."""
+    return {topic: conn.execute(BUMP, topic).fetchall()[0][0] for topic in set(topics)}
+
+
+def publish(bumped):
+    """Call after commit: advance the mirror and wake sessions watching these topics."""
+    notify.hub.advance(bumped)
+
+
+def current(topic):
+    """The latest counter for ``topic`` (0 if it never changed)."""
+    if CHECK == "memory":
+        return notify.hub.version(topic)
+    with db.connection() as conn:
+        row = conn.execute("SELECT version FROM change_versions WHERE scope = ? AND topic_id = ?", topic).fetchone()
+    version = row[0] if row else 0
+    if version > notify.hub.version(topic):
+        for namespace in CACHED.get(topic[0], ()):
+            cache.invalidate(namespace, topic[1])
+        notify.hub.advance({topic: version})
+    return version
+
+
+def current_many(topics):
+    return tuple(current(topic) for topic in topics)
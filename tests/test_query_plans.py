@@ -0,0 +1,15 @@
+"""Every data-access query in app.py must be served by an index."""
+from benchmarks import query_plans
+from meetup import db, schema
+
+
+def test_no_full_scans(tmp_path):
+    db.configure(str(tmp_path / "plans.db"))
+    schema.ensure_schema()
+    import app
+
+    try:
+        failures = query_plans.check(app)
+    finally:
+        db.get_pool().close()
+    assert failures == []